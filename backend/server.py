@@ -1,12 +1,17 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, Query, Request
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Query, Request, Response
+from fastapi.responses import StreamingResponse, FileResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
-import os, logging, uuid, io, csv
+from pymongo import ReturnDocument, UpdateOne, UpdateMany, DeleteOne, ReplaceOne, IndexModel
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure, PyMongoError
+import os, re, logging, uuid, io, csv, asyncio, time, json, base64, itertools, gzip, importlib.util, unicodedata
+import contextvars, copy, hashlib
 from pathlib import Path
 from pydantic import BaseModel
 from typing import List, Optional
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
 from passlib.context import CryptContext
 import jwt
@@ -15,22 +20,204 @@ ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+client = AsyncIOMotorClient(mongo_url, tz_aware=True)
 JWT_SECRET = os.environ.get('JWT_SECRET', 'aya-regulars-secret-2024')
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 app = FastAPI()
 api_router = APIRouter(prefix="/api")
 logger = logging.getLogger(__name__)
 
+# ==================== REQUEST LOADERS ====================
+# Lookups by id on the collections below go through per-request loaders: every `find_one({"id": ...})`
+# issued in the same event-loop tick is sent as one `$in` query, and the result is memoized until the
+# request ends. Any write through the same collection drops its memoized documents, so a handler that
+# reads, updates and reads again still sees its own write. Outside a request (jobs, CLI) lookups go
+# straight to MongoDB.
+LOADED_COLLECTIONS = {"users", "batches", "dancers", "passes"}
+LOADER_WRITES = {"insert_one", "insert_many", "update_one", "update_many", "replace_one", "delete_one",
+                 "delete_many", "find_one_and_update", "find_one_and_replace", "find_one_and_delete", "bulk_write"}
+request_loaders = contextvars.ContextVar("request_loaders", default=None)
+
+class Loader:
+    """Batches and memoizes lookups by id against one collection with one projection."""
+
+    def __init__(self, collection, projection):
+        self.collection, self.projection = collection, projection
+        self.cache, self.pending = {}, []
+
+    async def load(self, key):
+        fut = self.cache.get(key)
+        if fut is None:
+            loop = asyncio.get_running_loop()
+            fut = self.cache[key] = loop.create_future()
+            if not self.pending:
+                loop.call_soon(lambda: asyncio.ensure_future(self._dispatch()))
+            self.pending.append(key)
+        # Shielded so one cancelled caller doesn't cancel the lookup for everyone sharing it; callers
+        # get their own copy because handlers decorate the documents they load.
+        doc = await asyncio.shield(fut)
+        return copy.deepcopy(doc)
+
+    async def _dispatch(self):
+        keys, self.pending = self.pending, []
+        try:
+            docs = await self.collection.find({"id": {"$in": keys}}, self.projection).to_list(None)
+        except Exception as e:
+            for key in keys:
+                fut = self.cache.pop(key, None)
+                if fut is not None and not fut.done():
+                    fut.set_exception(e)
+            return
+        found = {d["id"]: d for d in docs}
+        for key in keys:
+            fut = self.cache.get(key)
+            if fut is not None and not fut.done():
+                fut.set_result(found.get(key))
+
+def loadable(filter, projection):
+    """True when a find_one can be answered by a loader: a plain id match whose projection keeps `id`."""
+    return (isinstance(filter, dict) and list(filter) == ["id"] and isinstance(filter["id"], str)
+            and (projection is None or (isinstance(projection, dict) and not any(projection.values())
+                                        and "id" not in projection)))
+
+class LoadingCollection:
+    """Collection proxy that routes id lookups to the request's loaders and clears them on writes."""
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def _loaders(self):
+        loaders = request_loaders.get()
+        return None if loaders is None else loaders.setdefault(self._collection.name, {})
+
+    def find_one(self, filter=None, *args, **kwargs):
+        projection = args[0] if args else kwargs.get("projection")
+        loaders = self._loaders()
+        if loaders is None or len(args) > 1 or set(kwargs) - {"projection"} or not loadable(filter, projection):
+            return self._collection.find_one(filter, *args, **kwargs)
+        key = tuple(sorted((projection or {}).items()))
+        if key not in loaders:
+            loaders[key] = Loader(self._collection, projection)
+        return loaders[key].load(filter["id"])
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if name not in LOADER_WRITES:
+            return attr
+
+        async def write(*args, **kwargs):
+            try:
+                return await attr(*args, **kwargs)
+            finally:
+                loaders = self._loaders()
+                if loaders is not None:
+                    loaders.clear()
+        return write
+
+class LoadingDatabase:
+    """Database proxy handing out LoadingCollection for LOADED_COLLECTIONS."""
+
+    def __init__(self, database):
+        self._database = database
+        self._collections = {name: LoadingCollection(database[name]) for name in LOADED_COLLECTIONS}
+
+    def __getitem__(self, name):
+        return self._collections.get(name) or self._database[name]
+
+    def __getattr__(self, name):
+        if name in self._collections:
+            return self._collections[name]
+        return getattr(self._database, name)
+
+async def open_request_loaders():
+    """Router dependency: give each request its own, empty set of loaders."""
+    request_loaders.set({})
+
+db = LoadingDatabase(client[os.environ['DB_NAME']])
+
+# ==================== PASSWORD HASHING ====================
+# bcrypt is deliberately slow, so it runs on a small dedicated thread pool (the C extension releases the
+# GIL) rather than on the event loop. At most PASSWORD_HASH_MAX_QUEUE hashes may be running or waiting;
+# beyond that requests get a 503 with Retry-After instead of piling up behind each other. Hashes made
+# with fewer than BCRYPT_ROUNDS rounds are flagged by needs_update and rehashed on the next login.
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", "12"))
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", "2"))
+PASSWORD_HASH_MAX_QUEUE = int(os.environ.get("PASSWORD_HASH_MAX_QUEUE", "32"))
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto",
+                           bcrypt__default_rounds=BCRYPT_ROUNDS, bcrypt__min_rounds=BCRYPT_ROUNDS)
+
+class PasswordHasher:
+    """Bounded off-loop front for pwd_context."""
+
+    def __init__(self, workers, max_queue):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self.max_queue, self.depth = max_queue, 0
+
+    async def _run(self, fn, *args):
+        if self.depth >= self.max_queue:
+            raise HTTPException(503, "Too many sign-ins in progress, please retry", headers={"Retry-After": "1"})
+        self.depth += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+        finally:
+            self.depth -= 1
+
+    async def hash(self, password):
+        return await self._run(pwd_context.hash, password)
+
+    async def verify_and_update(self, password, password_hash):
+        """Returns (matches, new_hash); new_hash is set when the stored hash should be replaced."""
+        return await self._run(pwd_context.verify_and_update, password, password_hash)
+
+password_hasher = PasswordHasher(PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_QUEUE)
+
+# ==================== CACHE HELPERS ====================
+class TTLCache:
+    """Small in-process LRU cache whose entries also expire after `ttl` seconds."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize, self.ttl = maxsize, ttl
+        self._data = OrderedDict()
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (value, time.monotonic() + self.ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
 # ==================== AUTH HELPERS ====================
-def create_token(user_id: str, role: str) -> str:
+# Authenticated users are served from an in-process cache. Tokens carry the user's token_version
+# ("tv"); bumping it on deactivation or password change revokes every outstanding token.
+user_cache = TTLCache(int(os.environ.get("USER_CACHE_SIZE", "1024")),
+                      float(os.environ.get("USER_CACHE_TTL_SECONDS", "60")))
+
+def create_token(user_id: str, role: str, token_version: int = 0) -> str:
     return jwt.encode(
-        {"user_id": user_id, "role": role, "exp": datetime.now(timezone.utc) + timedelta(hours=24)},
+        {"user_id": user_id, "role": role, "tv": token_version,
+         "exp": datetime.now(timezone.utc) + timedelta(hours=24)},
         JWT_SECRET, algorithm="HS256"
     )
 
+def invalidate_user(user_id: str):
+    user_cache.pop(user_id)
+
 async def get_current_user(request: Request):
     auth = request.headers.get("Authorization", "")
     if not auth.startswith("Bearer "):
@@ -41,18 +228,24 @@ async def get_current_user(request: Request):
         raise HTTPException(401, "Token expired")
     except jwt.InvalidTokenError:
         raise HTTPException(401, "Invalid token")
-    user = await db.users.find_one({"id": payload["user_id"]}, {"_id": 0})
+    user = user_cache.get(payload["user_id"])
+    if user is None:
+        user = await db.users.find_one({"id": payload["user_id"]}, {"_id": 0, "password_hash": 0})
+        if user:
+            user_cache.set(user["id"], user)
     if not user or not user.get("active", True):
         raise HTTPException(401, "User not found or inactive")
-    return user
+    if payload.get("tv", 0) != user.get("token_version", 0):
+        raise HTTPException(401, "Token revoked")
+    return dict(user)
 
 def require_admin(user):
     if user.get("role") != "admin":
         raise HTTPException(403, "Admin access required")
 
 # ==================== AUDIT LOG HELPER ====================
-async def audit_log(actor_id, action_type, entity_type, entity_id, metadata=None):
-    doc = {
+def audit_entry(actor_id, action_type, entity_type, entity_id, metadata=None):
+    return {
         "id": str(uuid.uuid4()),
         "actor_user_id": actor_id,
         "action_type": action_type,
@@ -61,25 +254,380 @@ async def audit_log(actor_id, action_type, entity_type, entity_id, metadata=None
         "metadata": metadata or {},
         "timestamp": datetime.now(timezone.utc).isoformat()
     }
-    await db.audit_log.insert_one({**doc})
+
+def audit_diff(old, updates):
+    """Metadata for an update: only the fields whose value changed, as {field: [before, after]}."""
+    old = old or {}
+    return {"changes": {k: [old.get(k), v] for k, v in updates.items() if old.get(k) != v}}
+
+def audit_changes(metadata):
+    """Field changes of an entry, reading both diffs and the older full before/after snapshots."""
+    if "changes" in metadata:
+        return metadata["changes"]
+    if isinstance(metadata.get("after"), dict):
+        before = metadata.get("before") or {}
+        return {k: [before.get(k), v] for k, v in metadata["after"].items()}
+    return {}
+
+def expand_audit_metadata(metadata):
+    """Present a diff as before/after dicts of the changed fields."""
+    if "changes" not in metadata:
+        return metadata
+    rest = {k: v for k, v in metadata.items() if k != "changes"}
+    return {**rest, "before": {k: c[0] for k, c in metadata["changes"].items()},
+            "after": {k: c[1] for k, c in metadata["changes"].items()}}
+
+class AuditBuffer:
+    """Write-behind queue for audit entries.
+
+    Mutations enqueue entries and return; a background task writes them with insert_many once
+    `batch_size` entries are waiting or `flush_seconds` have passed. The queue is bounded, so
+    producers wait when persistence falls behind instead of growing memory. With `sync` set (or
+    before start()/after stop(), or if the writer task has died) entries are written inline.
+    """
+
+    def __init__(self, batch_size, flush_seconds, max_queue, sync=False):
+        self.batch_size, self.flush_seconds, self.sync = batch_size, flush_seconds, sync
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self._task = None
+
+    def start(self):
+        if not self.sync and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Flush everything queued so far and stop the writer."""
+        if self._task is None:
+            return
+        if self._task.done():
+            await self._write(self._drain())
+        else:
+            await self.queue.put(None)
+            await self._task
+        self._task = None
+
+    def _drain(self):
+        entries = []
+        while not self.queue.empty():
+            entry = self.queue.get_nowait()
+            if entry is not None:
+                entries.append(entry)
+        return entries
+
+    async def put(self, entries):
+        if self._task is None or self._task.done():
+            await self._write(self._drain() + list(entries))
+            return
+        for entry in entries:
+            await self.queue.put(entry)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            first = await self.queue.get()
+            if first is None:
+                break
+            batch, deadline = [first], loop.time() + self.flush_seconds
+            while len(batch) < self.batch_size:
+                try:
+                    entry = await asyncio.wait_for(self.queue.get(), max(deadline - loop.time(), 0))
+                except asyncio.TimeoutError:
+                    break
+                if entry is None:
+                    stopping = True
+                    break
+                batch.append(entry)
+            try:
+                await self._write(batch)
+            except Exception:
+                # One bad batch must not stop the writer, or every later entry would queue forever
+                logger.exception("Dropping %d audit entries after an unexpected write error", len(batch))
+
+    async def _write(self, entries, attempts=3):
+        if not entries:
+            return
+        for attempt in range(attempts):
+            try:
+                await db.audit_log.insert_many(entries, ordered=False)
+                return
+            except BulkWriteError as e:
+                # A retry after a partial write only trips over entries that already landed
+                if all(err.get("code") == 11000 for err in e.details.get("writeErrors", [])):
+                    return
+                error = e
+            except Exception as e:
+                error = e
+            await asyncio.sleep(0.5 * 2 ** attempt)
+        logger.error("Dropping %d audit entries after %d failed writes (%s): %s",
+                     len(entries), attempts, error, [e["id"] for e in entries])
+
+audit_buffer = AuditBuffer(
+    batch_size=int(os.environ.get("AUDIT_BATCH_SIZE", "200")),
+    flush_seconds=float(os.environ.get("AUDIT_FLUSH_SECONDS", "1")),
+    max_queue=int(os.environ.get("AUDIT_QUEUE_MAX", "10000")),
+    sync=os.environ.get("AUDIT_SYNC", "").lower() in ("1", "true", "yes"),
+)
+
+async def audit_log(actor_id, action_type, entity_type, entity_id, metadata=None):
+    await audit_buffer.put([audit_entry(actor_id, action_type, entity_type, entity_id, metadata)])
+
+async def audit_log_many(entries):
+    await audit_buffer.put(entries)
+
+# ==================== AUDIT LOG ARCHIVE ====================
+# Entries older than AUDIT_RETENTION_DAYS move out of MongoDB into gzip NDJSON files, one per UTC day,
+# under AUDIT_ARCHIVE_DIR (use shared storage when workers run on several hosts). index.json records
+# each day's file, entry count, time range and the distinct filter values, so reads only open the
+# partitions that can match. One worker at a time archives, holding a lease in the locks collection.
+AUDIT_RETENTION_DAYS = int(os.environ.get("AUDIT_RETENTION_DAYS", "180"))
+AUDIT_ARCHIVE_DIR = Path(os.environ.get("AUDIT_ARCHIVE_DIR", str(ROOT_DIR / "audit_archive")))
+AUDIT_ARCHIVE_INTERVAL_SECONDS = int(os.environ.get("AUDIT_ARCHIVE_INTERVAL_SECONDS", "3600"))
+AUDIT_ARCHIVE_BATCH_SIZE = int(os.environ.get("AUDIT_ARCHIVE_BATCH_SIZE", "5000"))
+WORKER_ID = str(uuid.uuid4())
+
+async def acquire_lease(name, seconds):
+    """Take or extend a lease shared by all workers; False while another worker holds it."""
+    now = datetime.now(timezone.utc)
+    try:
+        await db.locks.update_one(
+            {"_id": name, "$or": [{"owner": WORKER_ID}, {"expires_at": {"$lt": now}}]},
+            {"$set": {"owner": WORKER_ID, "expires_at": now + timedelta(seconds=seconds)}}, upsert=True)
+    except DuplicateKeyError:
+        return False
+    return True
+
+async def hold_lease(name, seconds):
+    """Renew a lease this worker holds until cancelled, for work that can outlast one lease period."""
+    while True:
+        await asyncio.sleep(seconds / 4)
+        try:
+            await acquire_lease(name, seconds)
+        except PyMongoError:
+            logger.warning("Renewing the %s lease failed", name, exc_info=True)
+
+async def release_lease(name):
+    await db.locks.delete_one({"_id": name, "owner": WORKER_ID})
+
+def json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+class AuditArchive:
+    """Day-partitioned, compressed store for audit entries past retention.
+
+    Partition files are rewritten whole through a temp file and os.replace, so a crash leaves either
+    the old or the new file. Entries are deleted from MongoDB only after their partition and the
+    index are on disk; a run interrupted in between is repeated safely because appends skip ids the
+    partition already holds.
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self._index, self._mtime = {"partitions": {}}, None
+
+    def index(self):
+        path = self.root / "index.json"
+        try:
+            mtime = path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return {"partitions": {}}
+        if mtime != self._mtime:
+            self._index, self._mtime = json.loads(path.read_text()), mtime
+        return self._index
+
+    def _replace(self, path, data):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + ".tmp")
+        with open(tmp, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def _read(self, meta):
+        with gzip.open(self.root / meta["file"], "rt", encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def append(self, entries):
+        """Add entries to their day partitions and rewrite the index."""
+        partitions = dict(self.index()["partitions"])
+        by_day = {}
+        for e in entries:
+            by_day.setdefault(e["timestamp"][:10], []).append(e)
+        for day, rows in by_day.items():
+            meta = partitions.get(day)
+            existing = self._read(meta) if meta else []
+            seen = {e["id"] for e in existing}
+            rows = existing + [e for e in rows if e["id"] not in seen]
+            rows.sort(key=lambda e: (e["timestamp"], e["id"]))
+            meta = {
+                "file": f"{day[:4]}/{day[5:7]}/audit-{day}.ndjson.gz", "count": len(rows),
+                "min_timestamp": rows[0]["timestamp"], "max_timestamp": rows[-1]["timestamp"],
+                **{f: sorted({e.get(f) for e in rows if e.get(f)}) for f in AUDIT_LOG_FILTER_FIELDS},
+            }
+            body = "".join(json.dumps(e, default=json_default) + "\n" for e in rows)
+            self._replace(self.root / meta["file"], gzip.compress(body.encode()))
+            partitions[day] = meta
+        self._replace(self.root / "index.json", json.dumps({"partitions": partitions}).encode())
+
+    def _partitions(self, filters, start=None, end=None, before=None):
+        """Candidate partitions, newest day first."""
+        for day, meta in sorted(self.index()["partitions"].items(), reverse=True):
+            if (start and meta["max_timestamp"] < start) or (end and meta["min_timestamp"] > end):
+                continue
+            if before and meta["min_timestamp"] > before[0]:
+                continue
+            if any(field in meta and value not in meta[field] for field, value in filters.items()):
+                continue
+            yield meta
+
+    @staticmethod
+    def _matches(e, filters, start, end, before):
+        return (all(e.get(f) == v for f, v in filters.items())
+                and (not start or e["timestamp"] >= start) and (not end or e["timestamp"] <= end)
+                and (not before or (e["timestamp"], e["id"]) < tuple(before)))
+
+    def find(self, filters, start=None, end=None, before=None, limit=50):
+        """Archived entries matching the audit-log filters, newest first, strictly after keyset `before`."""
+        found = []
+        for meta in self._partitions(filters, start, end, before):
+            rows = [e for e in self._read(meta) if self._matches(e, filters, start, end, before)]
+            rows.sort(key=lambda e: (e["timestamp"], e["id"]), reverse=True)
+            found.extend(rows[:limit - len(found)])
+            if len(found) >= limit:
+                break
+        return found
+
+    def count(self, filters, start=None, end=None):
+        total = 0
+        for meta in self._partitions(filters, start, end):
+            if not filters and (not start or meta["min_timestamp"] >= start) and (not end or meta["max_timestamp"] <= end):
+                total += meta["count"]
+            else:
+                total += sum(1 for e in self._read(meta) if self._matches(e, filters, start, end, None))
+        return total
+
+    async def run(self, retention_days=AUDIT_RETENTION_DAYS):
+        """Move entries older than the retention window from MongoDB into the archive."""
+        cutoff = (datetime.now(timezone.utc) - timedelta(days=retention_days)).isoformat()
+        moved = 0
+        while True:
+            entries = await db.audit_log.find({"timestamp": {"$lt": cutoff}}, {"_id": 0}).sort(
+                [("timestamp", 1), ("id", 1)]).limit(AUDIT_ARCHIVE_BATCH_SIZE).to_list(AUDIT_ARCHIVE_BATCH_SIZE)
+            if not entries:
+                break
+            await asyncio.to_thread(self.append, entries)
+            await db.audit_log.delete_many({"id": {"$in": [e["id"] for e in entries]}})
+            moved += len(entries)
+        if moved:
+            logger.info("Archived %d audit entries older than %s", moved, cutoff)
+        return moved
+
+audit_archive = AuditArchive(AUDIT_ARCHIVE_DIR)
+
+async def audit_archive_job():
+    while True:
+        try:
+            # The lease outlives one interval so the holder keeps it across runs
+            if await acquire_lease("audit_archive", AUDIT_ARCHIVE_INTERVAL_SECONDS * 2):
+                await audit_archive.run()
+        except Exception:
+            logger.exception("Audit log archival failed")
+        await asyncio.sleep(AUDIT_ARCHIVE_INTERVAL_SECONDS)
 
 # ==================== SETTINGS & PASS STATUS HELPERS ====================
+# Settings are cached per worker. update_settings bumps a version counter on the document; other
+# workers drop their copy from a change stream, or by polling that counter when the deployment
+# has no replica set.
+SETTINGS_POLL_SECONDS = float(os.environ.get("SETTINGS_POLL_SECONDS", "5"))
+settings_cache = {"value": None, "generation": 0}
+
 async def get_settings():
-    s = await db.settings.find_one({"id": "global"}, {"_id": 0})
-    return s or {"id": "global", "monthly_expiry_warning_days": 5, "class_pack_expiry_warning_remaining": 2}
+    value = settings_cache["value"]
+    if value is None:
+        generation = settings_cache["generation"]
+        s = await db.settings.find_one({"id": "global"}, {"_id": 0})
+        value = s or {"id": "global", "monthly_expiry_warning_days": 5, "class_pack_expiry_warning_remaining": 2}
+        # Don't cache a read that raced with an invalidation
+        if generation == settings_cache["generation"]:
+            settings_cache["value"] = value
+    return {k: v for k, v in value.items() if k != "version"}
+
+def invalidate_settings():
+    settings_cache["value"] = None
+    settings_cache["generation"] += 1
+
+def invalidate_caches():
+    invalidate_settings()
+    user_cache.clear()
+
+async def watch_cache_invalidations():
+    """Drop cached settings and users changed by other workers.
+
+    Both caches are emptied whenever the stream (re)opens or polling takes over, since changes made
+    while no stream was open are never delivered.
+    """
+    pipeline = [{"$match": {"ns.coll": {"$in": ["settings", "users"]}}}]
+    while True:
+        try:
+            async with db.watch(pipeline, full_document="updateLookup") as stream:
+                invalidate_caches()
+                async for change in stream:
+                    if change["ns"]["coll"] == "settings":
+                        invalidate_settings()
+                    elif change.get("fullDocument"):
+                        invalidate_user(change["fullDocument"]["id"])
+        except OperationFailure as e:
+            logger.info("Change streams unavailable (%s); polling settings version every %ss", e, SETTINGS_POLL_SECONDS)
+            break
+        except PyMongoError:
+            logger.exception("Cache invalidation stream failed, reconnecting")
+            await asyncio.sleep(SETTINGS_POLL_SECONDS)
+    invalidate_caches()
+    while True:
+        await asyncio.sleep(SETTINGS_POLL_SECONDS)
+        try:
+            doc = await db.settings.find_one({"id": "global"}, {"_id": 0, "version": 1})
+            cached = settings_cache["value"]
+            if cached is not None and (doc or {}).get("version", 0) != cached.get("version", 0):
+                invalidate_settings()
+        except PyMongoError:
+            logger.exception("Settings version poll failed")
+
+PASS_DATE_FIELDS = ("start_date", "end_date", "valid_date")
+
+def parse_pass_date(value):
+    """Coerce an ISO date/datetime string or datetime to an aware UTC datetime; blanks become None."""
+    if value is None or value == "":
+        return None
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+def request_pass_date(value, default=None):
+    try:
+        return parse_pass_date(value) or default
+    except ValueError:
+        raise HTTPException(400, f"Invalid date: {value}")
+
+def format_date(value):
+    return value.strftime("%Y-%m-%d") if isinstance(value, datetime) else (value or "")[:10]
 
 def compute_pass_status(p, settings):
     now = datetime.now(timezone.utc)
-    now_iso = now.isoformat()
     if p["type"] == "monthly":
-        if now_iso > p.get("end_date", ""):
-            return "expired"
         try:
-            end = datetime.fromisoformat(p["end_date"])
-            if (end - now).days <= settings.get("monthly_expiry_warning_days", 5):
-                return "expiring_soon"
-        except Exception:
-            pass
+            end = parse_pass_date(p.get("end_date"))
+        except ValueError:
+            end = None
+        if end is None or end < now:
+            return "expired"
+        if (end - now).days <= settings.get("monthly_expiry_warning_days", 5):
+            return "expiring_soon"
         return "active"
     elif p["type"] == "class_pack":
         if p.get("remaining_classes", 0) <= 0:
@@ -91,6 +639,141 @@ def compute_pass_status(p, settings):
         return p.get("status", "unused")
     return "unknown"
 
+def pass_status_expr(settings, now=None):
+    """Aggregation expression mirroring compute_pass_status for the current pass document."""
+    now = now or datetime.now(timezone.utc)
+    warn_until = now + timedelta(days=settings.get("monthly_expiry_warning_days", 5) + 1)
+    remaining = {"$ifNull": ["$remaining_classes", 0]}
+    return {"$switch": {"branches": [
+        {"case": {"$eq": ["$type", "monthly"]}, "then": {"$cond": [
+            {"$lt": [{"$ifNull": ["$end_date", None]}, now]}, "expired",
+            {"$cond": [{"$lt": ["$end_date", warn_until]}, "expiring_soon", "active"]}
+        ]}},
+        {"case": {"$eq": ["$type", "class_pack"]}, "then": {"$cond": [
+            {"$lte": [remaining, 0]}, "expired",
+            {"$cond": [{"$lte": [remaining, settings.get("class_pack_expiry_warning_remaining", 2)]},
+                       "expiring_soon", "active"]}
+        ]}},
+        {"case": {"$eq": ["$type", "drop_in"]}, "then": {"$ifNull": ["$status", "unused"]}},
+    ], "default": "unknown"}}
+
+def pass_status_query(status, settings, now=None):
+    """Find filter for passes whose compute_pass_status is "expired" or "expiring_soon".
+
+    Served by the (type, end_date) and (type, remaining_classes) indexes.
+    """
+    now = now or datetime.now(timezone.utc)
+    if status == "expired":
+        return {"$or": [
+            {"type": "monthly", "end_date": {"$lt": now}},
+            {"type": "monthly", "end_date": None},
+            {"type": "class_pack", "remaining_classes": {"$lte": 0}},
+        ]}
+    warn_until = now + timedelta(days=settings.get("monthly_expiry_warning_days", 5) + 1)
+    return {"$or": [
+        {"type": "monthly", "end_date": {"$gte": now, "$lt": warn_until}},
+        {"type": "class_pack", "remaining_classes": {
+            "$gt": 0, "$lte": settings.get("class_pack_expiry_warning_remaining", 2)}},
+    ]}
+
+async def migrate_pass_dates():
+    """Convert pass dates stored as ISO strings to BSON datetimes. Safe to re-run."""
+    query = {"$or": [{f: {"$type": "string"}} for f in PASS_DATE_FIELDS]}
+    ops = []
+    async for p in db.passes.find(query, {"_id": 0, "id": 1, **{f: 1 for f in PASS_DATE_FIELDS}}):
+        updates = {}
+        for f in PASS_DATE_FIELDS:
+            if isinstance(p.get(f), str):
+                try:
+                    updates[f] = parse_pass_date(p[f])
+                except ValueError:
+                    logger.warning("Pass %s has unparseable %s %r, clearing it", p["id"], f, p[f])
+                    updates[f] = None
+        ops.append(UpdateOne({"id": p["id"]}, {"$set": updates}))
+        if len(ops) >= 1000:
+            await db.passes.bulk_write(ops, ordered=False)
+            ops = []
+    if ops:
+        await db.passes.bulk_write(ops, ordered=False)
+
+def usable_passes(passes, settings):
+    """Passes (newest first) that can pay for a class, in the order they should be tried."""
+    return [p for p in passes if compute_pass_status(p, settings) in ("active", "expiring_soon")
+            or (p["type"] == "drop_in" and p.get("status") == "unused")]
+
+# ==================== CURRENT PASS PROJECTION ====================
+# current_passes keeps one entry per (dancer_id, batch_id) pointing at the pass that is shown and
+# charged for that dancer in that batch. It is refreshed whenever passes are created, renewed or
+# consumed, so read paths join it instead of sorting each dancer's pass history.
+def select_current_pass(passes, settings):
+    """Newest usable pass, falling back to the newest pass; `passes` must be sorted newest first."""
+    usable = usable_passes(passes, settings)
+    return usable[0] if usable else passes[0]
+
+async def refresh_current_passes(batch_id, dancer_ids):
+    if not dancer_ids:
+        return
+    settings = await get_settings()
+    passes = await db.passes.find(
+        {"batch_id": batch_id, "dancer_id": {"$in": list(dancer_ids)}}, {"_id": 0}
+    ).sort("created_at", -1).to_list(None)
+    by_dancer = {}
+    for p in passes:
+        by_dancer.setdefault(p["dancer_id"], []).append(p)
+    now_iso = datetime.now(timezone.utc).isoformat()
+    ops = []
+    for did in set(dancer_ids):
+        key = {"dancer_id": did, "batch_id": batch_id}
+        if did in by_dancer:
+            current = select_current_pass(by_dancer[did], settings)
+            ops.append(UpdateOne(key, {"$set": {"pass_id": current["id"], "updated_at": now_iso}}, upsert=True))
+        else:
+            ops.append(DeleteOne(key))
+    await db.current_passes.bulk_write(ops, ordered=False)
+
+async def rebuild_current_passes():
+    """Recompute the whole projection from the pass history."""
+    pairs = await db.passes.aggregate([
+        {"$group": {"_id": "$batch_id", "dancer_ids": {"$addToSet": "$dancer_id"}}}
+    ]).to_list(None)
+    for pair in pairs:
+        await refresh_current_passes(pair["_id"], pair["dancer_ids"])
+
+async def dedupe_current_passes():
+    """Drop projection entries sharing (dancer_id, batch_id) and recompute those pairs from pass history."""
+    groups = await db.current_passes.aggregate([
+        {"$group": {"_id": {"dancer_id": "$dancer_id", "batch_id": "$batch_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+    ], allowDiskUse=True).to_list(None)
+    by_batch = {}
+    for group in groups:
+        await db.current_passes.delete_many(group["_id"])
+        by_batch.setdefault(group["_id"]["batch_id"], []).append(group["_id"]["dancer_id"])
+    for batch_id, dancer_ids in by_batch.items():
+        await refresh_current_passes(batch_id, dancer_ids)
+    if groups:
+        logger.info("Rebuilt %d duplicated current pass entries", len(groups))
+
+def current_pass_pipeline(match):
+    """Pipeline yielding the current pass documents for projection entries matching `match`."""
+    return [
+        {"$match": match},
+        {"$lookup": {"from": "passes", "localField": "pass_id", "foreignField": "id", "as": "pass"}},
+        {"$unwind": "$pass"},
+        {"$replaceRoot": {"newRoot": "$pass"}},
+        {"$project": {"_id": 0}},
+    ]
+
+async def load_current_passes(match):
+    passes = await db.current_passes.aggregate(current_pass_pipeline(match)).to_list(None)
+    return {(p["dancer_id"], p["batch_id"]): p for p in passes}
+
+async def count_current_pass_statuses(match, settings):
+    buckets = await db.current_passes.aggregate(current_pass_pipeline(match) + [
+        {"$group": {"_id": pass_status_expr(settings), "count": {"$sum": 1}}}
+    ]).to_list(None)
+    return {b["_id"]: b["count"] for b in buckets}
+
 # ==================== PYDANTIC MODELS ====================
 class LoginReq(BaseModel):
     email: str
@@ -132,15 +815,41 @@ class AttendanceBulkReq(BaseModel):
     batch_id: str
     records: List[AttendanceRecord]
 
+class AttendanceDelta(BaseModel):
+    id: str
+    dancer_id: str
+    status: str
+    client_timestamp: str
+    session_id: Optional[str] = None
+
+class AttendanceSyncReq(BaseModel):
+    session_id: str
+    batch_id: str
+    deltas: List[AttendanceDelta] = []
+    cursor: Optional[str] = None
+
+class ExportJobReq(BaseModel):
+    format: str = "csv"
+    batch_id: Optional[str] = None
+    start_date: Optional[str] = None
+    end_date: Optional[str] = None
+
 # ==================== AUTH ROUTES ====================
 @api_router.post("/auth/login")
 async def login(req: LoginReq):
     user = await db.users.find_one({"email": req.email}, {"_id": 0})
-    if not user or not pwd_context.verify(req.password, user["password_hash"]):
+    if not user:
+        raise HTTPException(401, "Invalid credentials")
+    ok, new_hash = await password_hasher.verify_and_update(req.password, user["password_hash"])
+    if not ok:
         raise HTTPException(401, "Invalid credentials")
     if not user.get("active", True):
         raise HTTPException(401, "Account disabled")
-    token = create_token(user["id"], user["role"])
+    if new_hash:
+        # Only replace the hash we verified; a concurrent password change wins.
+        await db.users.update_one({"id": user["id"], "password_hash": user["password_hash"]},
+                                  {"$set": {"password_hash": new_hash}})
+    token = create_token(user["id"], user["role"], user.get("token_version", 0))
     return {"token": token, "user": {k: v for k, v in user.items() if k != "password_hash"}}
 
 @api_router.get("/auth/me")
@@ -160,7 +869,7 @@ async def create_user(data: UserCreateReq, user=Depends(get_current_user)):
         raise HTTPException(400, "Email already exists")
     doc = {
         "id": str(uuid.uuid4()), "email": data.email,
-        "password_hash": pwd_context.hash(data.password),
+        "password_hash": await password_hasher.hash(data.password),
         "name": data.name, "role": "instructor", "active": True,
         "created_at": datetime.now(timezone.utc).isoformat()
     }
@@ -176,10 +885,14 @@ async def update_user(user_id: str, data: dict, user=Depends(get_current_user)):
         if k in data:
             updates[k] = data[k]
     if data.get("password"):
-        updates["password_hash"] = pwd_context.hash(data["password"])
+        updates["password_hash"] = await password_hasher.hash(data["password"])
     if not updates:
         raise HTTPException(400, "Nothing to update")
-    await db.users.update_one({"id": user_id}, {"$set": updates})
+    change = {"$set": updates}
+    if "password_hash" in updates or updates.get("active") is False:
+        change["$inc"] = {"token_version": 1}
+    await db.users.update_one({"id": user_id}, change)
+    invalidate_user(user_id)
     await audit_log(user["id"], "update_instructor", "user", user_id,
                     {"updates": {k: v for k, v in updates.items() if k != "password_hash"}})
     return await db.users.find_one({"id": user_id}, {"_id": 0, "password_hash": 0})
@@ -187,7 +900,8 @@ async def update_user(user_id: str, data: dict, user=Depends(get_current_user)):
 @api_router.delete("/users/{user_id}")
 async def deactivate_user(user_id: str, user=Depends(get_current_user)):
     require_admin(user)
-    await db.users.update_one({"id": user_id}, {"$set": {"active": False}})
+    await db.users.update_one({"id": user_id}, {"$set": {"active": False}, "$inc": {"token_version": 1}})
+    invalidate_user(user_id)
     await audit_log(user["id"], "deactivate_instructor", "user", user_id)
     return {"status": "deactivated"}
 
@@ -195,28 +909,38 @@ async def deactivate_user(user_id: str, user=Depends(get_current_user)):
 @api_router.get("/batches")
 async def list_batches(user=Depends(get_current_user)):
     query = {} if user["role"] == "admin" else {"assigned_instructor_ids": user["id"]}
-    batches = await db.batches.find(query, {"_id": 0}).to_list(1000)
     settings = await get_settings()
-    for b in batches:
-        enrollments = await db.enrollments.find({"batch_id": b["id"], "active": True}, {"_id": 0}).to_list(5000)
-        b["dancer_count"] = len(enrollments)
-        dancer_ids = [e["dancer_id"] for e in enrollments]
-        passes = await db.passes.find({"batch_id": b["id"], "dancer_id": {"$in": dancer_ids}}, {"_id": 0}).to_list(5000)
-        # Deduplicate: only latest pass per dancer
-        latest_passes = {}
-        for p in sorted(passes, key=lambda x: x.get("created_at", ""), reverse=True):
-            if p["dancer_id"] not in latest_passes:
-                latest_passes[p["dancer_id"]] = p
-        unique_passes = list(latest_passes.values())
-        b["expiring_soon_count"] = sum(1 for p in unique_passes if compute_pass_status(p, settings) == "expiring_soon")
-        b["expired_count"] = sum(1 for p in unique_passes if compute_pass_status(p, settings) == "expired")
-        if b.get("assigned_instructor_ids"):
-            b["instructors"] = await db.users.find(
-                {"id": {"$in": b["assigned_instructor_ids"]}}, {"_id": 0, "password_hash": 0}
-            ).to_list(100)
-        else:
-            b["instructors"] = []
-    return batches
+
+    def bucket_count(status):
+        return {"$sum": {"$map": {
+            "input": {"$filter": {"input": "$_pass_buckets", "cond": {"$eq": ["$$this._id", status]}}},
+            "in": "$$this.count"
+        }}}
+
+    pipeline = [
+        {"$match": query},
+        {"$lookup": {"from": "enrollments", "let": {"bid": "$id"}, "pipeline": [
+            {"$match": {"$expr": {"$eq": ["$batch_id", "$$bid"]}, "active": True}},
+            {"$project": {"_id": 0, "dancer_id": 1}},
+        ], "as": "_enrolled"}},
+        # Current pass per enrolled dancer, bucketed by computed status
+        {"$lookup": {"from": "current_passes", "let": {"bid": "$id", "dids": "$_enrolled.dancer_id"}, "pipeline": [
+            {"$match": {"$expr": {"$and": [{"$eq": ["$batch_id", "$$bid"]}, {"$in": ["$dancer_id", "$$dids"]}]}}},
+            *current_pass_pipeline({})[1:],
+            {"$group": {"_id": pass_status_expr(settings), "count": {"$sum": 1}}},
+        ], "as": "_pass_buckets"}},
+        {"$lookup": {"from": "users", "let": {"uids": {"$ifNull": ["$assigned_instructor_ids", []]}}, "pipeline": [
+            {"$match": {"$expr": {"$in": ["$id", "$$uids"]}}},
+            {"$project": {"_id": 0, "password_hash": 0}},
+        ], "as": "instructors"}},
+        {"$addFields": {
+            "dancer_count": {"$size": "$_enrolled"},
+            "expiring_soon_count": bucket_count("expiring_soon"),
+            "expired_count": bucket_count("expired"),
+        }},
+        {"$project": {"_id": 0, "_enrolled": 0, "_pass_buckets": 0}},
+    ]
+    return await db.batches.aggregate(pipeline).to_list(1000)
 
 @api_router.get("/batches/{batch_id}")
 async def get_batch(batch_id: str, user=Depends(get_current_user)):
@@ -225,12 +949,49 @@ async def get_batch(batch_id: str, user=Depends(get_current_user)):
         raise HTTPException(404, "Batch not found")
     return batch
 
+def etag_response(request, payload):
+    """JSON response with a content hash ETag; 304 with no body when the client already has this version."""
+    body = json.dumps(payload, default=json_default, separators=(",", ":"), sort_keys=True).encode()
+    etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag in [t.strip().removeprefix("W/") for t in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
+@api_router.get("/batches/{batch_id}/roster")
+async def get_batch_roster(batch_id: str, request: Request, user=Depends(get_current_user)):
+    """The attendance screen in one response: the batch, today's session, its enrolled dancers with their
+    enrollment and current pass, and the attendance recorded so far.
+    """
+    batch = await db.batches.find_one({"id": batch_id}, {"_id": 0})
+    if not batch:
+        raise HTTPException(404, "Batch not found")
+    session, enrollments, current, settings = await asyncio.gather(
+        open_today_session(batch_id, user),
+        db.enrollments.find({"batch_id": batch_id, "active": True}, {"_id": 0}).to_list(None),
+        load_current_passes({"batch_id": batch_id}),
+        get_settings())
+    stats_fields = [*new_attendance_stats(), "last_attended_date"]
+    dancers, attendance = await asyncio.gather(
+        db.dancers.find({"id": {"$in": [e["dancer_id"] for e in enrollments]}, "active": True},
+                        {**DANCER_PROJECTION, **{f: 0 for f in stats_fields}}).sort([("full_name", 1), ("id", 1)]).to_list(None),
+        db.attendance.find({"session_id": session["id"]}, {"_id": 0}).to_list(None))
+    by_dancer = {e["dancer_id"]: e for e in enrollments}
+    for d in dancers:
+        d["enrollment"] = by_dancer.get(d["id"])
+        active_pass = current.get((d["id"], batch_id))
+        if active_pass:
+            active_pass["computed_status"] = compute_pass_status(active_pass, settings)
+        d["active_pass"] = active_pass
+    return etag_response(request, {"batch": batch, "session": session, "dancers": dancers, "attendance": attendance})
+
 @api_router.post("/batches")
 async def create_batch(data: BatchCreateReq, user=Depends(get_current_user)):
     require_admin(user)
     doc = {"id": str(uuid.uuid4()), **data.model_dump(), "active": True, "created_at": datetime.now(timezone.utc).isoformat()}
     await db.batches.insert_one({**doc})
     await audit_log(user["id"], "create_batch", "batch", doc["id"], {"batch_name": data.batch_name})
+    await schedule_sessions([doc])
     return doc
 
 @api_router.put("/batches/{batch_id}")
@@ -242,74 +1003,207 @@ async def update_batch(batch_id: str, data: dict, user=Depends(get_current_user)
         raise HTTPException(400, "Nothing to update")
     old = await db.batches.find_one({"id": batch_id}, {"_id": 0})
     await db.batches.update_one({"id": batch_id}, {"$set": updates})
-    await audit_log(user["id"], "update_batch", "batch", batch_id, {"before": old, "after": updates})
-    return await db.batches.find_one({"id": batch_id}, {"_id": 0})
+    request_notifications_rebuild()
+    await audit_log(user["id"], "update_batch", "batch", batch_id, audit_diff(old, updates))
+    batch = await db.batches.find_one({"id": batch_id}, {"_id": 0})
+    if batch and updates.keys() & {"schedule_days", "time_slot", "active"}:
+        await schedule_sessions([batch])
+    return batch
 
 @api_router.delete("/batches/{batch_id}")
 async def deactivate_batch(batch_id: str, user=Depends(get_current_user)):
     require_admin(user)
-    await db.batches.update_one({"id": batch_id}, {"$set": {"active": False}})
-    await audit_log(user["id"], "deactivate_batch", "batch", batch_id)
+    old = await db.batches.find_one_and_update({"id": batch_id}, {"$set": {"active": False}}, {"_id": 0, "active": 1})
+    request_notifications_rebuild()
+    await audit_log(user["id"], "deactivate_batch", "batch", batch_id, audit_diff(old, {"active": False}))
+    await schedule_sessions([{"id": batch_id, "active": False}])
     return {"status": "deactivated"}
 
+# ==================== DANCER SEARCH ====================
+# Dancers carry an indexed search_keys array: "n:" + every prefix of each normalized name token, "w:" +
+# each whole token, and "p:" + every run of at least three digits of the phone number. A query becomes an
+# $all over the same keys, so each keystroke is a multikey index lookup; candidates are ranked here and capped.
+SEARCH_PREFIX_MAX = 15
+SEARCH_PHONE_MIN_DIGITS = 3
+DANCER_SEARCH_CANDIDATES = int(os.environ.get("DANCER_SEARCH_CANDIDATES", "200"))
+DANCER_SEARCH_LIMIT = int(os.environ.get("DANCER_SEARCH_LIMIT", "50"))
+DANCER_PROJECTION = {"_id": 0, "search_keys": 0}
+
+def search_tokens(text):
+    """Lowercased words with accents stripped."""
+    text = unicodedata.normalize("NFKD", text or "")
+    return re.findall(r"\w+", "".join(c for c in text if not unicodedata.combining(c)).casefold())
+
+def dancer_search_keys(full_name, phone_number):
+    tokens = search_tokens(full_name)
+    keys = {f"n:{t[:n]}" for t in tokens for n in range(1, min(len(t), SEARCH_PREFIX_MAX) + 1)}
+    keys.update(f"w:{t}" for t in tokens)
+    digits = re.sub(r"\D", "", phone_number or "")
+    keys.update(f"p:{digits[i:j]}" for i in range(len(digits))
+                for j in range(i + SEARCH_PHONE_MIN_DIGITS, len(digits) + 1))
+    return sorted(keys)
+
+def dancer_search_query(search, whole_words=False):
+    """The search_keys filter for a query, or None when it is too short to match anything.
+
+    With `whole_words` each name token must match a whole word rather than the start of one.
+    """
+    if not re.search(r"[^\d\s+()\-.]", search):
+        digits = re.sub(r"\D", "", search)
+        return {"search_keys": f"p:{digits}"} if len(digits) >= SEARCH_PHONE_MIN_DIGITS else None
+    name_key = (lambda t: f"w:{t}") if whole_words else (lambda t: f"n:{t[:SEARCH_PREFIX_MAX]}")
+    keys = [f"p:{t}" if t.isdigit() else name_key(t) for t in search_tokens(search)
+            if not t.isdigit() or len(t) >= SEARCH_PHONE_MIN_DIGITS]
+    return {"search_keys": {"$all": keys}} if keys else None
+
+def rank_dancers(dancers, search):
+    """Exact names first, then names whose words start in query order, then the rest; shorter names first."""
+    query = search_tokens(search)
+    def rank(d):
+        name = search_tokens(d.get("full_name"))
+        if name == query:
+            tier = 0
+        elif len(name) >= len(query) and all(n.startswith(q) for n, q in zip(name, query)):
+            tier = 1
+        else:
+            tier = 2
+        return tier, len(d.get("full_name") or ""), d.get("full_name") or ""
+    return sorted(dancers, key=rank)
+
+async def search_dancers(dq, search, projection=DANCER_PROJECTION, limit=DANCER_SEARCH_LIMIT):
+    """Dancers matching `dq` and the search text, ranked and capped at `limit`, and whether any were cut.
+
+    Whole-word matches are fetched first, so the candidate cap never cuts an exact name in favour of an
+    arbitrary prefix match; the remaining candidate slots are filled from the prefix match.
+    """
+    sq = dancer_search_query(search)
+    if sq is None:
+        return [], False
+    dancers = await db.dancers.find(
+        {"$and": [dq, dancer_search_query(search, whole_words=True)]}, projection
+    ).limit(DANCER_SEARCH_CANDIDATES).to_list(None)
+    if len(dancers) < DANCER_SEARCH_CANDIDATES:
+        seen = [d["id"] for d in dancers]
+        dancers += await db.dancers.find(
+            {"$and": [dq, sq, {"id": {"$nin": seen}}]}, projection
+        ).limit(DANCER_SEARCH_CANDIDATES - len(dancers)).to_list(None)
+    truncated = len(dancers) > limit or len(dancers) >= DANCER_SEARCH_CANDIDATES
+    return rank_dancers(dancers, search)[:limit], truncated
+
+async def backfill_dancer_search(missing_only=False):
+    query = {"search_keys": {"$exists": False}} if missing_only else {}
+    ops = []
+    async for d in db.dancers.find(query, {"_id": 0, "id": 1, "full_name": 1, "phone_number": 1}):
+        ops.append(UpdateOne({"id": d["id"]}, {"$set": {
+            "search_keys": dancer_search_keys(d.get("full_name"), d.get("phone_number"))}}))
+        if len(ops) >= 1000:
+            await db.dancers.bulk_write(ops, ordered=False)
+            ops = []
+    if ops:
+        await db.dancers.bulk_write(ops, ordered=False)
+
 # ==================== DANCER ROUTES ====================
+DANCER_FIELDS = {"id", "full_name", "phone_number", "notes", "active", "created_at"}
+DANCER_INCLUDES = {"enrollment", "active_pass", "enrollments", "passes", "stats"}
+
+def parse_list_param(value, allowed, name):
+    items = {v.strip() for v in value.split(",") if v.strip()}
+    unknown = items - allowed
+    if unknown:
+        raise HTTPException(400, f"Unknown {name}: {', '.join(sorted(unknown))}")
+    return items
+
 @api_router.get("/dancers")
-async def list_dancers(batch_id: str = Query(None), search: str = Query(None), user=Depends(get_current_user)):
-    settings = await get_settings()
+async def list_dancers(response: Response, batch_id: str = Query(None), search: str = Query(None),
+                       include: str = None, fields: str = None, cursor: str = None,
+                       limit: int = Query(None, ge=1, le=500), user=Depends(get_current_user)):
+    """Dancers ordered by name, with the related data named in `include` and the fields named in `fields`.
+
+    Without `limit` every match is returned; with it, the next page's cursor is in X-Next-Cursor. Search
+    results are ranked rather than paged: they stop at `limit` (default DANCER_SEARCH_LIMIT) and
+    X-Results-Truncated is set when more dancers matched. `include` defaults to enrollment,active_pass for a
+    batch roster and enrollments,passes,stats otherwise.
+    """
+    if include is None:
+        includes = {"enrollment", "active_pass"} if batch_id else {"enrollments", "passes", "stats"}
+    else:
+        includes = parse_list_param(include, DANCER_INCLUDES, "include")
+    if not batch_id and includes & {"enrollment", "active_pass"}:
+        raise HTTPException(400, "enrollment and active_pass need batch_id")
+    stats_fields = [*new_attendance_stats(), "last_attended_date"]
+    if fields:
+        projection = {f: 1 for f in parse_list_param(fields, DANCER_FIELDS, "field") | {"id", "full_name"}}
+        if "stats" in includes:
+            projection.update({f: 1 for f in stats_fields})
+    else:
+        projection = {"search_keys": 0, **({} if "stats" in includes else {f: 0 for f in stats_fields})}
+    projection["_id"] = 0
+
+    enrollments = {}
     if batch_id:
-        enrollments = await db.enrollments.find({"batch_id": batch_id, "active": True}, {"_id": 0}).to_list(5000)
-        dancer_ids = [e["dancer_id"] for e in enrollments]
-        dq = {"id": {"$in": dancer_ids}, "active": True}
-        if search:
-            dq["$or"] = [
-                {"full_name": {"$regex": search, "$options": "i"}},
-                {"phone_number": {"$regex": search, "$options": "i"}}
-            ]
-        dancers = await db.dancers.find(dq, {"_id": 0}).to_list(5000)
-        for d in dancers:
-            d["enrollment"] = next((e for e in enrollments if e["dancer_id"] == d["id"]), None)
-            passes = await db.passes.find(
-                {"dancer_id": d["id"], "batch_id": batch_id}, {"_id": 0}
-            ).sort("created_at", -1).to_list(100)
-            active_pass = None
-            for p in passes:
-                p["computed_status"] = compute_pass_status(p, settings)
-                if p["computed_status"] in ("active", "expiring_soon"):
-                    active_pass = p
-                    break
-            if not active_pass and passes:
-                passes[0]["computed_status"] = compute_pass_status(passes[0], settings)
-                active_pass = passes[0]
-            d["active_pass"] = active_pass
+        enrollments = {e["dancer_id"]: e for e in await db.enrollments.find(
+            {"batch_id": batch_id, "active": True}, {"_id": 0}).to_list(None)}
+        dq = {"id": {"$in": list(enrollments)}, "active": True}
+    elif user["role"] != "admin":
+        batches = await db.batches.find({"assigned_instructor_ids": user["id"]}, {"_id": 0, "id": 1}).to_list(None)
+        dancer_ids = await db.enrollments.distinct(
+            "dancer_id", {"batch_id": {"$in": [b["id"] for b in batches]}, "active": True})
+        dq = {"id": {"$in": dancer_ids}}
     else:
-        if user["role"] != "admin":
-            batches = await db.batches.find({"assigned_instructor_ids": user["id"]}, {"_id": 0}).to_list(100)
-            batch_ids = [b["id"] for b in batches]
-            enrollments = await db.enrollments.find({"batch_id": {"$in": batch_ids}, "active": True}, {"_id": 0}).to_list(5000)
-            dancer_ids = list(set(e["dancer_id"] for e in enrollments))
-            dq = {"id": {"$in": dancer_ids}}
-        else:
-            dq = {}
-        if search:
-            dq["$or"] = [
-                {"full_name": {"$regex": search, "$options": "i"}},
-                {"phone_number": {"$regex": search, "$options": "i"}}
-            ]
-        dancers = await db.dancers.find(dq, {"_id": 0}).to_list(5000)
-        for d in dancers:
-            d["enrollments"] = await db.enrollments.find({"dancer_id": d["id"], "active": True}, {"_id": 0}).to_list(100)
-            all_passes = await db.passes.find({"dancer_id": d["id"]}, {"_id": 0}).to_list(100)
-            for p in all_passes:
-                p["computed_status"] = compute_pass_status(p, settings)
-            d["passes"] = all_passes
-            att = await db.attendance.find({"dancer_id": d["id"]}, {"_id": 0}).to_list(5000)
-            d["total_sessions"] = len(att)
-            d["present_count"] = sum(1 for a in att if a["status"] == "present")
+        dq = {}
+    if search:
+        if cursor:
+            raise HTTPException(400, "cursor cannot be combined with search")
+        dancers, truncated = await search_dancers(dq, search, projection, limit or DANCER_SEARCH_LIMIT)
+        if truncated:
+            response.headers["X-Results-Truncated"] = "true"
+    else:
+        page_query = dq
+        if cursor:
+            name, last_id = decode_cursor(cursor)
+            page_query = keyset_query(dq, "full_name", name, last_id, "$gt")
+        query = db.dancers.find(page_query, projection).sort([("full_name", 1), ("id", 1)])
+        if limit:
+            query = query.limit(limit + 1)
+        dancers = await query.to_list(None)
+        if limit and len(dancers) > limit:
+            dancers = dancers[:limit]
+            response.headers["X-Next-Cursor"] = encode_cursor([dancers[-1]["full_name"], dancers[-1]["id"]])
+
+    ids = [d["id"] for d in dancers]
+    settings = await get_settings()
+    if "active_pass" in includes:
+        current = await load_current_passes({"batch_id": batch_id, "dancer_id": {"$in": ids}})
+    if "enrollments" in includes:
+        by_dancer = {}
+        for e in await db.enrollments.find({"dancer_id": {"$in": ids}, "active": True}, {"_id": 0}).to_list(None):
+            by_dancer.setdefault(e["dancer_id"], []).append(e)
+    if "passes" in includes:
+        passes_by_dancer = {}
+        for p in await db.passes.find({"dancer_id": {"$in": ids}}, {"_id": 0}).sort("created_at", -1).to_list(None):
+            p["computed_status"] = compute_pass_status(p, settings)
+            passes_by_dancer.setdefault(p["dancer_id"], []).append(p)
+    for d in dancers:
+        if "enrollment" in includes:
+            d["enrollment"] = enrollments.get(d["id"])
+        if "active_pass" in includes:
+            active_pass = current.get((d["id"], batch_id))
+            if active_pass:
+                active_pass["computed_status"] = compute_pass_status(active_pass, settings)
+            d["active_pass"] = active_pass
+        if "enrollments" in includes:
+            d["enrollments"] = by_dancer.get(d["id"], [])
+        if "passes" in includes:
+            d["passes"] = passes_by_dancer.get(d["id"], [])
+        if "stats" in includes:
+            for field, value in new_attendance_stats().items():
+                d.setdefault(field, value)
+            d.setdefault("last_attended_date", None)
     return dancers
 
 @api_router.get("/dancers/{dancer_id}")
 async def get_dancer(dancer_id: str, user=Depends(get_current_user)):
-    dancer = await db.dancers.find_one({"id": dancer_id}, {"_id": 0})
+    dancer = await db.dancers.find_one({"id": dancer_id}, DANCER_PROJECTION)
     if not dancer:
         raise HTTPException(404, "Dancer not found")
     settings = await get_settings()
@@ -318,9 +1212,9 @@ async def get_dancer(dancer_id: str, user=Depends(get_current_user)):
     for p in passes:
         p["computed_status"] = compute_pass_status(p, settings)
     dancer["passes"] = passes
-    att = await db.attendance.find({"dancer_id": dancer_id}, {"_id": 0}).to_list(5000)
-    dancer["total_sessions"] = len(att)
-    dancer["present_count"] = sum(1 for a in att if a["status"] == "present")
+    for field, value in new_attendance_stats().items():
+        dancer.setdefault(field, value)
+    dancer.setdefault("last_attended_date", None)
     return dancer
 
 @api_router.post("/dancers")
@@ -332,18 +1226,19 @@ async def create_dancer(data: DancerCreateReq, user=Depends(get_current_user)):
     dancer = {
         "id": str(uuid.uuid4()), "full_name": data.full_name,
         "phone_number": data.phone_number, "notes": data.notes,
-        "active": True, "created_at": datetime.now(timezone.utc).isoformat()
+        "active": True, "created_at": datetime.now(timezone.utc).isoformat(), **new_attendance_stats()
     }
-    await db.dancers.insert_one({**dancer})
+    await db.dancers.insert_one({**dancer, "search_keys": dancer_search_keys(data.full_name, data.phone_number)})
     await audit_log(user["id"], "create_dancer", "dancer", dancer["id"], {"name": data.full_name})
     if data.batch_id:
         enrollment = {
             "id": str(uuid.uuid4()), "dancer_id": dancer["id"],
             "batch_id": data.batch_id, "active": True,
             "join_date": datetime.now(timezone.utc).isoformat(),
-            "created_at": datetime.now(timezone.utc).isoformat()
+            "created_at": datetime.now(timezone.utc).isoformat(), **new_attendance_stats()
         }
         await db.enrollments.insert_one({**enrollment})
+        request_notifications_rebuild()
         await audit_log(user["id"], "create_enrollment", "enrollment", enrollment["id"],
                         {"dancer_id": dancer["id"], "batch_id": data.batch_id})
     return dancer
@@ -354,16 +1249,23 @@ async def update_dancer(dancer_id: str, data: dict, user=Depends(get_current_use
     updates = {k: v for k, v in data.items() if k in allowed}
     if not updates:
         raise HTTPException(400, "Nothing to update")
-    old = await db.dancers.find_one({"id": dancer_id}, {"_id": 0})
-    await db.dancers.update_one({"id": dancer_id}, {"$set": updates})
-    await audit_log(user["id"], "update_dancer", "dancer", dancer_id, {"before": old, "after": updates})
-    return await db.dancers.find_one({"id": dancer_id}, {"_id": 0})
+    old = await db.dancers.find_one({"id": dancer_id}, DANCER_PROJECTION)
+    dancer = await db.dancers.find_one_and_update(
+        {"id": dancer_id}, {"$set": updates}, DANCER_PROJECTION, return_document=ReturnDocument.AFTER)
+    if dancer and ("full_name" in updates or "phone_number" in updates):
+        # Keyed on the values the keys are built from, so a racing rename leaves its own keys in place
+        await db.dancers.update_one(
+            {"id": dancer_id, "full_name": dancer.get("full_name"), "phone_number": dancer.get("phone_number")},
+            {"$set": {"search_keys": dancer_search_keys(dancer.get("full_name"), dancer.get("phone_number"))}})
+    request_notifications_rebuild()
+    await audit_log(user["id"], "update_dancer", "dancer", dancer_id, audit_diff(old, updates))
+    return dancer
 
 @api_router.delete("/dancers/{dancer_id}")
 async def deactivate_dancer(dancer_id: str, user=Depends(get_current_user)):
     require_admin(user)
-    await db.dancers.update_one({"id": dancer_id}, {"$set": {"active": False}})
-    await audit_log(user["id"], "deactivate_dancer", "dancer", dancer_id)
+    old = await db.dancers.find_one_and_update({"id": dancer_id}, {"$set": {"active": False}}, {"_id": 0, "active": 1})
+    await audit_log(user["id"], "deactivate_dancer", "dancer", dancer_id, audit_diff(old, {"active": False}))
     return {"status": "deactivated"}
 
 # ==================== ENROLLMENT ROUTES ====================
@@ -378,9 +1280,10 @@ async def create_enrollment(data: dict, user=Depends(get_current_user)):
     enrollment = {
         "id": str(uuid.uuid4()), "dancer_id": dancer_id, "batch_id": batch_id,
         "active": True, "join_date": datetime.now(timezone.utc).isoformat(),
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": datetime.now(timezone.utc).isoformat(), **new_attendance_stats()
     }
     await db.enrollments.insert_one({**enrollment})
+    request_notifications_rebuild()
     await audit_log(user["id"], "create_enrollment", "enrollment", enrollment["id"],
                     {"dancer_id": dancer_id, "batch_id": batch_id})
     return enrollment
@@ -391,6 +1294,7 @@ async def deactivate_enrollment(enrollment_id: str, user=Depends(get_current_use
     if not enrollment:
         raise HTTPException(404, "Enrollment not found")
     await db.enrollments.update_one({"id": enrollment_id}, {"$set": {"active": False}})
+    request_notifications_rebuild()
     await audit_log(user["id"], "remove_dancer_from_batch", "enrollment", enrollment_id,
                     {"dancer_id": enrollment["dancer_id"], "batch_id": enrollment["batch_id"]})
     return {"status": "deactivated"}
@@ -417,22 +1321,24 @@ async def create_pass(data: PassCreateReq, user=Depends(get_current_user)):
         "type": data.type, "created_at": now.isoformat(), "created_by": user["id"]
     }
     if data.type == "monthly":
-        doc["start_date"] = data.start_date or now.isoformat()
-        doc["end_date"] = data.end_date or (now + timedelta(days=30)).isoformat()
+        doc["start_date"] = request_pass_date(data.start_date, now)
+        doc["end_date"] = request_pass_date(data.end_date, now + timedelta(days=30))
         doc["status"] = "active"
     elif data.type == "class_pack":
         doc["total_classes"] = data.total_classes or 8
         doc["remaining_classes"] = doc["total_classes"]
-        doc["start_date"] = data.start_date or now.isoformat()
-        doc["end_date"] = data.end_date or ""
+        doc["start_date"] = request_pass_date(data.start_date, now)
+        doc["end_date"] = request_pass_date(data.end_date)
         doc["status"] = "active"
     elif data.type == "drop_in":
         doc["total_classes"] = 1
         doc["remaining_classes"] = 1
         doc["session_id"] = data.session_id or ""
-        doc["valid_date"] = now.strftime("%Y-%m-%d")
+        doc["valid_date"] = now.replace(hour=0, minute=0, second=0, microsecond=0)
         doc["status"] = "unused"
     await db.passes.insert_one({**doc})
+    await refresh_current_passes(data.batch_id, [data.dancer_id])
+    request_notifications_rebuild()
     await audit_log(user["id"], "create_pass", "pass", doc["id"],
                     {"dancer_id": data.dancer_id, "type": data.type})
     return doc
@@ -445,57 +1351,453 @@ async def renew_pass(pass_id: str, data: dict, user=Depends(get_current_user)):
     now = datetime.now(timezone.utc)
     updates = {}
     if old["type"] == "monthly":
-        updates["start_date"] = data.get("start_date", now.isoformat())
-        updates["end_date"] = data.get("end_date", (now + timedelta(days=30)).isoformat())
+        updates["start_date"] = request_pass_date(data.get("start_date"), now)
+        updates["end_date"] = request_pass_date(data.get("end_date"), now + timedelta(days=30))
         updates["status"] = "active"
     elif old["type"] == "class_pack":
         total = data.get("total_classes", old.get("total_classes", 8))
         updates["total_classes"] = total
         updates["remaining_classes"] = total
-        updates["start_date"] = data.get("start_date", now.isoformat())
+        updates["start_date"] = request_pass_date(data.get("start_date"), now)
         updates["status"] = "active"
     await db.passes.update_one({"id": pass_id}, {"$set": updates})
-    await audit_log(user["id"], "renew_pass", "pass", pass_id, {"before": old, "after": updates})
+    await refresh_current_passes(old["batch_id"], [old["dancer_id"]])
+    request_notifications_rebuild()
+    await audit_log(user["id"], "renew_pass", "pass", pass_id, audit_diff(old, updates))
     return await db.passes.find_one({"id": pass_id}, {"_id": 0})
 
+# ==================== ATTENDANCE ROLLUPS ====================
+# daily_attendance_rollups holds one document per (batch_id, date) counting sessions and present, absent
+# and total attendance records, so attendance reports are one range scan. Each session document carries
+# the same counters for its own records, and dancers and their active enrollments carry them too, plus
+# the last date attended. Session creation and attendance transitions keep all of them current with $inc;
+# backfill_attendance_rollups, reconcile_session_counters and backfill_dancer_attendance_stats rebuild
+# them from the raw data.
+ROLLUP_STATUSES = ("present", "absent")
+SESSION_COUNTER_FIELDS = {"total": "total", "present": "present_count", "absent": "absent_count"}
+DANCER_COUNTER_FIELDS = {"total": "total_sessions", "present": "present_count", "absent": "absent_count"}
+SESSION_RECONCILE_DAYS = int(os.environ.get("SESSION_RECONCILE_DAYS", "14"))
+SESSION_RECONCILE_INTERVAL_SECONDS = int(os.environ.get("SESSION_RECONCILE_INTERVAL_SECONDS", "3600"))
+
+def attendance_deltas(transitions):
+    """Counter increments for (previous status, new status) transitions; None means a new record."""
+    inc = {}
+    for old, new in transitions:
+        if old == new:
+            continue
+        if old is None:
+            inc["total"] = inc.get("total", 0) + 1
+        for status, step in ((old, -1), (new, 1)):
+            if status in ROLLUP_STATUSES:
+                inc[status] = inc.get(status, 0) + step
+    return {k: v for k, v in inc.items() if v}
+
+def new_attendance_stats():
+    # last_attended_date stays unset until the first present mark so $max can raise it
+    return {f: 0 for f in DANCER_COUNTER_FIELDS.values()}
+
+async def record_session_rollup(session):
+    await db.daily_attendance_rollups.update_one(
+        {"batch_id": session["batch_id"], "date": session["date"]}, {"$inc": {"sessions": 1}}, upsert=True)
+
+async def apply_attendance_deltas(session, transitions):
+    """Apply the net effect of (dancer_id, previous status, new status) transitions to every counter.
+
+    The session and its day's rollup get one $inc each, the rollup also counting a generated session on
+    its first record; each dancer and their active enrollment in the session's batch get their own, with
+    last_attended_date raised by $max on a new present mark and recomputed for dancers whose present mark
+    was taken back.
+    """
+    inc = attendance_deltas([(old, new) for _, old, new in transitions])
+    if inc:
+        before = await db.sessions.find_one_and_update(
+            {"id": session["id"]}, {"$inc": {SESSION_COUNTER_FIELDS[k]: v for k, v in inc.items()}},
+            projection={"_id": 0, "created_by": 1, "total": 1})
+        rollup_inc = dict(inc)
+        if before and before.get("created_by") == SCHEDULER and not before.get("total") and inc.get("total", 0) > 0:
+            rollup_inc["sessions"] = 1
+        await db.daily_attendance_rollups.update_one(
+            {"batch_id": session["batch_id"], "date": session["date"]}, {"$inc": rollup_inc}, upsert=True)
+    by_dancer = {}
+    for dancer_id, old, new in transitions:
+        by_dancer.setdefault(dancer_id, []).append((old, new))
+    dancer_ops, enrollment_ops = [], []
+    for dancer_id, pairs in by_dancer.items():
+        update = {}
+        inc = attendance_deltas(pairs)
+        if inc:
+            update["$inc"] = {DANCER_COUNTER_FIELDS[k]: v for k, v in inc.items()}
+        if any(new == "present" and old != "present" for old, new in pairs):
+            update["$max"] = {"last_attended_date": session["date"]}
+        if update:
+            dancer_ops.append(UpdateOne({"id": dancer_id}, update))
+            enrollment_ops.append(UpdateOne(
+                {"dancer_id": dancer_id, "batch_id": session["batch_id"], "active": True}, update))
+    if dancer_ops:
+        await db.dancers.bulk_write(dancer_ops, ordered=False)
+        await db.enrollments.bulk_write(enrollment_ops, ordered=False)
+    unmarked = [did for did, pairs in by_dancer.items() if any(old == "present" and new != "present" for old, new in pairs)]
+    if unmarked:
+        await refresh_last_attended(unmarked)
+
+async def refresh_last_attended(dancer_ids):
+    rows = await db.attendance.aggregate([
+        {"$match": {"dancer_id": {"$in": dancer_ids}, "status": "present"}},
+        {"$lookup": {"from": "sessions", "localField": "session_id", "foreignField": "id", "as": "session"}},
+        {"$unwind": "$session"},
+        {"$group": {"_id": {"dancer_id": "$dancer_id", "batch_id": "$session.batch_id"}, "date": {"$max": "$session.date"}}},
+    ]).to_list(None)
+    unset = {"$unset": {"last_attended_date": ""}}
+    enrollment_ops = [UpdateMany({"dancer_id": {"$in": dancer_ids}, "active": True}, unset)]
+    latest = {}
+    for r in rows:
+        enrollment_ops.append(UpdateOne({**r["_id"], "active": True}, {"$set": {"last_attended_date": r["date"]}}))
+        did = r["_id"]["dancer_id"]
+        latest[did] = max(latest.get(did, ""), r["date"])
+    await db.enrollments.bulk_write(enrollment_ops, ordered=True)
+    await db.dancers.bulk_write([
+        UpdateOne({"id": did}, {"$set": {"last_attended_date": latest[did]}} if did in latest else unset)
+        for did in dancer_ids], ordered=False)
+
+def count_status_expr(status):
+    return {"$size": {"$filter": {"input": "$att", "as": "a", "cond": {"$eq": ["$$a.status", status]}}}}
+
+async def backfill_attendance_rollups():
+    """Recompute every rollup from sessions and attendance.
+
+    Marks made while this runs can be overwritten by the rebuilt totals, so run it when attendance is quiet.
+    """
+    stamp = datetime.now(timezone.utc)
+    pipeline = [
+        {"$lookup": {"from": "attendance", "localField": "id", "foreignField": "session_id", "as": "att"}},
+        # Generated sessions count once attendance has been marked in them
+        {"$match": {"$or": [{"created_by": {"$ne": SCHEDULER}}, {"att.0": {"$exists": True}}]}},
+        {"$group": {"_id": {"batch_id": "$batch_id", "date": "$date"}, "sessions": {"$sum": 1},
+                    "total": {"$sum": {"$size": "$att"}},
+                    **{st: {"$sum": count_status_expr(st)} for st in ROLLUP_STATUSES}}},
+    ]
+    ops = []
+    async for r in db.sessions.aggregate(pipeline, allowDiskUse=True):
+        key = r.pop("_id")
+        ops.append(ReplaceOne(key, {**key, **r, "rebuilt_at": stamp}, upsert=True))
+        if len(ops) >= 1000:
+            await db.daily_attendance_rollups.bulk_write(ops, ordered=False)
+            ops = []
+    if ops:
+        await db.daily_attendance_rollups.bulk_write(ops, ordered=False)
+    await db.daily_attendance_rollups.delete_many({"$or": [
+        {"rebuilt_at": {"$lt": stamp}}, {"rebuilt_at": {"$exists": False}}]})
+
+async def reconcile_session_counters(days=None):
+    """Recount attendance for sessions dated within the last `days` (all when None) and repair drifted counters.
+
+    Repairs are compare-and-set against the counters read, so a session marked meanwhile is left for the next run.
+    """
+    match = {}
+    if days is not None:
+        match["date"] = {"$gte": (datetime.now(timezone.utc) - timedelta(days=days)).strftime("%Y-%m-%d")}
+    pipeline = [
+        {"$match": match},
+        {"$lookup": {"from": "attendance", "localField": "id", "foreignField": "session_id", "as": "att"}},
+        {"$project": {"_id": 0, "id": 1, **{f: 1 for f in SESSION_COUNTER_FIELDS.values()},
+                      "counted": {"total": {"$size": "$att"},
+                                  **{SESSION_COUNTER_FIELDS[st]: count_status_expr(st) for st in ROLLUP_STATUSES}}}},
+    ]
+    repaired = 0
+    async for s in db.sessions.aggregate(pipeline, allowDiskUse=True):
+        stored = {f: s.get(f) for f in SESSION_COUNTER_FIELDS.values()}
+        if stored != s["counted"]:
+            result = await db.sessions.update_one({"id": s["id"], **stored}, {"$set": s["counted"]})
+            repaired += result.modified_count
+    if repaired:
+        logger.info("Repaired attendance counters on %d sessions", repaired)
+    return repaired
+
+async def backfill_dancer_attendance_stats():
+    """Recompute dancer and active-enrollment counters from attendance.
+
+    A dancer's history in a batch is credited to their current enrollment there. Marks made while this runs
+    can be overwritten, so run it when attendance is quiet.
+    """
+    pipeline = [
+        {"$lookup": {"from": "sessions", "localField": "session_id", "foreignField": "id", "as": "session"}},
+        {"$unwind": "$session"},
+        {"$group": {
+            "_id": {"dancer_id": "$dancer_id", "batch_id": "$session.batch_id"}, "total": {"$sum": 1},
+            **{st: {"$sum": {"$cond": [{"$eq": ["$status", st]}, 1, 0]}} for st in ROLLUP_STATUSES},
+            "last_attended_date": {"$max": {"$cond": [{"$eq": ["$status", "present"]}, "$session.date", None]}},
+        }},
+    ]
+    reset = UpdateMany({}, {"$set": new_attendance_stats(), "$unset": {"last_attended_date": ""}})
+    enrollment_ops, dancers = [reset], {}
+    async for r in db.attendance.aggregate(pipeline, allowDiskUse=True):
+        stats = {DANCER_COUNTER_FIELDS[k]: r[k] for k in DANCER_COUNTER_FIELDS}
+        if r["last_attended_date"]:
+            stats["last_attended_date"] = r["last_attended_date"]
+        enrollment_ops.append(UpdateOne({**r["_id"], "active": True}, {"$set": stats}))
+        total = dancers.setdefault(r["_id"]["dancer_id"], new_attendance_stats())
+        for f in DANCER_COUNTER_FIELDS.values():
+            total[f] += stats[f]
+        if stats.get("last_attended_date", "") > total.get("last_attended_date", ""):
+            total["last_attended_date"] = stats["last_attended_date"]
+    await db.enrollments.bulk_write(enrollment_ops, ordered=True)
+    await db.dancers.bulk_write([reset] + [UpdateOne({"id": did}, {"$set": stats}) for did, stats in dancers.items()],
+                                ordered=True)
+
+async def session_reconcile_job():
+    while True:
+        try:
+            if await acquire_lease("session_reconcile", SESSION_RECONCILE_INTERVAL_SECONDS * 2):
+                await reconcile_session_counters(SESSION_RECONCILE_DAYS)
+        except Exception:
+            logger.exception("Session counter reconcile failed")
+        await asyncio.sleep(SESSION_RECONCILE_INTERVAL_SECONDS)
+
+# ==================== SESSION SCHEDULE ====================
+# Sessions are generated ahead of time from each active batch's schedule_days ("Tue/Thu", "Mon-Fri",
+# "Daily", ...) for the next SESSION_HORIZON_DAYS days, so opening a batch on a class day is a plain read
+# and calendars can list upcoming classes. (batch_id, date) is unique, so racing creates of the same
+# session collapse into one. A generated session counts in the daily rollups only once attendance is first
+# marked in it. Generated sessions still unmarked are removed once their day has passed (a holiday or a
+# cancelled class), or when a batch's schedule changes or it is deactivated; sessions created by hand are kept.
+SESSION_HORIZON_DAYS = int(os.environ.get("SESSION_HORIZON_DAYS", "28"))
+SESSION_SCHEDULE_INTERVAL_SECONDS = int(os.environ.get("SESSION_SCHEDULE_INTERVAL_SECONDS", "21600"))
+SCHEDULER = "scheduler"
+WEEKDAY_NAMES = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+SCHEDULE_ALIASES = {"daily": range(7), "everyday": range(7), "weekdays": range(5), "weekends": (5, 6), "weekend": (5, 6)}
+# Runs of words joined by dashes or "to" ("Mon-Fri", "Tue to Thu"); a run of exactly two days is a range
+SCHEDULE_RUN_RE = re.compile(r"[a-z]+(?:\s*(?:-|–|\bto\b)\s*[a-z]+)*")
+SCHEDULE_RUN_SEPARATOR_RE = re.compile(r"\s*(?:-|–|\bto\b)\s*")
+# Short forms seen in timetables ("M/W/F", "Tu/Th"); "t" and "s" are ambiguous and left out
+WEEKDAY_ABBREVIATIONS = {"m": 0, "mo": 0, "tu": 1, "w": 2, "we": 2, "th": 3, "r": 3, "f": 4, "fr": 4, "sa": 5, "su": 6}
+TIME_RE = re.compile(r"(\d{1,2})(?:[:.](\d{2}))?\s*([ap]\.?m\.?)?", re.I)
+
+def weekday_number(word):
+    if word in WEEKDAY_ABBREVIATIONS:
+        return WEEKDAY_ABBREVIATIONS[word]
+    if len(word) >= 3:
+        for i, name in enumerate(WEEKDAY_NAMES):
+            if name.startswith(word):
+                return i
+    return None
+
+def parse_schedule_days(text):
+    """Weekday numbers (Monday = 0) named in free text such as "Tue/Thu", "Mon-Fri 7pm" or "M/W/F".
+
+    Two days joined by a hyphen, en dash or "to" are a range wherever they appear; a longer dashed chain
+    ("Mon-Wed-Fri") has no single start and end, so its days are taken as a list.
+    """
+    days = set()
+    for run in SCHEDULE_RUN_RE.finditer((text or "").lower()):
+        words = SCHEDULE_RUN_SEPARATOR_RE.split(run.group())
+        numbers = [weekday_number(w) for w in words]
+        if len(words) == 2 and None not in numbers:
+            i, j = numbers
+            days.update((i + k) % 7 for k in range((j - i) % 7 + 1))
+            continue
+        for word, number in zip(words, numbers):
+            if word in SCHEDULE_ALIASES:
+                days.update(SCHEDULE_ALIASES[word])
+            elif number is not None:
+                days.add(number)
+    return days
+
+def parse_time_slot(text):
+    """Start time as "HH:MM" (24h) from text such as "7:00-8:30 PM" or "6pm"; None when unreadable."""
+    times = TIME_RE.findall(text or "")
+    if not times:
+        return None
+    hour, minute, meridiem = int(times[0][0]), int(times[0][1] or 0), times[0][2]
+    if not meridiem and len(times) > 1 and times[1][2]:
+        # "7:00-8:30 PM": the start shares the end's meridiem unless that would put it after the end;
+        # before a 12 o'clock end ("11-12:30 PM") it is on the other side of noon
+        end_hour = int(times[1][0])
+        if hour <= end_hour and (end_hour != 12 or hour == 12):
+            meridiem = times[1][2]
+    meridiem = meridiem.lower().replace(".", "")
+    if meridiem == "pm" and hour < 12:
+        hour += 12
+    elif meridiem == "am" and hour == 12:
+        hour = 0
+    if hour > 23 or minute > 59:
+        return None
+    return f"{hour:02d}:{minute:02d}"
+
+def new_session(batch_id, date, created_by, start_time=None):
+    session = {"id": str(uuid.uuid4()), "batch_id": batch_id, "date": date, "created_by": created_by,
+               "created_at": datetime.now(timezone.utc).isoformat(), **{f: 0 for f in SESSION_COUNTER_FIELDS.values()}}
+    if start_time:
+        session["start_time"] = start_time
+    return session
+
+def unmarked_scheduled_sessions_query(batch_id, today, wanted):
+    """Generated sessions of a batch to remove: unmarked, and either past or no longer on the schedule.
+
+    Matching on the counter means a session marked meanwhile survives the delete.
+    """
+    return {"batch_id": batch_id, "created_by": SCHEDULER, "total": 0, "$or": [
+        {"date": {"$lt": today}}, {"date": {"$gt": today, "$nin": wanted}}]}
+
+async def schedule_sessions(batches=None):
+    """Bring generated sessions for `batches` (every batch when None) in line with their schedules.
+
+    Returns the number of sessions created.
+    """
+    if batches is None:
+        batches = await db.batches.find({}, {"_id": 0, "id": 1, "schedule_days": 1, "time_slot": 1, "active": 1}).to_list(None)
+    today = datetime.now(timezone.utc).date()
+    horizon = [today + timedelta(days=i) for i in range(SESSION_HORIZON_DAYS)]
+    created = 0
+    for batch in batches:
+        weekdays = parse_schedule_days(batch.get("schedule_days")) if batch.get("active", True) else set()
+        wanted = [d.isoformat() for d in horizon if d.weekday() in weekdays]
+        start_time = parse_time_slot(batch.get("time_slot"))
+        await db.sessions.delete_many(unmarked_scheduled_sessions_query(batch["id"], today.isoformat(), wanted))
+        if not wanted:
+            continue
+        await db.sessions.update_many(
+            {"batch_id": batch["id"], "created_by": SCHEDULER, "date": {"$gte": today.isoformat()},
+             "start_time": {"$ne": start_time}},
+            {"$set": {"start_time": start_time}} if start_time else {"$unset": {"start_time": ""}})
+        sessions = [new_session(batch["id"], date, SCHEDULER, start_time) for date in wanted]
+        ops = [UpdateOne({"batch_id": s["batch_id"], "date": s["date"]}, {"$setOnInsert": s}, upsert=True) for s in sessions]
+        try:
+            upserted = (await db.sessions.bulk_write(ops, ordered=False)).upserted_ids
+        except BulkWriteError as e:
+            # Another writer created some of these sessions first; they exist, which is all we need
+            if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+                raise
+            upserted = {u["index"]: u["_id"] for u in e.details.get("upserted", [])}
+        created += len(upserted)
+    if created:
+        logger.info("Scheduled %d sessions", created)
+    return created
+
+async def drop_unmarked_scheduled_sessions():
+    """Remove generated sessions whose day passed without attendance, and stop counting them in the rollups."""
+    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    await db.sessions.delete_many({"created_by": SCHEDULER, "total": 0, "date": {"$lt": today}})
+    await backfill_attendance_rollups()
+
+async def session_schedule_job():
+    while True:
+        try:
+            if await acquire_lease("session_schedule", SESSION_SCHEDULE_INTERVAL_SECONDS * 2):
+                await schedule_sessions()
+        except Exception:
+            logger.exception("Session scheduling failed")
+        await asyncio.sleep(SESSION_SCHEDULE_INTERVAL_SECONDS)
+
+async def dedupe_sessions():
+    """Merge sessions sharing (batch_id, date) into the earliest one so the pair can be indexed unique.
+
+    Attendance moves to the kept session unless the dancer already has a record there, in which case
+    the duplicate record is dropped and any class it took from a pass is given back. Counters,
+    rollups and dancer stats are rebuilt afterwards.
+    """
+    groups = await db.sessions.aggregate([
+        {"$sort": {"created_at": 1}},
+        {"$group": {"_id": {"batch_id": "$batch_id", "date": "$date"}, "ids": {"$push": "$id"}}},
+        {"$match": {"ids.1": {"$exists": True}}},
+    ], allowDiskUse=True).to_list(None)
+    for group in groups:
+        keep, extras = group["ids"][0], group["ids"][1:]
+        kept = set(await db.attendance.distinct("dancer_id", {"session_id": keep}))
+        async for a in db.attendance.find({"session_id": {"$in": extras}}, {"_id": 0}):
+            if a["dancer_id"] in kept:
+                await discard_attendance(a)
+            else:
+                await db.attendance.update_one({"id": a["id"]}, {"$set": {"session_id": keep}})
+                kept.add(a["dancer_id"])
+        await db.sessions.delete_many({"id": {"$in": extras}})
+    if groups:
+        logger.info("Merged duplicate sessions for %d batch days", len(groups))
+        await reconcile_session_counters()
+        await backfill_attendance_rollups()
+        await backfill_dancer_attendance_stats()
+        await rebuild_current_passes()
+
+async def discard_attendance(a):
+    """Delete a duplicate attendance record, giving back the class its present mark took."""
+    await db.attendance.delete_one({"id": a["id"]})
+    # Absent records keep the pass_id they were released from, so only present marks still hold a class
+    if a.get("status") == "present" and a.get("pass_id"):
+        p = await db.passes.find_one({"id": a["pass_id"]}, {"_id": 0})
+        if p:
+            await release_pass(p)
+
+async def dedupe_attendance():
+    """Collapse attendance records sharing (session_id, dancer_id) so the pair can be indexed unique.
+
+    The most recently marked record is kept and the others are discarded. Counters, rollups, dancer
+    stats and current passes are rebuilt afterwards.
+    """
+    groups = await db.attendance.aggregate([
+        {"$sort": {"timestamp": -1}},
+        {"$group": {"_id": {"session_id": "$session_id", "dancer_id": "$dancer_id"}, "ids": {"$push": "$id"}}},
+        {"$match": {"ids.1": {"$exists": True}}},
+    ], allowDiskUse=True).to_list(None)
+    for group in groups:
+        async for a in db.attendance.find({"id": {"$in": group["ids"][1:]}}, {"_id": 0}):
+            await discard_attendance(a)
+    if groups:
+        logger.info("Collapsed duplicate attendance for %d session dancers", len(groups))
+        await reconcile_session_counters()
+        await backfill_attendance_rollups()
+        await backfill_dancer_attendance_stats()
+        await rebuild_current_passes()
+
 # ==================== SESSION ROUTES ====================
-@api_router.get("/sessions/today")
-async def get_today_session(batch_id: str = Query(...), user=Depends(get_current_user)):
+async def open_today_session(batch_id, user):
     today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
     session = await db.sessions.find_one({"batch_id": batch_id, "date": today}, {"_id": 0})
-    if not session:
-        session = {
-            "id": str(uuid.uuid4()), "batch_id": batch_id, "date": today,
-            "created_by": user["id"], "created_at": datetime.now(timezone.utc).isoformat()
-        }
-        await db.sessions.insert_one({**session})
+    if session:
+        return session
+    # Off-schedule class: create it once, however many devices open the batch at the same moment
+    session = new_session(batch_id, today, user["id"])
+    try:
+        existing = await db.sessions.find_one_and_update(
+            {"batch_id": batch_id, "date": today}, {"$setOnInsert": session}, upsert=True, projection={"_id": 0})
+    except DuplicateKeyError:
+        return await db.sessions.find_one({"batch_id": batch_id, "date": today}, {"_id": 0})
+    if existing:
+        return existing
+    await record_session_rollup(session)
     return session
 
+@api_router.get("/sessions/today")
+async def get_today_session(batch_id: str = Query(...), user=Depends(get_current_user)):
+    return await open_today_session(batch_id, user)
+
 @api_router.get("/sessions")
-async def list_sessions(batch_id: str = Query(None), user=Depends(get_current_user)):
-    query = {}
-    if batch_id:
-        query["batch_id"] = batch_id
-    sessions = await db.sessions.find(query, {"_id": 0}).sort("date", -1).to_list(1000)
+async def list_sessions(response: Response, batch_id: str = Query(None), start_date: str = None, end_date: str = None,
+                        cursor: str = None, limit: int = Query(50, ge=1, le=200), user=Depends(get_current_user)):
+    """Newest sessions first with their attendance counters; the next page's cursor is in X-Next-Cursor.
+
+    Scheduled sessions exist ahead of time, so the range ends today unless end_date says otherwise.
+    """
+    query = session_query(batch_id, start_date, end_date or datetime.now(timezone.utc).strftime("%Y-%m-%d"))
+    if cursor:
+        date, last_id = decode_cursor(cursor)
+        query = keyset_query(query, "date", date, last_id, "$lt")
+    sessions = await db.sessions.find(query, {"_id": 0}).sort([("date", -1), ("id", -1)]).limit(limit + 1).to_list(limit + 1)
+    if len(sessions) > limit:
+        response.headers["X-Next-Cursor"] = encode_cursor([sessions[limit - 1]["date"], sessions[limit - 1]["id"]])
+    sessions = sessions[:limit]
     for s in sessions:
-        att = await db.attendance.find({"session_id": s["id"]}, {"_id": 0}).to_list(5000)
-        s["total"] = len(att)
-        s["present_count"] = sum(1 for a in att if a["status"] == "present")
-        s["absent_count"] = sum(1 for a in att if a["status"] == "absent")
+        for field in SESSION_COUNTER_FIELDS.values():
+            s.setdefault(field, 0)
     return sessions
 
 @api_router.post("/sessions")
 async def create_session(data: dict, user=Depends(get_current_user)):
-    batch_id = data.get("batch_id")
     date = data.get("date", datetime.now(timezone.utc).strftime("%Y-%m-%d"))
-    existing = await db.sessions.find_one({"batch_id": batch_id, "date": date})
-    if existing:
+    session = new_session(data.get("batch_id"), date, user["id"])
+    try:
+        await db.sessions.insert_one({**session})
+    except DuplicateKeyError:
         raise HTTPException(400, "Session already exists for this date")
-    session = {
-        "id": str(uuid.uuid4()), "batch_id": batch_id, "date": date,
-        "created_by": user["id"], "created_at": datetime.now(timezone.utc).isoformat()
-    }
-    await db.sessions.insert_one({**session})
+    await record_session_rollup(session)
     return session
 
 # ==================== ATTENDANCE ROUTES ====================
@@ -503,148 +1805,518 @@ async def create_session(data: dict, user=Depends(get_current_user)):
 async def get_attendance(session_id: str = Query(...), user=Depends(get_current_user)):
     return await db.attendance.find({"session_id": session_id}, {"_id": 0}).to_list(5000)
 
-@api_router.post("/attendance/bulk")
-async def mark_attendance_bulk(data: AttendanceBulkReq, user=Depends(get_current_user)):
-    settings = await get_settings()
-    warnings = []
-    results = []
-
-    for record in data.records:
-        existing = await db.attendance.find_one(
-            {"session_id": data.session_id, "dancer_id": record.dancer_id}, {"_id": 0}
-        )
-        old_status = existing["status"] if existing else None
-        new_status = record.status
-        pass_used = None
+ATTENDANCE_CAS_RETRIES = 5
+
+async def consume_pass(p):
+    """Atomically take one class from a pass; returns the updated pass, or None if it was used up meanwhile."""
+    if p["type"] == "class_pack":
+        return await db.passes.find_one_and_update(
+            {"id": p["id"], "remaining_classes": {"$gt": 0}}, {"$inc": {"remaining_classes": -1}},
+            projection={"_id": 0}, return_document=ReturnDocument.AFTER)
+    if p["type"] == "drop_in":
+        return await db.passes.find_one_and_update(
+            {"id": p["id"], "status": "unused"}, {"$set": {"status": "used"}},
+            projection={"_id": 0}, return_document=ReturnDocument.AFTER)
+    return p
+
+async def release_pass(p):
+    """Give back a class taken by consume_pass."""
+    if p["type"] == "class_pack":
+        await db.passes.update_one({"id": p["id"]}, {"$inc": {"remaining_classes": 1}})
+    elif p["type"] == "drop_in":
+        await db.passes.update_one({"id": p["id"], "status": "used"}, {"$set": {"status": "unused"}})
 
-        # Consume pass when marking present
-        if new_status == "present" and old_status != "present":
-            active_passes = await db.passes.find(
-                {"dancer_id": record.dancer_id, "batch_id": data.batch_id}, {"_id": 0}
+async def write_attendance_if_unchanged(existing, att_doc):
+    """Compare-and-set: persist att_doc only if the stored record still has the status and pass we read."""
+    if existing:
+        res = await db.attendance.update_one(
+            {"id": existing["id"], "status": existing["status"], "pass_id": existing.get("pass_id")},
+            {"$set": {k: v for k, v in att_doc.items() if k != "id"}})
+        return res.matched_count == 1
+    try:
+        await db.attendance.insert_one({**att_doc})
+        return True
+    except DuplicateKeyError:
+        return False
+
+async def charge_attendance(att_doc, batch_id, passes, settings):
+    """Take a class for a present mark this writer has claimed; returns the pass charged or None.
+
+    Prefetched passes are tried first, then the dancer's pass history is re-read for any usable pass not
+    tried yet. The pass is attached with a guarded update that only succeeds while the record is still
+    present and uncharged; if another writer moved it off present meanwhile, the class is given back.
+    """
+    tried = set()
+    for attempt in range(2):
+        if attempt:
+            passes[:] = await db.passes.find(
+                {"dancer_id": att_doc["dancer_id"], "batch_id": batch_id}, {"_id": 0}
             ).sort("created_at", -1).to_list(100)
-            for p in active_passes:
-                st = compute_pass_status(p, settings)
-                if st in ("active", "expiring_soon"):
-                    pass_used = p
-                    break
-                if p["type"] == "drop_in" and p.get("status") == "unused":
-                    pass_used = p
-                    break
-            if pass_used:
-                if pass_used["type"] == "class_pack":
-                    nr = pass_used.get("remaining_classes", 0) - 1
-                    await db.passes.update_one({"id": pass_used["id"]}, {"$set": {"remaining_classes": nr}})
-                    if nr <= 0:
-                        warnings.append({"dancer_id": record.dancer_id, "message": "Class pack exhausted"})
-                    elif nr <= settings.get("class_pack_expiry_warning_remaining", 2):
-                        warnings.append({"dancer_id": record.dancer_id, "message": f"Class pack low: {nr} remaining"})
-                elif pass_used["type"] == "drop_in":
-                    await db.passes.update_one({"id": pass_used["id"]}, {"$set": {"status": "used"}})
-                elif pass_used["type"] == "monthly":
-                    cs = compute_pass_status(pass_used, settings)
-                    if cs == "expiring_soon":
-                        warnings.append({"dancer_id": record.dancer_id, "message": "Monthly pass expiring soon"})
-                    elif cs == "expired":
-                        warnings.append({"dancer_id": record.dancer_id, "message": "Monthly pass expired"})
-            else:
-                warnings.append({"dancer_id": record.dancer_id, "message": "No active pass"})
-
-        # Reverse consumption when changing from present
-        elif old_status == "present" and new_status != "present":
-            if existing and existing.get("pass_id"):
-                old_pass = await db.passes.find_one({"id": existing["pass_id"]}, {"_id": 0})
-                if old_pass:
-                    if old_pass["type"] == "class_pack":
-                        await db.passes.update_one({"id": old_pass["id"]}, {"$inc": {"remaining_classes": 1}})
-                    elif old_pass["type"] == "drop_in":
-                        await db.passes.update_one({"id": old_pass["id"]}, {"$set": {"status": "unused"}})
-
+        for p in usable_passes(passes, settings):
+            if p["id"] in tried:
+                continue
+            tried.add(p["id"])
+            pass_used = await consume_pass(p)
+            if not pass_used:
+                continue
+            p.update(pass_used)
+            res = await db.attendance.update_one(
+                {"id": att_doc["id"], "status": "present", "pass_id": None}, {"$set": {"pass_id": pass_used["id"]}})
+            if res.matched_count != 1:
+                await release_pass(pass_used)
+                return None
+            att_doc["pass_id"] = pass_used["id"]
+            return pass_used
+    return None
+
+async def apply_attendance(session_id, batch_id, dancer_id, new_status, existing, passes, passes_by_id,
+                           settings, actor_id, now_iso, client_timestamp=None):
+    """Apply one attendance record race-free and return (att_doc, warnings, status it replaced).
+
+    The transition is claimed first with a compare-and-set on the status and pass we read, so exactly
+    one writer moves a record onto or off present. Only that writer then charges a pass (attached with a
+    guarded update) or gives back the class the record held.
+    """
+    for attempt in range(ATTENDANCE_CAS_RETRIES):
+        if attempt:
+            existing = await db.attendance.find_one({"session_id": session_id, "dancer_id": dancer_id}, {"_id": 0})
+        old_status = existing["status"] if existing else None
+        consuming = new_status == "present" and old_status != "present"
+        pass_id = None if consuming else (existing.get("pass_id") if existing else None)
         att_doc = {
-            "session_id": data.session_id, "dancer_id": record.dancer_id,
-            "status": new_status, "marked_by": user["id"],
-            "pass_id": pass_used["id"] if pass_used else (existing.get("pass_id") if existing else None),
-            "timestamp": datetime.now(timezone.utc).isoformat()
+            "session_id": session_id, "dancer_id": dancer_id,
+            "status": new_status, "marked_by": actor_id,
+            "pass_id": pass_id, "timestamp": now_iso, "client_timestamp": client_timestamp or now_iso,
+            "id": existing["id"] if existing else str(uuid.uuid4())
         }
-        if existing:
-            await db.attendance.update_one({"id": existing["id"]}, {"$set": att_doc})
-            att_doc["id"] = existing["id"]
-        else:
-            att_doc["id"] = str(uuid.uuid4())
-            await db.attendance.insert_one({**att_doc})
-        await audit_log(user["id"], "mark_attendance", "attendance", att_doc["id"],
-                        {"dancer_id": record.dancer_id, "status": new_status, "session_id": data.session_id})
-        results.append(att_doc)
+        if await write_attendance_if_unchanged(existing, att_doc):
+            break
+    else:
+        raise HTTPException(409, "Attendance was changed concurrently, please retry")
+    pass_used = await charge_attendance(att_doc, batch_id, passes, settings) if consuming else None
 
+    warnings = []
+    # Warn about the pass consumed when marking present
+    if consuming:
+        if not pass_used:
+            warnings.append({"dancer_id": dancer_id, "message": "No active pass"})
+        elif pass_used["type"] == "class_pack":
+            nr = pass_used.get("remaining_classes", 0)
+            if nr <= 0:
+                warnings.append({"dancer_id": dancer_id, "message": "Class pack exhausted"})
+            elif nr <= settings.get("class_pack_expiry_warning_remaining", 2):
+                warnings.append({"dancer_id": dancer_id, "message": f"Class pack low: {nr} remaining"})
+        elif pass_used["type"] == "monthly":
+            cs = compute_pass_status(pass_used, settings)
+            if cs == "expiring_soon":
+                warnings.append({"dancer_id": dancer_id, "message": "Monthly pass expiring soon"})
+            elif cs == "expired":
+                warnings.append({"dancer_id": dancer_id, "message": "Monthly pass expired"})
+
+    # Reverse consumption when changing from present
+    elif old_status == "present" and new_status != "present" and pass_id:
+        old_pass = passes_by_id.get(pass_id) or await db.passes.find_one({"id": pass_id}, {"_id": 0})
+        if old_pass:
+            await release_pass(old_pass)
+    return att_doc, warnings, old_status
+
+async def mark_attendance(session_id, batch_id, records, user):
+    """Apply (dancer_id, status, client_timestamp or None) records to one session; returns (results, warnings)."""
+    session = await db.sessions.find_one({"id": session_id}, {"_id": 0, "id": 1, "batch_id": 1, "date": 1})
+    if not session:
+        raise HTTPException(404, "Session not found")
+    if session["batch_id"] != batch_id:
+        raise HTTPException(400, "Session belongs to another batch")
+    settings = await get_settings()
+    now_iso = datetime.now(timezone.utc).isoformat()
+    records_by_dancer = {}
+    for i, (dancer_id, status, client_timestamp) in enumerate(records):
+        records_by_dancer.setdefault(dancer_id, []).append((i, status, client_timestamp))
+    dancer_ids = list(records_by_dancer)
+    if not dancer_ids:
+        return [], []
+
+    # Prefetch current attendance, the current pass of every dancer and any pass up for release
+    existing_by_dancer = {a["dancer_id"]: a for a in await db.attendance.find(
+        {"session_id": session_id, "dancer_id": {"$in": dancer_ids}}, {"_id": 0}
+    ).to_list(None)}
+    current = await load_current_passes({"batch_id": batch_id, "dancer_id": {"$in": dancer_ids}})
+    passes_by_dancer = {}
+    for did in dancer_ids:
+        p = current.get((did, batch_id))
+        passes_by_dancer[did] = usable_passes([p], settings) if p else []
+    consumed_ids = [a["pass_id"] for a in existing_by_dancer.values() if a.get("pass_id")]
+    passes_by_id = {p["id"]: p for p in await db.passes.find(
+        {"id": {"$in": consumed_ids}}, {"_id": 0}
+    ).to_list(None)} if consumed_ids else {}
+    # The projection can lag time-based expiry; fall back to the history only where it has no usable pass
+    fallback = [did for did, ps in passes_by_dancer.items()
+                if not ps and any(st == "present" for _, st, _ in records_by_dancer[did])]
+    if fallback:
+        for p in await db.passes.find(
+            {"dancer_id": {"$in": fallback}, "batch_id": batch_id}, {"_id": 0}
+        ).sort("created_at", -1).to_list(None):
+            passes_by_dancer[p["dancer_id"]].append(p)
+
+    # Dancers are independent and run concurrently; repeated records for one dancer stay ordered
+    changed, transitions = set(), []
+
+    async def mark_dancer(dancer_id):
+        out, existing = [], existing_by_dancer.get(dancer_id)
+        for i, status, client_timestamp in records_by_dancer[dancer_id]:
+            existing, warns, previous = await apply_attendance(
+                session_id, batch_id, dancer_id, status, existing, passes_by_dancer[dancer_id],
+                passes_by_id, settings, user["id"], now_iso, client_timestamp)
+            transitions.append((dancer_id, previous, status))
+            if (previous == "present") != (status == "present"):
+                changed.add(dancer_id)
+            out.append((i, dict(existing), warns))
+        return out
+
+    marked = sorted(
+        (m for ms in await asyncio.gather(*(mark_dancer(did) for did in dancer_ids)) for m in ms),
+        key=lambda m: m[0])
+    results = [att for _, att, _ in marked]
+    warnings = [w for _, _, ws in marked for w in ws]
+    await refresh_current_passes(batch_id, changed)
+    await apply_attendance_deltas(session, transitions)
+    request_notifications_rebuild()
+    await audit_log_many([
+        audit_entry(user["id"], "mark_attendance", "attendance", att["id"],
+                    {"dancer_id": att["dancer_id"], "status": att["status"], "session_id": session_id})
+        for att in results
+    ])
+    return results, warnings
+
+@api_router.post("/attendance/bulk")
+async def mark_attendance_bulk(data: AttendanceBulkReq, user=Depends(get_current_user)):
+    results, warnings = await mark_attendance(
+        data.session_id, data.batch_id, [(r.dancer_id, r.status, None) for r in data.records], user)
     return {"results": results, "warnings": warnings}
 
+# Offline sync: the client queues taps with its own ids and timestamps and sends them when it can. A delta
+# id seen before is answered from attendance_sync_ops instead of being applied again, so retrying a sync
+# whose response was lost cannot move a record back or charge a pass twice. Conflicting taps resolve by
+# client timestamp, latest wins: older deltas are acknowledged as "stale" or "superseded" and skipped, and
+# deltas for a session that no longer exists as "rejected". Each delta is applied in its session's batch.
+# The response carries the session's records changed since the client's cursor; the cursor is replayed
+# with SYNC_CURSOR_OVERLAP_SECONDS of overlap to cover writes still committing when it was issued, so
+# clients apply changes by record id.
+SYNC_CURSOR_OVERLAP_SECONDS = int(os.environ.get("SYNC_CURSOR_OVERLAP_SECONDS", "30"))
+SYNC_OP_RETENTION_DAYS = int(os.environ.get("SYNC_OP_RETENTION_DAYS", "30"))
+
+def parse_client_timestamp(value, now):
+    """Client time as a UTC ISO string, clamped to `now` so a fast device clock can't pin a record."""
+    try:
+        ts = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        raise HTTPException(400, f"Invalid client_timestamp: {value}")
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return min(ts.astimezone(timezone.utc), now).isoformat()
+
+@api_router.post("/attendance/sync")
+async def sync_attendance(data: AttendanceSyncReq, user=Depends(get_current_user)):
+    now = datetime.now(timezone.utc)
+    for d in data.deltas:
+        if d.status not in ROLLUP_STATUSES:
+            raise HTTPException(400, f"Invalid status: {d.status}")
+    ids = list({d.id for d in data.deltas})
+    outcomes = {o["id"]: o["outcome"] for o in await db.attendance_sync_ops.find(
+        {"user_id": user["id"], "id": {"$in": ids}}, {"_id": 0, "id": 1, "outcome": 1}).to_list(None)} if ids else {}
+    replayed = set(outcomes)
+
+    # Latest new delta per (session, dancer); the rest were overtaken on the device itself
+    latest = {}
+    for d in data.deltas:
+        if d.id in outcomes:
+            continue
+        ts = parse_client_timestamp(d.client_timestamp, now)
+        key = (d.session_id or data.session_id, d.dancer_id)
+        if key in latest and latest[key][1] > ts:
+            outcomes[d.id] = "superseded"
+            continue
+        if key in latest:
+            outcomes[latest[key][0].id] = "superseded"
+        latest[key] = (d, ts)
+        outcomes[d.id] = "applied"
+
+    by_session = {}
+    for (session_id, _), item in latest.items():
+        by_session.setdefault(session_id, []).append(item)
+    # Each delta is charged in its own session's batch, whatever batch the device was showing
+    sessions = {s["id"]: s for s in await db.sessions.find(
+        {"id": {"$in": list(by_session)}}, {"_id": 0, "id": 1, "batch_id": 1}).to_list(None)}
+    warnings = []
+    for session_id, items in by_session.items():
+        if session_id not in sessions:
+            for d, _ in items:
+                outcomes[d.id] = "rejected"
+            continue
+        existing = {a["dancer_id"]: a for a in await db.attendance.find(
+            {"session_id": session_id, "dancer_id": {"$in": [d.dancer_id for d, _ in items]}},
+            {"_id": 0, "dancer_id": 1, "timestamp": 1, "client_timestamp": 1}).to_list(None)}
+        fresh = []
+        for d, ts in items:
+            a = existing.get(d.dancer_id)
+            if a and (a.get("client_timestamp") or a["timestamp"]) > ts:
+                outcomes[d.id] = "stale"
+            else:
+                fresh.append((d.dancer_id, d.status, ts))
+        if fresh:
+            warnings += (await mark_attendance(session_id, sessions[session_id]["batch_id"], fresh, user))[1]
+
+    ops = [{"id": d.id, "user_id": user["id"], "session_id": d.session_id or data.session_id,
+            "dancer_id": d.dancer_id, "status": d.status, "client_timestamp": d.client_timestamp,
+            "outcome": outcomes[d.id], "created_at": now}
+           for d in {d.id: d for d in data.deltas if d.id not in replayed}.values()]
+    if ops:
+        try:
+            await db.attendance_sync_ops.insert_many(ops, ordered=False)
+        except BulkWriteError as e:
+            # A concurrent retry of the same deltas recorded them first
+            if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+                raise
+
+    changes = {"session_id": data.session_id}
+    if data.cursor:
+        try:
+            since = datetime.fromisoformat(decode_cursor(data.cursor, size=1)[0]) - timedelta(seconds=SYNC_CURSOR_OVERLAP_SECONDS)
+        except ValueError:
+            raise HTTPException(400, "Invalid cursor")
+        changes["timestamp"] = {"$gte": since.isoformat()}
+    return {
+        "results": [{"id": d.id, "outcome": outcomes[d.id]} for d in data.deltas],
+        "warnings": warnings,
+        "changes": await db.attendance.find(changes, {"_id": 0}).to_list(None),
+        "cursor": encode_cursor([now.isoformat()]),
+    }
+
 # ==================== AUDIT LOG ROUTES ====================
+# The audit log is paged by keyset on (timestamp, id), newest first, so every page is an index seek.
+# One compound index per combination of equality filters keeps filtered pages on the same plan.
+AUDIT_LOG_FILTER_FIELDS = ("actor_user_id", "action_type", "entity_type")
+AUDIT_LOG_INDEXES = [
+    [(f, 1) for f in fields] + [("timestamp", -1), ("id", -1)]
+    for n in range(len(AUDIT_LOG_FILTER_FIELDS) + 1)
+    for fields in itertools.combinations(AUDIT_LOG_FILTER_FIELDS, n)
+]
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def decode_cursor(token, size=2):
+    """Values of a cursor made by encode_cursor; 400 unless it holds exactly `size` strings."""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token.encode()))
+    except (ValueError, TypeError):
+        raise HTTPException(400, "Invalid cursor")
+    if not isinstance(values, list) or len(values) != size or not all(isinstance(v, str) for v in values):
+        raise HTTPException(400, "Invalid cursor")
+    return values
+
+def keyset_query(query, field, value, last_id, op):
+    """`query` narrowed to the rows after (value, last_id) in (field, id) order; `op` is "$gt" or "$lt"."""
+    return {"$and": [query, {"$or": [{field: {op: value}}, {field: value, "id": {op: last_id}}]}]}
+
 @api_router.get("/audit-log")
 async def get_audit_log_route(
     user=Depends(get_current_user),
     actor_id: str = None, action_type: str = None,
     entity_type: str = None, start_date: str = None,
-    end_date: str = None, page: int = 1, limit: int = 50
+    end_date: str = None, cursor: str = None,
+    limit: int = Query(50, ge=1, le=200), include_total: bool = False
 ):
     require_admin(user)
-    query = {}
-    if actor_id:
-        query["actor_user_id"] = actor_id
-    if action_type:
-        query["action_type"] = action_type
-    if entity_type:
-        query["entity_type"] = entity_type
-    if start_date or end_date:
+    filters = {f: v for f, v in zip(AUDIT_LOG_FILTER_FIELDS, (actor_id, action_type, entity_type)) if v}
+    query = dict(filters)
+    start = start_date or None
+    end = end_date + "T23:59:59" if end_date else None
+    if start or end:
         query["timestamp"] = {}
-        if start_date:
-            query["timestamp"]["$gte"] = start_date
-        if end_date:
-            query["timestamp"]["$lte"] = end_date + "T23:59:59"
-    total = await db.audit_log.count_documents(query)
-    logs = await db.audit_log.find(query, {"_id": 0}).sort("timestamp", -1).skip((page - 1) * limit).limit(limit).to_list(limit)
+        if start:
+            query["timestamp"]["$gte"] = start
+        if end:
+            query["timestamp"]["$lte"] = end
+    total = None
+    if include_total:
+        # Unfiltered totals come from collection metadata instead of a count scan
+        total = await db.audit_log.count_documents(query) if query else await db.audit_log.estimated_document_count()
+        total += await asyncio.to_thread(audit_archive.count, filters, start, end)
+    page_query, before = query, None
+    if cursor:
+        before = decode_cursor(cursor)
+        page_query = keyset_query(query, "timestamp", *before, "$lt")
+    logs = await db.audit_log.find(page_query, {"_id": 0}).sort(
+        [("timestamp", -1), ("id", -1)]).limit(limit + 1).to_list(limit + 1)
+    if len(logs) <= limit:
+        # Everything older has been archived; continue the same keyset into the archive
+        if logs:
+            before = [logs[-1]["timestamp"], logs[-1]["id"]]
+        logs += await asyncio.to_thread(audit_archive.find, filters, start, end, before, limit + 1 - len(logs))
+    next_cursor = encode_cursor([logs[limit - 1]["timestamp"], logs[limit - 1]["id"]]) if len(logs) > limit else None
+    logs = logs[:limit]
     actor_ids = list(set(l["actor_user_id"] for l in logs))
     actors = await db.users.find({"id": {"$in": actor_ids}}, {"_id": 0, "id": 1, "name": 1, "email": 1}).to_list(100)
     actor_map = {a["id"]: a.get("name", a.get("email", "Unknown")) for a in actors}
     for l in logs:
         l["actor_name"] = actor_map.get(l["actor_user_id"], "Unknown")
-    return {"logs": logs, "total": total, "page": page, "limit": limit}
+        l["metadata"] = expand_audit_metadata(l.get("metadata") or {})
+    return {"logs": logs, "next_cursor": next_cursor, "total": total, "limit": limit}
 
-# ==================== NOTIFICATION ROUTES ====================
-@api_router.get("/notifications")
-async def get_notifications(user=Depends(get_current_user)):
+AUDITED_ENTITIES = {"batch": "batches", "dancer": "dancers", "pass": "passes", "settings": "settings"}
+
+@api_router.get("/audit-log/state")
+async def get_entity_state(entity_type: str, entity_id: str, at: str, user=Depends(get_current_user)):
+    """Rebuild an entity as it was at `at` by undoing the audited field changes made since, newest first.
+
+    Fields changed outside audited updates (such as classes consumed by attendance) keep their current value.
+    """
+    require_admin(user)
+    if entity_type not in AUDITED_ENTITIES:
+        raise HTTPException(400, f"Unsupported entity type: {entity_type}")
+    at_dt = request_pass_date(at)
+    if at_dt is None:
+        raise HTTPException(400, f"Invalid date: {at}")
+    at_iso = at_dt.isoformat()
+    state = await db[AUDITED_ENTITIES[entity_type]].find_one({"id": entity_id}, {"_id": 0})
+    if not state:
+        raise HTTPException(404, "Entity not found")
+    if state.get("created_at") and state["created_at"] > at_iso:
+        return {"entity_type": entity_type, "entity_id": entity_id, "at": at_iso, "state": None, "changes_undone": 0}
+    filters = {"entity_type": entity_type, "entity_id": entity_id}
+    entries = await db.audit_log.find({**filters, "timestamp": {"$gt": at_iso}}, {"_id": 0}).sort(
+        [("timestamp", -1), ("id", -1)]).to_list(None)
+    before = [entries[-1]["timestamp"], entries[-1]["id"]] if entries else None
+    entries += await asyncio.to_thread(audit_archive.find, filters, at_iso, None, before, 10 ** 9)
+    undone = 0
+    for entry in entries:
+        if entry["timestamp"] <= at_iso:
+            continue
+        for field, (old_value, _) in audit_changes(entry.get("metadata") or {}).items():
+            state[field] = old_value
+        undone += 1
+    if entity_type == "settings":
+        state.pop("version", None)
+    return {"entity_type": entity_type, "entity_id": entity_id, "at": at_iso, "state": state, "changes_undone": undone}
+
+# ==================== NOTIFICATION FEED ====================
+# Expiry alerts are precomputed into the notifications collection, one document per scope ("admin" or
+# "instructor:<user id>") and pass, so the bell icon poll is a single indexed read. A background job
+# rebuilds the feed at startup, every NOTIFICATIONS_REFRESH_SECONDS, and shortly after relevant writes.
+NOTIFICATIONS_REFRESH_SECONDS = int(os.environ.get("NOTIFICATIONS_REFRESH_SECONDS", "300"))
+NOTIFICATIONS_DEBOUNCE_SECONDS = float(os.environ.get("NOTIFICATIONS_DEBOUNCE_SECONDS", "2"))
+notifications_dirty = asyncio.Event()
+
+def notification_scope(user):
+    return "admin" if user["role"] == "admin" else f"instructor:{user['id']}"
+
+def request_notifications_rebuild():
+    notifications_dirty.set()
+
+async def rebuild_notifications():
+    """Upsert the alerts current passes call for and delete the ones they no longer do.
+
+    Every worker rebuilds after its own writes, so runs can overlap. A run only deletes entries it saw
+    before it started and did not regenerate, never ones a concurrent run has just written.
+    """
+    existing = await db.notifications.find({}, {"_id": 1, "scope": 1, "id": 1, "type": 1}).to_list(None)
     settings = await get_settings()
-    notifications = []
-    if user["role"] == "admin":
-        batches = await db.batches.find({"active": True}, {"_id": 0}).to_list(100)
-    else:
-        batches = await db.batches.find({"assigned_instructor_ids": user["id"], "active": True}, {"_id": 0}).to_list(100)
+    batches = await db.batches.find({"active": True}, {"_id": 0}).to_list(None)
+    batch_ids = [b["id"] for b in batches]
+    enrollments = await db.enrollments.find({"batch_id": {"$in": batch_ids}, "active": True}, {"_id": 0}).to_list(None)
+    dancer_ids = list({e["dancer_id"] for e in enrollments})
+    dancers = {d["id"]: d for d in await db.dancers.find({"id": {"$in": dancer_ids}}, DANCER_PROJECTION).to_list(None)}
+    current = await load_current_passes({"batch_id": {"$in": batch_ids}, "dancer_id": {"$in": dancer_ids}})
+    enrolled = {}
+    for e in enrollments:
+        enrolled.setdefault(e["batch_id"], []).append(e["dancer_id"])
+
+    stamp = datetime.now(timezone.utc).isoformat()
+    ops, keys = [], set()
     for batch in batches:
-        enrollments = await db.enrollments.find({"batch_id": batch["id"], "active": True}, {"_id": 0}).to_list(5000)
-        dancer_ids = [e["dancer_id"] for e in enrollments]
-        for did in dancer_ids:
-            dancer = await db.dancers.find_one({"id": did}, {"_id": 0})
-            if not dancer:
+        scopes = ["admin"] + [f"instructor:{uid}" for uid in batch.get("assigned_instructor_ids", [])]
+        for did in enrolled.get(batch["id"], []):
+            dancer = dancers.get(did)
+            p = current.get((did, batch["id"]))
+            if not dancer or not p:
+                continue
+            status = compute_pass_status(p, settings)
+            if status not in ("expiring_soon", "expired"):
                 continue
-            passes = await db.passes.find({"dancer_id": did, "batch_id": batch["id"]}, {"_id": 0}).to_list(100)
-            for p in passes:
-                status = compute_pass_status(p, settings)
-                if status in ("expiring_soon", "expired"):
-                    msg = ""
-                    if p["type"] == "monthly":
-                        msg = f"Monthly pass {'expiring soon' if status == 'expiring_soon' else 'expired'} (ends {p.get('end_date', '')[:10]})"
-                    elif p["type"] == "class_pack":
-                        msg = f"Class pack: {p.get('remaining_classes', 0)} classes remaining" if status == "expiring_soon" else "Class pack expired"
-                    notifications.append({
-                        "id": p["id"], "type": status,
-                        "dancer_name": dancer["full_name"], "dancer_id": did,
-                        "batch_name": batch["batch_name"], "batch_id": batch["id"],
-                        "message": msg, "pass_type": p["type"]
-                    })
-    return notifications
+            msg = ""
+            if p["type"] == "monthly":
+                msg = f"Monthly pass {'expiring soon' if status == 'expiring_soon' else 'expired'} (ends {format_date(p.get('end_date'))})"
+            elif p["type"] == "class_pack":
+                msg = f"Class pack: {p.get('remaining_classes', 0)} classes remaining" if status == "expiring_soon" else "Class pack expired"
+            n = {
+                "id": p["id"], "type": status,
+                "dancer_name": dancer["full_name"], "dancer_id": did,
+                "batch_name": batch["batch_name"], "batch_id": batch["id"],
+                "message": msg, "pass_type": p["type"],
+                "rank": len(ops), "generated_at": stamp
+            }
+            # Read/dismissed state survives rebuilds until the alert changes type
+            for scope in scopes:
+                keys.add((scope, p["id"], status))
+                ops.append(UpdateOne(
+                    {"scope": scope, "id": p["id"], "type": status},
+                    {"$set": n, "$setOnInsert": {"read": False, "dismissed": False}}, upsert=True))
+    if ops:
+        await db.notifications.bulk_write(ops, ordered=False)
+    stale = [n["_id"] for n in existing if (n.get("scope"), n.get("id"), n.get("type")) not in keys]
+    if stale:
+        await db.notifications.delete_many({"_id": {"$in": stale}})
+
+async def notifications_job():
+    notifications_dirty.set()
+    while True:
+        try:
+            await asyncio.wait_for(notifications_dirty.wait(), NOTIFICATIONS_REFRESH_SECONDS)
+            await asyncio.sleep(NOTIFICATIONS_DEBOUNCE_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        notifications_dirty.clear()
+        try:
+            await rebuild_notifications()
+        except Exception:
+            logger.exception("Notification feed rebuild failed")
+
+# ==================== NOTIFICATION ROUTES ====================
+@api_router.get("/notifications")
+async def get_notifications(include_dismissed: bool = False, user=Depends(get_current_user)):
+    query = {"scope": notification_scope(user)}
+    if not include_dismissed:
+        query["dismissed"] = False
+    return await db.notifications.find(
+        query, {"_id": 0, "scope": 0, "rank": 0, "generated_at": 0}
+    ).sort("rank", 1).to_list(None)
+
+@api_router.put("/notifications/read-all")
+async def mark_all_notifications_read(user=Depends(get_current_user)):
+    await db.notifications.update_many({"scope": notification_scope(user), "read": False}, {"$set": {"read": True}})
+    return {"status": "read"}
+
+@api_router.put("/notifications/{notification_id}/read")
+async def mark_notification_read(notification_id: str, user=Depends(get_current_user)):
+    res = await db.notifications.update_many({"scope": notification_scope(user), "id": notification_id}, {"$set": {"read": True}})
+    if not res.matched_count:
+        raise HTTPException(404, "Notification not found")
+    return {"status": "read"}
+
+@api_router.put("/notifications/{notification_id}/dismiss")
+async def dismiss_notification(notification_id: str, user=Depends(get_current_user)):
+    res = await db.notifications.update_many(
+        {"scope": notification_scope(user), "id": notification_id}, {"$set": {"read": True, "dismissed": True}})
+    if not res.matched_count:
+        raise HTTPException(404, "Notification not found")
+    return {"status": "dismissed"}
 
 # ==================== REPORT ROUTES ====================
-@api_router.get("/reports/attendance")
-async def get_attendance_report(batch_id: str = None, start_date: str = None, end_date: str = None, user=Depends(get_current_user)):
-    require_admin(user)
+ATTENDANCE_EXPORT_COLUMNS = ["Date", "Batch", "Dancer", "Phone", "Status", "Pass Type"]
+CSV_CHUNK_BYTES = 16 * 1024
+
+def session_query(batch_id=None, start_date=None, end_date=None):
     sq = {}
     if batch_id:
         sq["batch_id"] = batch_id
@@ -654,75 +2326,348 @@ async def get_attendance_report(batch_id: str = None, start_date: str = None, en
             sq["date"]["$gte"] = start_date
         if end_date:
             sq["date"]["$lte"] = end_date
-    sessions = await db.sessions.find(sq, {"_id": 0}).to_list(5000)
-    batches = await db.batches.find({}, {"_id": 0}).to_list(100)
-    batch_map = {b["id"]: b for b in batches}
+    return sq
+
+async def attendance_export_rows(batch_id=None, start_date=None, end_date=None):
+    """Yield one export row per attendance record, joined to its session, batch, dancer and pass on the server."""
+    pipeline = [
+        {"$match": session_query(batch_id, start_date, end_date)},
+        {"$sort": {"date": 1, "batch_id": 1}},
+        {"$lookup": {"from": "attendance", "localField": "id", "foreignField": "session_id", "as": "att"}},
+        {"$unwind": "$att"},
+        {"$lookup": {"from": "batches", "localField": "batch_id", "foreignField": "id", "as": "batch"}},
+        {"$lookup": {"from": "dancers", "localField": "att.dancer_id", "foreignField": "id", "as": "dancer"}},
+        {"$lookup": {"from": "passes", "localField": "att.pass_id", "foreignField": "id", "as": "pass"}},
+        {"$project": {"_id": 0, "date": 1, "status": "$att.status",
+                      "batch_name": {"$first": "$batch.batch_name"}, "full_name": {"$first": "$dancer.full_name"},
+                      "phone_number": {"$first": "$dancer.phone_number"}, "pass_type": {"$first": "$pass.type"}}},
+    ]
+    async for r in db.sessions.aggregate(pipeline, allowDiskUse=True, batchSize=500):
+        yield [r["date"], r.get("batch_name") or "Unknown", r.get("full_name") or "", r.get("phone_number") or "",
+               r["status"], r.get("pass_type") or "none"]
+
+async def stream_csv(header, rows):
+    """Encode rows as CSV, handing out chunks of about CSV_CHUNK_BYTES as they fill."""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(header)
+    yield buf.getvalue().encode()
+    buf.seek(0)
+    buf.truncate()
+    async for row in rows:
+        writer.writerow(row)
+        if buf.tell() >= CSV_CHUNK_BYTES:
+            yield buf.getvalue().encode()
+            buf.seek(0)
+            buf.truncate()
+    if buf.tell():
+        yield buf.getvalue().encode()
+
+@api_router.get("/reports/attendance")
+async def get_attendance_report(batch_id: str = None, start_date: str = None, end_date: str = None, user=Depends(get_current_user)):
+    require_admin(user)
+    # Scheduled sessions exist ahead of time; unless asked otherwise, only count the ones already held
+    end_date = end_date or datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    rollups = await db.daily_attendance_rollups.find(
+        session_query(batch_id, start_date, end_date), {"_id": 0}).sort("date", 1).to_list(None)
+    batch_ids = list({r["batch_id"] for r in rollups})
+    batch_map = {b["id"]: b for b in await db.batches.find(
+        {"id": {"$in": batch_ids}}, {"_id": 0, "id": 1, "batch_name": 1}).to_list(None)}
     report = {}
-    for s in sessions:
-        bid = s["batch_id"]
+    for r in rollups:
+        bid = r["batch_id"]
         if bid not in report:
             bi = batch_map.get(bid, {})
             report[bid] = {"batch_id": bid, "batch_name": bi.get("batch_name", "Unknown"), "total_sessions": 0, "total_present": 0, "total_absent": 0, "sessions": []}
-        att = await db.attendance.find({"session_id": s["id"]}, {"_id": 0}).to_list(5000)
-        present = sum(1 for a in att if a["status"] == "present")
-        absent = sum(1 for a in att if a["status"] == "absent")
-        report[bid]["total_sessions"] += 1
+        present, absent = r.get("present", 0), r.get("absent", 0)
+        report[bid]["total_sessions"] += r.get("sessions", 0)
         report[bid]["total_present"] += present
         report[bid]["total_absent"] += absent
-        report[bid]["sessions"].append({"date": s["date"], "present": present, "absent": absent, "total": len(att)})
+        report[bid]["sessions"].append({"date": r["date"], "present": present, "absent": absent, "total": r.get("total", 0)})
     return list(report.values())
 
+@api_router.get("/reports/low-attendance")
+async def get_low_attendance_report(batch_id: str = None, max_rate: float = Query(0.5, ge=0, le=1),
+                                    min_sessions: int = Query(4, ge=1), limit: int = Query(50, ge=1, le=500),
+                                    user=Depends(get_current_user)):
+    """Active enrollments attending less than `max_rate` of their marked sessions, lowest rate first."""
+    require_admin(user)
+    match = {"active": True, "total_sessions": {"$gte": min_sessions}}
+    if batch_id:
+        match["batch_id"] = batch_id
+    return await db.enrollments.aggregate([
+        {"$match": match},
+        {"$addFields": {"attendance_rate": {"$divide": ["$present_count", "$total_sessions"]}}},
+        {"$match": {"attendance_rate": {"$lt": max_rate}}},
+        {"$sort": {"attendance_rate": 1, "total_sessions": -1}},
+        {"$limit": limit},
+        {"$lookup": {"from": "dancers", "localField": "dancer_id", "foreignField": "id", "as": "dancer"}},
+        {"$lookup": {"from": "batches", "localField": "batch_id", "foreignField": "id", "as": "batch"}},
+        {"$project": {"_id": 0, "enrollment_id": "$id", "dancer_id": 1, "batch_id": 1, "total_sessions": 1,
+                      "present_count": 1, "absent_count": 1, "last_attended_date": 1, "attendance_rate": 1,
+                      "dancer_name": {"$first": "$dancer.full_name"}, "batch_name": {"$first": "$batch.batch_name"}}},
+    ]).to_list(limit)
+
 @api_router.get("/reports/expiring")
 async def get_expiring_report(user=Depends(get_current_user)):
     require_admin(user)
     settings = await get_settings()
-    passes = await db.passes.find({}, {"_id": 0}).to_list(10000)
-    expiring, expired_list = [], []
-    for p in passes:
-        status = compute_pass_status(p, settings)
-        if status not in ("expiring_soon", "expired"):
-            continue
-        dancer = await db.dancers.find_one({"id": p["dancer_id"]}, {"_id": 0})
-        batch = await db.batches.find_one({"id": p["batch_id"]}, {"_id": 0})
-        entry = {**p, "computed_status": status, "dancer_name": dancer["full_name"] if dancer else "Unknown", "batch_name": batch["batch_name"] if batch else "Unknown"}
-        if status == "expiring_soon":
-            expiring.append(entry)
-        else:
-            expired_list.append(entry)
-    return {"expiring": expiring, "expired": expired_list}
+    now = datetime.now(timezone.utc)
+    report = {"expiring_soon": [], "expired": []}
+    for status, entries in report.items():
+        passes = await db.passes.find(pass_status_query(status, settings, now), {"_id": 0}).to_list(None)
+        dancers = await asyncio.gather(*(db.dancers.find_one({"id": p["dancer_id"]}, DANCER_PROJECTION) for p in passes))
+        batches = await asyncio.gather(*(db.batches.find_one({"id": p["batch_id"]}, {"_id": 0}) for p in passes))
+        for p, dancer, batch in zip(passes, dancers, batches):
+            entries.append({**p, "computed_status": status, "dancer_name": dancer["full_name"] if dancer else "Unknown", "batch_name": batch["batch_name"] if batch else "Unknown"})
+    return {"expiring": report["expiring_soon"], "expired": report["expired"]}
 
 @api_router.get("/reports/csv")
 async def export_csv(batch_id: str = None, start_date: str = None, end_date: str = None, user=Depends(get_current_user)):
     require_admin(user)
-    sq = {}
-    if batch_id:
-        sq["batch_id"] = batch_id
-    if start_date or end_date:
-        sq["date"] = {}
-        if start_date:
-            sq["date"]["$gte"] = start_date
-        if end_date:
-            sq["date"]["$lte"] = end_date
-    sessions = await db.sessions.find(sq, {"_id": 0}).to_list(5000)
-    batches = await db.batches.find({}, {"_id": 0}).to_list(100)
-    batch_map = {b["id"]: b["batch_name"] for b in batches}
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(["Date", "Batch", "Dancer", "Phone", "Status", "Pass Type"])
-    for s in sessions:
-        att_records = await db.attendance.find({"session_id": s["id"]}, {"_id": 0}).to_list(5000)
-        for a in att_records:
-            dancer = await db.dancers.find_one({"id": a["dancer_id"]}, {"_id": 0})
-            pass_doc = await db.passes.find_one({"id": a.get("pass_id")}, {"_id": 0}) if a.get("pass_id") else None
-            writer.writerow([
-                s["date"], batch_map.get(s["batch_id"], "Unknown"),
-                dancer.get("full_name", "") if dancer else "", dancer.get("phone_number", "") if dancer else "",
-                a["status"], pass_doc["type"] if pass_doc else "none"
-            ])
-    output.seek(0)
-    return StreamingResponse(io.BytesIO(output.getvalue().encode()), media_type="text/csv",
+    rows = attendance_export_rows(batch_id, start_date, end_date)
+    return StreamingResponse(stream_csv(ATTENDANCE_EXPORT_COLUMNS, rows), media_type="text/csv",
                              headers={"Content-Disposition": "attachment; filename=attendance_report.csv"})
 
+# ==================== EXPORT JOBS ====================
+# Large exports run as jobs: POST /exports queues a document in export_jobs, a pool of EXPORT_WORKERS tasks
+# per process claims queued jobs and writes the file under EXPORT_DIR (shared storage when workers span
+# hosts), and the client polls the job for progress before downloading. Finished files are removed after
+# EXPORT_RETENTION_HOURS. A running job whose worker stops heartbeating is picked up again.
+EXPORT_DIR = Path(os.environ.get("EXPORT_DIR", str(ROOT_DIR / "exports")))
+EXPORT_WORKERS = int(os.environ.get("EXPORT_WORKERS", "2"))
+EXPORT_RETENTION_HOURS = int(os.environ.get("EXPORT_RETENTION_HOURS", "24"))
+EXPORT_POLL_SECONDS = float(os.environ.get("EXPORT_POLL_SECONDS", "5"))
+EXPORT_STALE_SECONDS = int(os.environ.get("EXPORT_STALE_SECONDS", "600"))
+EXPORT_HEARTBEAT_SECONDS = int(os.environ.get("EXPORT_HEARTBEAT_SECONDS", "60"))
+EXPORT_CHUNK_ROWS = 2000
+XLSX_MAX_ROWS = 1048576
+# format: (required module, media type)
+EXPORT_FORMATS = {
+    "csv": (None, "text/csv"),
+    "parquet": ("pyarrow", "application/vnd.apache.parquet"),
+    "xlsx": ("openpyxl", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+}
+export_jobs_pending = asyncio.Event()
+
+class CsvExportWriter:
+    def __init__(self, path):
+        self.file = open(path, "w", newline="", encoding="utf-8")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(ATTENDANCE_EXPORT_COLUMNS)
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+class ParquetExportWriter:
+    # pandas' to_parquet needs the whole frame in memory, so row groups go straight through pyarrow
+    def __init__(self, path):
+        import pyarrow as pa, pyarrow.parquet as pq
+        self.pa = pa
+        self.schema = pa.schema([(c, pa.string()) for c in ATTENDANCE_EXPORT_COLUMNS])
+        self.writer = pq.ParquetWriter(path, self.schema)
+
+    def write(self, rows):
+        columns = [self.pa.array(c, self.pa.string()) for c in zip(*rows)]
+        self.writer.write_table(self.pa.Table.from_arrays(columns, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+class XlsxExportWriter:
+    """Writes "Attendance", then "Attendance 2", ... as each sheet reaches Excel's row limit."""
+
+    def __init__(self, path):
+        from openpyxl import Workbook
+        self.path = path
+        self.workbook = Workbook(write_only=True)
+        self.sheets = 0
+        self.new_sheet()
+
+    def new_sheet(self):
+        self.sheets += 1
+        self.sheet = self.workbook.create_sheet("Attendance" if self.sheets == 1 else f"Attendance {self.sheets}")
+        self.sheet.append(ATTENDANCE_EXPORT_COLUMNS)
+        self.sheet_rows = 1
+
+    def write(self, rows):
+        for row in rows:
+            if self.sheet_rows >= XLSX_MAX_ROWS:
+                self.new_sheet()
+            self.sheet.append(row)
+            self.sheet_rows += 1
+
+    def close(self):
+        self.workbook.save(self.path)
+
+EXPORT_WRITERS = {"csv": CsvExportWriter, "parquet": ParquetExportWriter, "xlsx": XlsxExportWriter}
+
+def export_path(job):
+    return EXPORT_DIR / f"{job['id']}.{job['format']}"
+
+def export_part_path(job):
+    """Scratch file for one claim, so a worker that lost its job never writes over the new owner's file."""
+    path = export_path(job)
+    return path.with_name(f"{path.name}.{job['claim_id']}.part")
+
+async def count_attendance_rows(batch_id=None, start_date=None, end_date=None):
+    result = await db.sessions.aggregate([
+        {"$match": session_query(batch_id, start_date, end_date)},
+        {"$lookup": {"from": "attendance", "localField": "id", "foreignField": "session_id", "as": "att"}},
+        {"$group": {"_id": None, "n": {"$sum": {"$size": "$att"}}}},
+    ]).to_list(1)
+    return result[0]["n"] if result else 0
+
+async def report_export_progress(job, fields):
+    """Record progress under this worker's claim; fails the run if the job was reclaimed meanwhile."""
+    res = await db.export_jobs.update_one({"id": job["id"], "claim_id": job["claim_id"]}, {"$set": fields})
+    if res.matched_count == 0:
+        raise RuntimeError("Export job was claimed by another worker")
+
+async def run_export_job(job):
+    filters = job["filters"]
+    total = await count_attendance_rows(**filters)
+    await report_export_progress(job, {"total_rows": total})
+    EXPORT_DIR.mkdir(parents=True, exist_ok=True)
+    part = export_part_path(job)
+    writer = await asyncio.to_thread(EXPORT_WRITERS[job["format"]], part)
+    written, chunk = 0, []
+    try:
+        async for row in attendance_export_rows(**filters):
+            chunk.append(row)
+            if len(chunk) < EXPORT_CHUNK_ROWS:
+                continue
+            await asyncio.to_thread(writer.write, chunk)
+            written += len(chunk)
+            chunk = []
+            await report_export_progress(job, {"rows_written": written})
+        if chunk:
+            await asyncio.to_thread(writer.write, chunk)
+            written += len(chunk)
+    finally:
+        await asyncio.to_thread(writer.close)
+    await report_export_progress(job, {"rows_written": written})
+    os.replace(part, export_path(job))
+    return written
+
+async def export_heartbeat(job):
+    """Keep a claimed job's heartbeat fresh for as long as it runs, counting phase included."""
+    while True:
+        await asyncio.sleep(EXPORT_HEARTBEAT_SECONDS)
+        try:
+            await db.export_jobs.update_one({"id": job["id"], "claim_id": job["claim_id"]},
+                                            {"$set": {"heartbeat_at": datetime.now(timezone.utc)}})
+        except PyMongoError:
+            logger.warning("Export job %s heartbeat failed", job["id"], exc_info=True)
+
+async def claim_export_job():
+    now = datetime.now(timezone.utc)
+    return await db.export_jobs.find_one_and_update(
+        {"$or": [{"status": "queued"},
+                 {"status": "running", "heartbeat_at": {"$lt": now - timedelta(seconds=EXPORT_STALE_SECONDS)}}]},
+        {"$set": {"status": "running", "worker_id": WORKER_ID, "claim_id": str(uuid.uuid4()),
+                  "started_at": now, "heartbeat_at": now}},
+        sort=[("created_at", 1)], projection={"_id": 0}, return_document=ReturnDocument.AFTER)
+
+async def export_worker():
+    while True:
+        try:
+            job = await claim_export_job()
+        except PyMongoError:
+            logger.exception("Claiming an export job failed")
+            job = None
+        if job is None:
+            export_jobs_pending.clear()
+            try:
+                await asyncio.wait_for(export_jobs_pending.wait(), EXPORT_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        heartbeat = asyncio.create_task(export_heartbeat(job))
+        try:
+            written = await run_export_job(job)
+            update = {"status": "done", "rows_written": written}
+        except Exception as e:
+            logger.exception("Export job %s failed", job["id"])
+            export_part_path(job).unlink(missing_ok=True)
+            update = {"status": "failed", "error": str(e)}
+        finally:
+            heartbeat.cancel()
+        now = datetime.now(timezone.utc)
+        try:
+            await db.export_jobs.update_one({"id": job["id"], "claim_id": job["claim_id"]}, {"$set": {
+                **update, "finished_at": now, "expires_at": now + timedelta(hours=EXPORT_RETENTION_HOURS)}})
+        except Exception:
+            # The job stays claimed until its heartbeat goes stale, then another worker runs it again
+            logger.exception("Recording the outcome of export job %s failed", job["id"])
+
+async def export_cleanup_job():
+    while True:
+        try:
+            expired = await db.export_jobs.find(
+                {"expires_at": {"$lt": datetime.now(timezone.utc)}}, {"_id": 0}).to_list(None)
+            for job in expired:
+                export_path(job).unlink(missing_ok=True)
+            if expired:
+                await db.export_jobs.delete_many({"id": {"$in": [j["id"] for j in expired]}})
+        except Exception:
+            logger.exception("Export cleanup failed")
+        await asyncio.sleep(3600)
+
+def export_job_view(job):
+    total, written = job.get("total_rows"), job.get("rows_written", 0)
+    progress = 1.0 if job["status"] == "done" else (min(written / total, 1.0) if total else 0.0)
+    return {**job, "progress": round(progress, 3)}
+
+@api_router.post("/exports")
+async def create_export_job(data: ExportJobReq, user=Depends(get_current_user)):
+    require_admin(user)
+    if data.format not in EXPORT_FORMATS:
+        raise HTTPException(400, f"Unsupported format: {data.format}")
+    module = EXPORT_FORMATS[data.format][0]
+    if module and importlib.util.find_spec(module) is None:
+        raise HTTPException(400, f"{data.format} export requires {module}, which is not installed")
+    job = {
+        "id": str(uuid.uuid4()), "format": data.format, "status": "queued", "rows_written": 0, "total_rows": None,
+        "filters": {"batch_id": data.batch_id, "start_date": data.start_date, "end_date": data.end_date},
+        "created_by": user["id"], "created_at": datetime.now(timezone.utc),
+    }
+    await db.export_jobs.insert_one({**job})
+    export_jobs_pending.set()
+    await audit_log(user["id"], "create_export", "export", job["id"], {"format": data.format, **job["filters"]})
+    return export_job_view(job)
+
+@api_router.get("/exports")
+async def list_export_jobs(user=Depends(get_current_user)):
+    require_admin(user)
+    jobs = await db.export_jobs.find({}, {"_id": 0}).sort("created_at", -1).to_list(50)
+    return [export_job_view(j) for j in jobs]
+
+@api_router.get("/exports/{job_id}")
+async def get_export_job(job_id: str, user=Depends(get_current_user)):
+    require_admin(user)
+    job = await db.export_jobs.find_one({"id": job_id}, {"_id": 0})
+    if not job:
+        raise HTTPException(404, "Export not found")
+    return export_job_view(job)
+
+@api_router.get("/exports/{job_id}/download")
+async def download_export(job_id: str, user=Depends(get_current_user)):
+    require_admin(user)
+    job = await db.export_jobs.find_one({"id": job_id}, {"_id": 0})
+    if not job:
+        raise HTTPException(404, "Export not found")
+    if job["status"] != "done":
+        raise HTTPException(409, f"Export is {job['status']}")
+    path = export_path(job)
+    if not path.exists():
+        raise HTTPException(410, "Export file is no longer available")
+    return FileResponse(path, media_type=EXPORT_FORMATS[job["format"]][1],
+                        filename=f"attendance_report.{job['format']}")
+
 # ==================== SETTINGS ROUTES ====================
 @api_router.get("/settings")
 async def get_settings_route(user=Depends(get_current_user)):
@@ -737,8 +2682,10 @@ async def update_settings(data: dict, user=Depends(get_current_user)):
     if not updates:
         raise HTTPException(400, "Nothing to update")
     old = await get_settings()
-    await db.settings.update_one({"id": "global"}, {"$set": updates}, upsert=True)
-    await audit_log(user["id"], "update_settings", "settings", "global", {"before": old, "after": updates})
+    await db.settings.update_one({"id": "global"}, {"$set": updates, "$inc": {"version": 1}}, upsert=True)
+    invalidate_settings()
+    request_notifications_rebuild()
+    await audit_log(user["id"], "update_settings", "settings", "global", audit_diff(old, updates))
     return await get_settings()
 
 # ==================== DASHBOARD STATS ====================
@@ -748,9 +2695,8 @@ async def get_dashboard_stats(user=Depends(get_current_user)):
     if user["role"] == "admin":
         active_batches = await db.batches.count_documents({"active": True})
         total_dancers = await db.dancers.count_documents({"active": True})
-        passes = await db.passes.find({}, {"_id": 0}).to_list(10000)
-        expiring = sum(1 for p in passes if compute_pass_status(p, settings) == "expiring_soon")
-        expired = sum(1 for p in passes if compute_pass_status(p, settings) == "expired")
+        counts = await count_current_pass_statuses({}, settings)
+        expiring, expired = counts.get("expiring_soon", 0), counts.get("expired", 0)
         today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
         today_sessions = await db.sessions.count_documents({"date": today})
         return {"active_batches": active_batches, "total_dancers": total_dancers,
@@ -760,9 +2706,8 @@ async def get_dashboard_stats(user=Depends(get_current_user)):
         batch_ids = [b["id"] for b in batches]
         enrollments = await db.enrollments.find({"batch_id": {"$in": batch_ids}, "active": True}).to_list(5000)
         dancer_ids = list(set(e["dancer_id"] for e in enrollments))
-        passes = await db.passes.find({"batch_id": {"$in": batch_ids}}, {"_id": 0}).to_list(5000)
-        expiring = sum(1 for p in passes if compute_pass_status(p, settings) == "expiring_soon")
-        expired = sum(1 for p in passes if compute_pass_status(p, settings) == "expired")
+        counts = await count_current_pass_statuses({"batch_id": {"$in": batch_ids}}, settings)
+        expiring, expired = counts.get("expiring_soon", 0), counts.get("expired", 0)
         return {"active_batches": len(batches), "total_dancers": len(dancer_ids),
                 "expiring_soon": expiring, "expired": expired, "today_sessions": 0}
 
@@ -774,19 +2719,21 @@ async def seed_data():
         return {"message": "Already seeded"}
     now = datetime.now(timezone.utc)
 
+    admin_hash, inst1_hash, inst2_hash = await asyncio.gather(
+        password_hasher.hash("admin123"), password_hasher.hash("instructor123"), password_hasher.hash("instructor123"))
     admin_id = str(uuid.uuid4())
     await db.users.insert_one({"id": admin_id, "email": "admin@aya.dance",
-        "password_hash": pwd_context.hash("admin123"), "name": "AYA Admin",
+        "password_hash": admin_hash, "name": "AYA Admin",
         "role": "admin", "active": True, "created_at": now.isoformat()})
 
     inst1_id = str(uuid.uuid4())
     await db.users.insert_one({"id": inst1_id, "email": "prerrna@aya.dance",
-        "password_hash": pwd_context.hash("instructor123"), "name": "Prerrna",
+        "password_hash": inst1_hash, "name": "Prerrna",
         "role": "instructor", "active": True, "created_at": now.isoformat()})
 
     inst2_id = str(uuid.uuid4())
     await db.users.insert_one({"id": inst2_id, "email": "arjun@aya.dance",
-        "password_hash": pwd_context.hash("instructor123"), "name": "Arjun",
+        "password_hash": inst2_hash, "name": "Arjun",
         "role": "instructor", "active": True, "created_at": now.isoformat()})
 
     batch_id = str(uuid.uuid4())
@@ -805,66 +2752,249 @@ async def seed_data():
         did = str(uuid.uuid4())
         dancer_ids.append(did)
         await db.dancers.insert_one({"id": did, "full_name": name, "phone_number": phone,
-            "notes": "", "active": True, "created_at": now.isoformat()})
+            "notes": "", "active": True, "created_at": now.isoformat(), **new_attendance_stats(),
+            "search_keys": dancer_search_keys(name, phone)})
         await db.enrollments.insert_one({"id": str(uuid.uuid4()), "dancer_id": did,
             "batch_id": batch_id, "active": True, "join_date": now.isoformat(),
-            "created_at": now.isoformat()})
+            "created_at": now.isoformat(), **new_attendance_stats()})
 
     # Aisha: Monthly active
     await db.passes.insert_one({"id": str(uuid.uuid4()), "dancer_id": dancer_ids[0], "batch_id": batch_id,
-        "type": "monthly", "start_date": (now - timedelta(days=10)).isoformat(),
-        "end_date": (now + timedelta(days=20)).isoformat(), "status": "active",
+        "type": "monthly", "start_date": now - timedelta(days=10),
+        "end_date": now + timedelta(days=20), "status": "active",
         "created_at": now.isoformat(), "created_by": inst1_id})
     # Rohan: Class Pack 8, 5 remaining
     await db.passes.insert_one({"id": str(uuid.uuid4()), "dancer_id": dancer_ids[1], "batch_id": batch_id,
         "type": "class_pack", "total_classes": 8, "remaining_classes": 5,
-        "start_date": (now - timedelta(days=15)).isoformat(), "end_date": "",
+        "start_date": now - timedelta(days=15), "end_date": None,
         "status": "active", "created_at": now.isoformat(), "created_by": inst1_id})
     # Maya: Class Pack 8, 2 remaining (expiring soon)
     await db.passes.insert_one({"id": str(uuid.uuid4()), "dancer_id": dancer_ids[2], "batch_id": batch_id,
         "type": "class_pack", "total_classes": 8, "remaining_classes": 2,
-        "start_date": (now - timedelta(days=20)).isoformat(), "end_date": "",
+        "start_date": now - timedelta(days=20), "end_date": None,
         "status": "active", "created_at": now.isoformat(), "created_by": inst1_id})
     # Kiran: Monthly expired
     await db.passes.insert_one({"id": str(uuid.uuid4()), "dancer_id": dancer_ids[3], "batch_id": batch_id,
-        "type": "monthly", "start_date": (now - timedelta(days=40)).isoformat(),
-        "end_date": (now - timedelta(days=10)).isoformat(), "status": "expired",
+        "type": "monthly", "start_date": now - timedelta(days=40),
+        "end_date": now - timedelta(days=10), "status": "expired",
         "created_at": now.isoformat(), "created_by": inst1_id})
     # Dev: Drop-in unused
     await db.passes.insert_one({"id": str(uuid.uuid4()), "dancer_id": dancer_ids[4], "batch_id": batch_id,
         "type": "drop_in", "total_classes": 1, "remaining_classes": 1,
-        "session_id": "", "valid_date": now.strftime("%Y-%m-%d"),
+        "session_id": "", "valid_date": now.replace(hour=0, minute=0, second=0, microsecond=0),
         "status": "unused", "created_at": now.isoformat(), "created_by": inst1_id})
+    await refresh_current_passes(batch_id, dancer_ids)
+    request_notifications_rebuild()
 
     await db.settings.update_one({"id": "global"},
         {"$set": {"id": "global", "monthly_expiry_warning_days": 5, "class_pack_expiry_warning_remaining": 2}},
         upsert=True)
+    invalidate_settings()
+    await schedule_sessions()
 
     return {"message": "Seeded successfully", "admin": "admin@aya.dance / admin123",
             "instructor1": "prerrna@aya.dance / instructor123", "instructor2": "arjun@aya.dance / instructor123"}
 
+# ==================== MIGRATIONS ====================
+# Schema changes are applied by `python server.py migrate` (or by the first worker to boot a new release):
+# each pending data migration runs once, in version order, then the declared INDEXES are created if their
+# fingerprint changed. Progress is recorded in the `migrations` collection, so later boots only read it.
+# Indexes are never dropped automatically; `index-status` lists the ones no longer declared.
+INDEXES = {
+    "users": [
+        IndexModel("id", unique=True),
+        IndexModel("email", unique=True),                                   # login, create_user
+        IndexModel("role"),                                                 # GET /users
+    ],
+    "batches": [
+        IndexModel("id", unique=True),
+        IndexModel("active"),                                               # dashboard, notifications
+        IndexModel([("assigned_instructor_ids", 1), ("active", 1)]),        # instructor-scoped reads
+    ],
+    "dancers": [
+        IndexModel("id", unique=True),
+        IndexModel("active"),                                               # dashboard
+        IndexModel("search_keys"),                                          # GET /dancers?search
+        IndexModel([("full_name", 1), ("id", 1)]),                          # GET /dancers pages
+    ],
+    "enrollments": [
+        IndexModel("id", unique=True),
+        IndexModel([("dancer_id", 1), ("batch_id", 1), ("active", 1)]),     # enroll, dancer detail
+        IndexModel([("active", 1), ("batch_id", 1), ("total_sessions", 1)]),  # batch rosters, low attendance
+    ],
+    "passes": [
+        IndexModel("id", unique=True),
+        IndexModel([("dancer_id", 1), ("batch_id", 1), ("created_at", -1)]),  # pass history, fallback lookups
+        IndexModel([("batch_id", 1), ("created_at", -1)]),                  # GET /passes?batch_id
+        IndexModel([("type", 1), ("end_date", 1)]),                         # expiring report
+        IndexModel([("type", 1), ("remaining_classes", 1)]),
+    ],
+    "current_passes": [
+        IndexModel([("dancer_id", 1), ("batch_id", 1)], unique=True),
+        IndexModel([("batch_id", 1), ("dancer_id", 1)]),
+    ],
+    "sessions": [
+        IndexModel("id", unique=True),
+        IndexModel([("date", 1), ("batch_id", 1)]),                         # reports, dashboard
+        IndexModel([("batch_id", 1), ("date", 1)], unique=True),            # /sessions/today, scheduler
+        IndexModel([("batch_id", 1), ("date", -1), ("id", -1)]),            # GET /sessions
+    ],
+    "attendance": [
+        IndexModel("id", unique=True),
+        IndexModel([("session_id", 1), ("dancer_id", 1)], unique=True),     # marking, session detail
+        IndexModel([("dancer_id", 1), ("status", 1)]),                      # dancer stats
+    ],
+    "daily_attendance_rollups": [
+        IndexModel([("batch_id", 1), ("date", 1)], unique=True),
+        IndexModel([("date", 1), ("batch_id", 1)]),                         # attendance report
+    ],
+    "audit_log": [
+        IndexModel("id", unique=True),
+        *(IndexModel(keys) for keys in AUDIT_LOG_INDEXES),                  # GET /audit-log filters
+        IndexModel([("entity_type", 1), ("entity_id", 1), ("timestamp", -1)]),  # GET /audit-log/state
+    ],
+    "notifications": [
+        IndexModel([("scope", 1), ("id", 1), ("type", 1)], unique=True),
+        IndexModel([("scope", 1), ("dismissed", 1), ("rank", 1)]),          # GET /notifications
+        IndexModel("generated_at"),
+    ],
+    "attendance_sync_ops": [
+        IndexModel([("user_id", 1), ("id", 1)], unique=True),               # POST /attendance/sync replays
+        IndexModel("created_at", expireAfterSeconds=SYNC_OP_RETENTION_DAYS * 86400),
+    ],
+    "export_jobs": [
+        IndexModel("id", unique=True),
+        IndexModel([("status", 1), ("created_at", 1)]),                     # worker claims
+        IndexModel([("created_at", -1)]),                                   # GET /exports
+        IndexModel("expires_at"),                                           # cleanup
+    ],
+}
+MIGRATIONS = [
+    (1, "migrate-pass-dates", migrate_pass_dates),
+    (2, "rebuild-current-passes", rebuild_current_passes),
+    (3, "backfill-attendance-rollups", backfill_attendance_rollups),
+    (4, "reconcile-session-counters", reconcile_session_counters),
+    (5, "backfill-dancer-attendance-stats", backfill_dancer_attendance_stats),
+    (6, "backfill-dancer-search", lambda: backfill_dancer_search(missing_only=True)),
+    (7, "dedupe-sessions", dedupe_sessions),
+    (8, "dedupe-attendance", dedupe_attendance),
+    (9, "dedupe-current-passes", dedupe_current_passes),
+    (10, "add-dancer-search-words", backfill_dancer_search),
+    (11, "drop-unmarked-scheduled-sessions", drop_unmarked_scheduled_sessions),
+]
+AUTO_MIGRATE = os.environ.get("AUTO_MIGRATE", "1") == "1"
+MIGRATION_LEASE_SECONDS = int(os.environ.get("MIGRATION_LEASE_SECONDS", "600"))
+
+def index_fingerprint():
+    spec = {name: sorted(json.dumps(m.document, sort_keys=True) for m in models)
+            for name, models in INDEXES.items()}
+    return hashlib.sha256(json.dumps(spec, sort_keys=True).encode()).hexdigest()
+
+async def pending_migrations():
+    """(indexes_stale, [(version, name, fn), ...]) still to apply."""
+    done = {d["_id"]: d for d in await db.migrations.find({}).to_list(None)}
+    stale = done.get("indexes", {}).get("fingerprint") != index_fingerprint()
+    return stale, [m for m in MIGRATIONS if m[0] not in done]
+
+async def ensure_indexes():
+    await asyncio.gather(*(db[name].create_indexes(models) for name, models in INDEXES.items()))
+    await db.migrations.update_one({"_id": "indexes"}, {"$set": {
+        "fingerprint": index_fingerprint(), "applied_at": datetime.now(timezone.utc)}}, upsert=True)
+    logger.info("Indexes up to date")
+
+async def migrate():
+    """Apply pending migrations, then index changes, under the migrations lease.
+
+    Returns False without doing anything while another process holds the lease. The lease is renewed
+    in the background and checked between steps, since backfills can outlast MIGRATION_LEASE_SECONDS.
+    """
+    if not await acquire_lease("migrations", MIGRATION_LEASE_SECONDS):
+        logger.info("Another process is applying migrations")
+        return False
+    heartbeat = asyncio.create_task(hold_lease("migrations", MIGRATION_LEASE_SECONDS))
+    try:
+        # Data first: a migration may have to clean up documents before a new unique index can be built
+        stale, pending = await pending_migrations()
+        for version, name, fn in pending:
+            if not await acquire_lease("migrations", MIGRATION_LEASE_SECONDS):
+                logger.warning("Lost the migrations lease before migration %s %s; stopping", version, name)
+                return False
+            if await db.migrations.find_one({"_id": version}):
+                continue
+            logger.info("Applying migration %s %s", version, name)
+            await fn()
+            await db.migrations.update_one({"_id": version}, {"$set": {
+                "name": name, "applied_at": datetime.now(timezone.utc)}}, upsert=True)
+        if stale:
+            await ensure_indexes()
+    finally:
+        heartbeat.cancel()
+        await release_lease("migrations")
+    return True
+
+async def index_status():
+    """Log declared indexes that are missing and existing ones that are no longer declared."""
+    for name, models in INDEXES.items():
+        existing = {i["name"] async for i in db[name].list_indexes()} - {"_id_"}
+        declared = {m.document["name"] for m in models}
+        for missing in sorted(declared - existing):
+            logger.info("%s: missing %s", name, missing)
+        for extra in sorted(existing - declared):
+            logger.info("%s: undeclared %s", name, extra)
+
 # ==================== APP CONFIG ====================
-app.include_router(api_router)
+app.include_router(api_router, dependencies=[Depends(open_request_loaders)])
 app.add_middleware(
     CORSMiddleware, allow_credentials=True,
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
-    allow_methods=["*"], allow_headers=["*"],
+    allow_methods=["*"], allow_headers=["*"], expose_headers=["X-Next-Cursor", "X-Results-Truncated", "ETag"],
 )
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+background_tasks = []
 
 @app.on_event("startup")
 async def startup():
-    await db.users.create_index("id", unique=True)
-    await db.users.create_index("email", unique=True)
-    await db.batches.create_index("id", unique=True)
-    await db.dancers.create_index("id", unique=True)
-    await db.enrollments.create_index("id", unique=True)
-    await db.passes.create_index("id", unique=True)
-    await db.sessions.create_index("id", unique=True)
-    await db.attendance.create_index("id", unique=True)
-    await db.audit_log.create_index("id", unique=True)
-    logger.info("AYA Regulars Manager - Database indexes created")
+    stale, pending = await pending_migrations()
+    if stale or pending:
+        if AUTO_MIGRATE:
+            await migrate()
+        else:
+            logger.warning("Database schema is behind; run `python server.py migrate`")
+    audit_buffer.start()
+    background_tasks.append(asyncio.create_task(notifications_job()))
+    background_tasks.append(asyncio.create_task(watch_cache_invalidations()))
+    background_tasks.append(asyncio.create_task(audit_archive_job()))
+    background_tasks.append(asyncio.create_task(export_cleanup_job()))
+    background_tasks.append(asyncio.create_task(session_reconcile_job()))
+    background_tasks.append(asyncio.create_task(session_schedule_job()))
+    for _ in range(EXPORT_WORKERS):
+        background_tasks.append(asyncio.create_task(export_worker()))
 
 @app.on_event("shutdown")
 async def shutdown():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await audit_buffer.stop()
+    password_hasher.executor.shutdown(wait=False)
     client.close()
+
+# ==================== MAINTENANCE CLI ====================
+if __name__ == "__main__":
+    import argparse
+    commands = {
+        "migrate": migrate,
+        "index-status": index_status,
+        "migrate-pass-dates": migrate_pass_dates,
+        "archive-audit-log": audit_archive.run,
+        "backfill-attendance-rollups": backfill_attendance_rollups,
+        "reconcile-session-counters": reconcile_session_counters,
+        "backfill-dancer-attendance-stats": backfill_dancer_attendance_stats,
+        "backfill-dancer-search": backfill_dancer_search,
+        "schedule-sessions": schedule_sessions,
+    }
+    parser = argparse.ArgumentParser(description="AYA Regulars Manager maintenance commands")
+    parser.add_argument("command", choices=sorted(commands))
+    args = parser.parse_args()
+    asyncio.run(commands[args.command]())
+    logger.info("%s finished", args.command)
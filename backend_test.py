@@ -3,6 +3,8 @@
 import requests
 import sys
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 class AYABackendTester:
@@ -314,6 +316,169 @@ class AYABackendTester:
             self.log(f"✅ Today session created/retrieved: {response['date']}")
         return success
 
+    def test_concurrent_attendance(self):
+        """Stress pass consumption with concurrent, duplicate attendance submissions.
+
+        Run against a local deployment backed by a replica set; the check is that a
+        class pack is charged exactly once however many requests race each other.
+        """
+        if not self.instructor_token:
+            return False
+
+        headers = {"Authorization": f"Bearer {self.instructor_token}"}
+        success, batches = self.run_test("Get Batches for Concurrency", "GET", "/batches", 200, headers=headers)
+        if not success or not batches:
+            return False
+        batch_id = batches[0]['id']
+        success, session = self.run_test("Get Session for Concurrency", "GET", "/sessions/today", 200,
+                                         data={"batch_id": batch_id}, headers=headers)
+        if not success:
+            return False
+        success, dancer = self.run_test("Create Stress Dancer", "POST", "/dancers", 200,
+                                        data={"full_name": f"Stress Dancer {datetime.now().strftime('%H%M%S')}",
+                                              "batch_id": batch_id}, headers=headers)
+        if not success:
+            return False
+        success, pass_doc = self.run_test("Create Stress Class Pack", "POST", "/passes", 200,
+                                          data={"dancer_id": dancer['id'], "batch_id": batch_id,
+                                                "type": "class_pack", "total_classes": 5}, headers=headers)
+        if not success:
+            return False
+
+        url = f"{self.base_url}/api/attendance/bulk"
+        test_headers = {'Content-Type': 'application/json', **headers}
+
+        def mark(status):
+            body = {"session_id": session['id'], "batch_id": batch_id,
+                    "records": [{"dancer_id": dancer['id'], "status": status}]}
+            return requests.post(url, json=body, headers=test_headers, timeout=30).status_code
+
+        def remaining():
+            r = requests.get(f"{self.base_url}/api/passes", params={"dancer_id": dancer['id']},
+                             headers=test_headers, timeout=30)
+            return next(p['remaining_classes'] for p in r.json() if p['id'] == pass_doc['id'])
+
+        self.tests_run += 1
+        with ThreadPoolExecutor(max_workers=20) as pool:
+            codes = list(pool.map(mark, ["present"] * 20))
+        if remaining() != 4:
+            self.log(f"❌ Concurrent present marks charged the pack {5 - remaining()} times ({codes})")
+            return False
+
+        with ThreadPoolExecutor(max_workers=20) as pool:
+            codes = list(pool.map(mark, ["absent", "present"] * 15))
+        mark("absent")
+        if remaining() != 5:
+            self.log(f"❌ Pack not restored after concurrent toggles: {remaining()} remaining ({codes})")
+            return False
+        self.tests_passed += 1
+        self.log("✅ Concurrent attendance charged the class pack exactly once")
+        return True
+
+    def test_export_job(self):
+        """Test background CSV export: queue, poll progress, download"""
+        if not self.admin_token:
+            return False
+
+        headers = {"Authorization": f"Bearer {self.admin_token}"}
+        success, job = self.run_test("Create Export Job", "POST", "/exports", 200, data={"format": "csv"}, headers=headers)
+        if not success:
+            return False
+
+        for _ in range(30):
+            success, job = self.run_test("Poll Export Job", "GET", f"/exports/{job['id']}", 200, headers=headers)
+            if not success or job["status"] in ("done", "failed"):
+                break
+            time.sleep(1)
+        if job.get("status") != "done":
+            self.log(f"❌ Export job did not finish: {job}")
+            return False
+
+        response = requests.get(f"{self.base_url}/api/exports/{job['id']}/download", headers=headers, timeout=30)
+        self.tests_run += 1
+        if response.status_code == 200 and response.text.startswith("Date,Batch,Dancer"):
+            self.tests_passed += 1
+            self.log(f"✅ Downloaded export with {job['rows_written']} rows")
+            return True
+        self.log(f"❌ Export download failed - Status: {response.status_code}")
+        return False
+
+    def test_batch_roster(self):
+        """Test the one-request attendance roster and its ETag revalidation"""
+        if not self.instructor_token:
+            return False
+
+        headers = {"Authorization": f"Bearer {self.instructor_token}"}
+        success, batches = self.run_test("Get Batches for Roster", "GET", "/batches", 200, headers=headers)
+        if not success or not batches:
+            return False
+
+        url = f"{self.base_url}/api/batches/{batches[0]['id']}/roster"
+        response = requests.get(url, headers=headers, timeout=30)
+        self.tests_run += 1
+        roster = response.json() if response.status_code == 200 else {}
+        if not {"batch", "session", "dancers", "attendance"} <= set(roster) or not response.headers.get("ETag"):
+            self.log(f"❌ Roster - Status: {response.status_code}")
+            return False
+        self.tests_passed += 1
+        self.log(f"✅ Roster with {len(roster['dancers'])} dancers for {roster['session']['date']}")
+
+        response = requests.get(url, headers={**headers, "If-None-Match": response.headers["ETag"]}, timeout=30)
+        self.tests_run += 1
+        if response.status_code == 304:
+            self.tests_passed += 1
+            self.log("✅ Unchanged roster revalidated with 304")
+            return True
+        self.log(f"❌ Roster revalidation - Expected 304, got {response.status_code}")
+        return False
+
+    def test_attendance_sync(self):
+        """Test offline attendance sync: a retried delta is acknowledged without being applied twice"""
+        if not self.instructor_token:
+            return False
+
+        headers = {"Authorization": f"Bearer {self.instructor_token}"}
+        success, batches = self.run_test("Get Batches for Sync", "GET", "/batches", 200, headers=headers)
+        if not success or not batches:
+            return False
+        batch_id = batches[0]['id']
+        success, session = self.run_test("Get Session for Sync", "GET", "/sessions/today", 200,
+                                         data={"batch_id": batch_id}, headers=headers)
+        if not success:
+            return False
+        success, dancer = self.run_test("Create Sync Dancer", "POST", "/dancers", 200,
+                                        data={"full_name": f"Sync Dancer {datetime.now().strftime('%H%M%S')}",
+                                              "batch_id": batch_id}, headers=headers)
+        if not success:
+            return False
+        success, pass_doc = self.run_test("Create Sync Class Pack", "POST", "/passes", 200,
+                                          data={"dancer_id": dancer['id'], "batch_id": batch_id,
+                                                "type": "class_pack", "total_classes": 5}, headers=headers)
+        if not success:
+            return False
+
+        delta = {"id": f"sync-{dancer['id']}", "dancer_id": dancer['id'], "status": "present",
+                 "client_timestamp": datetime.utcnow().isoformat() + "Z"}
+        body = {"session_id": session['id'], "batch_id": batch_id, "deltas": [delta]}
+        success, first = self.run_test("Sync Attendance", "POST", "/attendance/sync", 200, data=body, headers=headers)
+        if not success:
+            return False
+        success, retry = self.run_test("Retry Sync Attendance", "POST", "/attendance/sync", 200,
+                                       data={**body, "cursor": first["cursor"]}, headers=headers)
+        if not success:
+            return False
+
+        success, passes = self.run_test("Get Sync Dancer Passes", "GET", "/passes", 200,
+                                        data={"dancer_id": dancer['id']}, headers=headers)
+        remaining = next((p["remaining_classes"] for p in passes if p["id"] == pass_doc["id"]), None)
+        self.tests_run += 1
+        if retry["results"][0]["outcome"] == "applied" and remaining == 4:
+            self.tests_passed += 1
+            self.log("✅ Retried sync delta charged the class pack once")
+            return True
+        self.log(f"❌ Retried sync - outcome {retry['results']}, remaining {remaining}")
+        return False
+
     def run_all_tests(self):
         """Run all backend tests"""
         self.log("🚀 Starting AYA Regulars Manager Backend Tests")
@@ -333,6 +498,10 @@ class AYABackendTester:
             self.test_settings,
             self.test_instructor_batches,
             self.test_today_session,
+            self.test_concurrent_attendance,
+            self.test_export_job,
+            self.test_batch_roster,
+            self.test_attendance_sync,
         ]
         
         self.log(f"\n📋 Running {len(tests)} backend tests...\n")
@@ -15,34 +15,47 @@ const ACTION_TYPES = [
   "create_pass", "renew_pass", "mark_attendance",
   "create_batch", "update_batch", "deactivate_batch",
   "create_instructor", "update_instructor", "deactivate_instructor",
-  "update_settings"
+  "update_settings", "create_export"
 ];
 
 export default function AuditLogPage() {
   const [logs, setLogs] = useState([]);
   const [total, setTotal] = useState(0);
   const [page, setPage] = useState(1);
+  // cursors[i] is the continuation token that loads page i + 1
+  const [cursors, setCursors] = useState([null]);
   const [filters, setFilters] = useState({ action_type: "", start_date: "", end_date: "" });
   const [detailLog, setDetailLog] = useState(null);
   const limit = 20;
 
   const load = () => {
-    const params = { page, limit };
+    const params = { limit };
+    if (cursors[page - 1]) params.cursor = cursors[page - 1];
+    if (page === 1) params.include_total = true;
     if (filters.action_type) params.action_type = filters.action_type;
     if (filters.start_date) params.start_date = filters.start_date;
     if (filters.end_date) params.end_date = filters.end_date;
     api.get("/audit-log", { params }).then((r) => {
       setLogs(r.data.logs);
-      setTotal(r.data.total);
+      if (r.data.total !== null) setTotal(r.data.total);
+      setCursors((prev) => [...prev.slice(0, page), r.data.next_cursor]);
     }).catch(() => {});
   };
   useEffect(load, [page, filters]);
 
+  const changeFilters = (next) => {
+    setFilters(next);
+    setCursors([null]);
+    setPage(1);
+  };
+
   const formatDate = (iso) => {
     if (!iso) return "-";
     try { return new Date(iso).toLocaleString(); } catch { return iso; }
   };
 
+  const formatValue = (v) => (v === null || v === undefined ? "-" : typeof v === "object" ? JSON.stringify(v) : String(v));
+
   return (
     <div className="space-y-6" data-testid="audit-log-page">
       <div>
@@ -51,7 +64,7 @@ export default function AuditLogPage() {
       </div>
 
       <div className="flex flex-wrap gap-3">
-        <Select value={filters.action_type} onValueChange={(v) => { setFilters({ ...filters, action_type: v === "all" ? "" : v }); setPage(1); }}>
+        <Select value={filters.action_type} onValueChange={(v) => changeFilters({ ...filters, action_type: v === "all" ? "" : v })}>
           <SelectTrigger data-testid="audit-filter-action" className="w-48 rounded-xl h-10">
             <SelectValue placeholder="All actions" />
           </SelectTrigger>
@@ -60,8 +73,8 @@ export default function AuditLogPage() {
             {ACTION_TYPES.map((a) => <SelectItem key={a} value={a}>{a.replace(/_/g, " ")}</SelectItem>)}
           </SelectContent>
         </Select>
-        <Input type="date" data-testid="audit-filter-start" value={filters.start_date} onChange={(e) => { setFilters({ ...filters, start_date: e.target.value }); setPage(1); }} className="w-40 rounded-xl h-10" />
-        <Input type="date" data-testid="audit-filter-end" value={filters.end_date} onChange={(e) => { setFilters({ ...filters, end_date: e.target.value }); setPage(1); }} className="w-40 rounded-xl h-10" />
+        <Input type="date" data-testid="audit-filter-start" value={filters.start_date} onChange={(e) => changeFilters({ ...filters, start_date: e.target.value })} className="w-40 rounded-xl h-10" />
+        <Input type="date" data-testid="audit-filter-end" value={filters.end_date} onChange={(e) => changeFilters({ ...filters, end_date: e.target.value })} className="w-40 rounded-xl h-10" />
       </div>
 
       <Card className="rounded-2xl border-border/50 overflow-hidden">
@@ -102,7 +115,7 @@ export default function AuditLogPage() {
             <ChevronLeft className="h-4 w-4" />
           </Button>
           <span className="text-sm py-1.5">Page {page}</span>
-          <Button variant="outline" size="sm" className="rounded-full" disabled={page * limit >= total} onClick={() => setPage(page + 1)}>
+          <Button variant="outline" size="sm" className="rounded-full" disabled={!cursors[page]} onClick={() => setPage(page + 1)}>
             <ChevronRight className="h-4 w-4" />
           </Button>
         </div>
@@ -119,6 +132,27 @@ export default function AuditLogPage() {
                 <div><span className="text-muted-foreground">Entity:</span> <span className="font-medium">{detailLog.entity_type}</span></div>
                 <div><span className="text-muted-foreground">Time:</span> <span className="font-medium">{formatDate(detailLog.timestamp)}</span></div>
               </div>
+              {detailLog.metadata?.after && (
+                <div>
+                  <h4 className="font-medium mb-2">Changes</h4>
+                  <Table>
+                    <TableHeader><TableRow>
+                      <TableHead>Field</TableHead>
+                      <TableHead>Before</TableHead>
+                      <TableHead>After</TableHead>
+                    </TableRow></TableHeader>
+                    <TableBody>
+                      {Object.keys(detailLog.metadata.after).map((field) => (
+                        <TableRow key={field}>
+                          <TableCell className="text-xs font-medium">{field.replace(/_/g, " ")}</TableCell>
+                          <TableCell className="text-xs text-muted-foreground">{formatValue(detailLog.metadata.before?.[field])}</TableCell>
+                          <TableCell className="text-xs">{formatValue(detailLog.metadata.after[field])}</TableCell>
+                        </TableRow>
+                      ))}
+                    </TableBody>
+                  </Table>
+                </div>
+              )}
               {detailLog.metadata && Object.keys(detailLog.metadata).length > 0 && (
                 <div>
                   <h4 className="font-medium mb-2">Details</h4>
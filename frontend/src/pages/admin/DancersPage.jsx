@@ -13,16 +13,24 @@ export default function DancersPage() {
   const [search, setSearch] = useState("");
   const [selected, setSelected] = useState(null);
   const [detailOpen, setDetailOpen] = useState(false);
+  const [nextCursor, setNextCursor] = useState(null);
+  const [truncated, setTruncated] = useState(false);
 
-  const loadDancers = () => {
-    api.get("/dancers", { params: { search: search || undefined } }).then((r) => setDancers(r.data)).catch(() => {});
+  const loadDancers = (cursor) => {
+    const params = { search: search || undefined, include: "passes,stats", fields: "id,full_name,phone_number", limit: 50 };
+    if (cursor) params.cursor = cursor;
+    api.get("/dancers", { params }).then((r) => {
+      setDancers((prev) => (cursor ? [...prev, ...r.data] : r.data));
+      setNextCursor(r.headers["x-next-cursor"] || null);
+      setTruncated(r.headers["x-results-truncated"] === "true");
+    }).catch(() => {});
   };
   // reload whenever the search term changes
-  useEffect(loadDancers, [search]);
+  useEffect(() => { loadDancers(null); }, [search]);
 
   const handleSearch = (e) => {
     e.preventDefault();
-    loadDancers();
+    loadDancers(null);
   };
 
   const openDetail = (d) => {
@@ -102,6 +110,16 @@ export default function DancersPage() {
           </Table>
         </Card>
       )}
+      {truncated && (
+        <p className="text-sm text-muted-foreground text-center" data-testid="dancers-search-truncated">
+          Showing the top {dancers.length} matches. Refine your search to find others.
+        </p>
+      )}
+      {nextCursor && (
+        <Button variant="outline" className="w-full rounded-full" onClick={() => loadDancers(nextCursor)} data-testid="load-more-dancers">
+          Load more
+        </Button>
+      )}
 
       <Dialog open={detailOpen} onOpenChange={setDetailOpen}>
         <DialogContent className="rounded-2xl max-w-md">
@@ -115,6 +133,7 @@ export default function DancersPage() {
                 <div><span className="text-muted-foreground">Status:</span> <span className="font-medium">{selected.active ? "Active" : "Inactive"}</span></div>
                 <div><span className="text-muted-foreground">Sessions:</span> <span className="font-medium">{selected.total_sessions}</span></div>
                 <div><span className="text-muted-foreground">Present:</span> <span className="font-medium">{selected.present_count}</span></div>
+                <div><span className="text-muted-foreground">Last attended:</span> <span className="font-medium">{selected.last_attended_date || "-"}</span></div>
               </div>
               {selected.notes && <div><span className="text-muted-foreground">Notes:</span> <p>{selected.notes}</p></div>}
               <div>
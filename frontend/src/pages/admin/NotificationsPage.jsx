@@ -2,7 +2,8 @@ import { useEffect, useState } from "react";
 import api from "@/lib/api";
 import { Card, CardContent } from "@/components/ui/card";
 import { Badge } from "@/components/ui/badge";
-import { Bell, AlertCircle, Clock } from "lucide-react";
+import { Button } from "@/components/ui/button";
+import { Bell, AlertCircle, Clock, X } from "lucide-react";
 
 export default function NotificationsPage() {
   const [notifications, setNotifications] = useState([]);
@@ -11,6 +12,11 @@ export default function NotificationsPage() {
     api.get("/notifications").then((r) => setNotifications(r.data)).catch(() => {});
   }, []);
 
+  const dismiss = (id) => {
+    api.put(`/notifications/${id}/dismiss`).catch(() => {});
+    setNotifications((prev) => prev.filter((n) => n.id !== id));
+  };
+
   return (
     <div className="space-y-6" data-testid="notifications-page">
       <div>
@@ -49,6 +55,9 @@ export default function NotificationsPage() {
                   <p className="text-xs text-muted-foreground">{n.batch_name}</p>
                   <p className="text-[10px] text-muted-foreground/60 uppercase">{n.pass_type?.replace("_", " ")}</p>
                 </div>
+                <Button variant="ghost" size="icon" className="h-8 w-8 rounded-full shrink-0" onClick={() => dismiss(n.id)} data-testid={`dismiss-notification-${n.id}`}>
+                  <X className="h-4 w-4" />
+                </Button>
               </CardContent>
             </Card>
           ))}
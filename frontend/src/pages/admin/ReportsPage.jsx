@@ -17,6 +17,9 @@ export default function ReportsPage() {
   const [endDate, setEndDate] = useState("");
   const [attReport, setAttReport] = useState([]);
   const [expiringReport, setExpiringReport] = useState({ expiring: [], expired: [] });
+  const [lowAttendance, setLowAttendance] = useState([]);
+  const [exportFormat, setExportFormat] = useState("csv");
+  const [exportJobs, setExportJobs] = useState([]);
 
   useEffect(() => {
     api.get("/batches").then((r) => setBatches(r.data)).catch(() => {});
@@ -29,6 +32,7 @@ export default function ReportsPage() {
     if (startDate) params.start_date = startDate;
     if (endDate) params.end_date = endDate;
     api.get("/reports/attendance", { params }).then((r) => setAttReport(r.data)).catch(() => {});
+    api.get("/reports/low-attendance", { params: batchId ? { batch_id: batchId } : {} }).then((r) => setLowAttendance(r.data)).catch(() => {});
   };
   useEffect(loadAttendance, [batchId, startDate, endDate]);
 
@@ -50,6 +54,42 @@ export default function ReportsPage() {
     }
   };
 
+  const loadExports = () => api.get("/exports").then((r) => setExportJobs(r.data)).catch(() => {});
+  useEffect(() => { loadExports(); }, []);
+  const exportsRunning = exportJobs.some((j) => j.status === "queued" || j.status === "running");
+  useEffect(() => {
+    if (!exportsRunning) return undefined;
+    const timer = setInterval(loadExports, 2000);
+    return () => clearInterval(timer);
+  }, [exportsRunning]);
+
+  const handleExportJob = async () => {
+    try {
+      const body = { format: exportFormat };
+      if (batchId) body.batch_id = batchId;
+      if (startDate) body.start_date = startDate;
+      if (endDate) body.end_date = endDate;
+      await api.post("/exports", body);
+      toast.success("Export started");
+      loadExports();
+    } catch (e) {
+      toast.error(e.response?.data?.detail || "Export failed");
+    }
+  };
+
+  const downloadExport = async (job) => {
+    try {
+      const res = await api.get(`/exports/${job.id}/download`, { responseType: "blob" });
+      const url = window.URL.createObjectURL(new Blob([res.data]));
+      const a = document.createElement("a");
+      a.href = url;
+      a.download = `attendance_report.${job.format}`;
+      a.click();
+    } catch {
+      toast.error("Download failed");
+    }
+  };
+
   const chartData = attReport.flatMap((b) =>
     b.sessions.map((s) => ({ date: s.date, present: s.present, absent: s.absent }))
   ).sort((a, b) => a.date.localeCompare(b.date));
@@ -76,8 +116,46 @@ export default function ReportsPage() {
         </Select>
         <Input type="date" value={startDate} onChange={(e) => setStartDate(e.target.value)} className="w-40 rounded-xl h-10" />
         <Input type="date" value={endDate} onChange={(e) => setEndDate(e.target.value)} className="w-40 rounded-xl h-10" />
+        <Select value={exportFormat} onValueChange={setExportFormat}>
+          <SelectTrigger data-testid="export-format" className="w-32 rounded-xl h-10"><SelectValue /></SelectTrigger>
+          <SelectContent>
+            <SelectItem value="csv">CSV</SelectItem>
+            <SelectItem value="parquet">Parquet</SelectItem>
+            <SelectItem value="xlsx">Excel</SelectItem>
+          </SelectContent>
+        </Select>
+        <Button data-testid="export-job-button" onClick={handleExportJob} variant="outline" className="rounded-full h-10 px-6">
+          Background export
+        </Button>
       </div>
 
+      {exportJobs.length > 0 && (
+        <Card className="rounded-2xl border-border/50">
+          <CardHeader><CardTitle className="font-heading text-lg">Exports</CardTitle></CardHeader>
+          <CardContent>
+            <div className="space-y-2">
+              {exportJobs.map((j) => (
+                <div key={j.id} className="flex items-center justify-between py-2 border-b border-border last:border-0" data-testid={`export-job-${j.id}`}>
+                  <div>
+                    <p className="text-sm font-medium">{j.format.toUpperCase()} - {j.filters.start_date || "start"} to {j.filters.end_date || "today"}</p>
+                    <p className="text-xs text-muted-foreground">{j.status === "failed" ? j.error : `${j.rows_written} rows`}</p>
+                  </div>
+                  {j.status === "done" ? (
+                    <Button variant="ghost" size="sm" className="rounded-full" onClick={() => downloadExport(j)}>
+                      <Download className="h-4 w-4" />
+                    </Button>
+                  ) : (
+                    <Badge variant="outline" className="rounded-full text-xs">
+                      {j.status === "running" ? `${Math.round(j.progress * 100)}%` : j.status}
+                    </Badge>
+                  )}
+                </div>
+              ))}
+            </div>
+          </CardContent>
+        </Card>
+      )}
+
       {/* Chart */}
       {chartData.length > 0 && (
         <Card className="rounded-2xl border-border/50">
@@ -109,6 +187,28 @@ export default function ReportsPage() {
         </Card>
       ))}
 
+      {/* Low attendance */}
+      {lowAttendance.length > 0 && (
+        <Card className="rounded-2xl border-border/50">
+          <CardHeader><CardTitle className="font-heading text-lg">Low Attendance</CardTitle></CardHeader>
+          <CardContent>
+            <div className="space-y-2">
+              {lowAttendance.map((e) => (
+                <div key={e.enrollment_id} className="flex items-center justify-between py-2 border-b border-border last:border-0" data-testid={`low-attendance-${e.enrollment_id}`}>
+                  <div>
+                    <p className="text-sm font-medium">{e.dancer_name}</p>
+                    <p className="text-xs text-muted-foreground">{e.batch_name} - last attended {e.last_attended_date || "never"}</p>
+                  </div>
+                  <Badge variant="outline" className="rounded-full text-xs">
+                    {e.present_count}/{e.total_sessions} ({Math.round(e.attendance_rate * 100)}%)
+                  </Badge>
+                </div>
+              ))}
+            </div>
+          </CardContent>
+        </Card>
+      )}
+
       {/* Expiring / Expired */}
       <div className="grid md:grid-cols-2 gap-6">
         <Card className="rounded-2xl border-border/50">
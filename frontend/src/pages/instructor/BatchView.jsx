@@ -1,4 +1,4 @@
-import { useEffect, useState, useCallback } from "react";
+import { useEffect, useState, useCallback, useRef } from "react";
 import { useParams, useNavigate } from "react-router-dom";
 import api from "@/lib/api";
 import { Tabs, TabsContent, TabsList, TabsTrigger } from "@/components/ui/tabs";
@@ -31,10 +31,39 @@ function PassBadge({ pass }) {
   );
 }
 
+/* ============== OFFLINE ATTENDANCE QUEUE ============== */
+// Saved marks stay queued in localStorage, one key per session, until /attendance/sync acknowledges them.
+// Each delta keeps its id across retries, so a save whose response was lost is recognised by the server and
+// not applied twice. Queues left from other sessions (an earlier class taken offline) are flushed too.
+const QUEUE_PREFIX = "aya-attendance-queue-";
+const queueKey = (sessionId) => `${QUEUE_PREFIX}${sessionId}`;
+const queuedSessionIds = () =>
+  Object.keys(localStorage).filter((k) => k.startsWith(QUEUE_PREFIX)).map((k) => k.slice(QUEUE_PREFIX.length));
+const readQueue = (sessionId) => JSON.parse(localStorage.getItem(queueKey(sessionId)) || "[]");
+const writeQueue = (sessionId, deltas) => {
+  if (deltas.length) localStorage.setItem(queueKey(sessionId), JSON.stringify(deltas));
+  else localStorage.removeItem(queueKey(sessionId));
+};
+const newDeltaId = () =>
+  (window.crypto?.randomUUID ? window.crypto.randomUUID() : `${Date.now()}-${Math.random().toString(36).slice(2)}`);
+
+// Sends one session's queue and drops only the deltas the server acknowledged, so marks queued while the
+// request was in flight wait for the next flush.
+const syncSession = async (sessionId, cursor) => {
+  const queue = readQueue(sessionId);
+  if (!queue.length) return null;
+  const res = await api.post("/attendance/sync", {
+    session_id: sessionId, batch_id: queue[0].batch_id, cursor,
+    deltas: queue.map(({ batch_id, ...delta }) => delta),
+  });
+  const acked = new Set(res.data.results.map((r) => r.id));
+  writeQueue(sessionId, readQueue(sessionId).filter((d) => !acked.has(d.id)));
+  return res;
+};
+
 /* ============== TODAY TAB (Attendance) ============== */
-function TodayTab({ batchId, batch }) {
-  const [session, setSession] = useState(null);
-  const [dancers, setDancers] = useState([]);
+function TodayTab({ batchId, roster, reload }) {
+  const { session, dancers } = roster;
   const [attendance, setAttendance] = useState({});
   const [searchQ, setSearchQ] = useState("");
   const [filter, setFilter] = useState("all");
@@ -43,25 +72,64 @@ function TodayTab({ batchId, batch }) {
   const [warnings, setWarnings] = useState([]);
   const [dropinOpen, setDropinOpen] = useState(false);
   const [dropinForm, setDropinForm] = useState({ full_name: "", phone_number: "" });
+  const [queued, setQueued] = useState(0);
+  // Marks to apply on top of the next roster, e.g. a drop-in added before the reload lands
+  const pendingMarks = useRef({});
+  // When each dancer was last tapped here, or marked on the server; sent so the latest mark wins
+  const markedAt = useRef({});
+  // Sync cursor for this session: each sync returns only the records changed since the previous one
+  const syncCursor = useRef(null);
 
-  const load = useCallback(async () => {
-    try {
-      const sRes = await api.get("/sessions/today", { params: { batch_id: batchId } });
-      setSession(sRes.data);
-      const dRes = await api.get("/dancers", { params: { batch_id: batchId } });
-      setDancers(dRes.data);
-      const aRes = await api.get("/attendance", { params: { session_id: sRes.data.id } });
-      const map = {};
-      aRes.data.forEach((a) => { map[a.dancer_id] = a.status; });
-      setAttendance(map);
-    } catch {
-      toast.error("Failed to load session");
+  useEffect(() => {
+    const map = {};
+    markedAt.current = {};
+    roster.attendance.forEach((a) => {
+      map[a.dancer_id] = a.status;
+      markedAt.current[a.dancer_id] = a.client_timestamp || a.timestamp;
+    });
+    setAttendance({ ...map, ...pendingMarks.current });
+    pendingMarks.current = {};
+    syncCursor.current = null;
+    setQueued(readQueue(roster.session.id).length);
+  }, [roster]);
+
+  // Server records newer than this device's last tap for a dancer win, unless a mark is still queued
+  const applyChanges = useCallback((changes) => {
+    const pending = new Set(readQueue(session.id).map((d) => d.dancer_id));
+    const updates = {};
+    changes.forEach((a) => {
+      const at = a.client_timestamp || a.timestamp;
+      const local = markedAt.current[a.dancer_id];
+      if (pending.has(a.dancer_id) || (local && Date.parse(local) > Date.parse(at))) return;
+      updates[a.dancer_id] = a.status;
+      markedAt.current[a.dancer_id] = at;
+    });
+    if (Object.keys(updates).length) setAttendance((prev) => ({ ...prev, ...updates }));
+  }, [session.id]);
+
+  const flushQueue = useCallback(async () => {
+    for (const sessionId of queuedSessionIds()) {
+      // Other sessions' queues stay put on failure and are retried on the next flush
+      if (sessionId !== session.id) await syncSession(sessionId).catch(() => {});
     }
-  }, [batchId]);
+    const res = await syncSession(session.id, syncCursor.current || undefined);
+    setQueued(readQueue(session.id).length);
+    if (res) {
+      syncCursor.current = res.data.cursor;
+      applyChanges(res.data.changes);
+    }
+    return res;
+  }, [session.id, applyChanges]);
 
-  useEffect(() => { load(); }, [load]);
+  useEffect(() => {
+    const onOnline = () => flushQueue().then((res) => { if (res) toast.success("Queued attendance synced"); }).catch(() => {});
+    window.addEventListener("online", onOnline);
+    if (navigator.onLine && queuedSessionIds().length) onOnline();
+    return () => window.removeEventListener("online", onOnline);
+  }, [flushQueue]);
 
   const toggle = (did) => {
+    markedAt.current[did] = new Date().toISOString();
     setAttendance((prev) => ({
       ...prev,
       [did]: prev[did] === "present" ? "absent" : "present",
@@ -70,28 +138,32 @@ function TodayTab({ batchId, batch }) {
 
   const markAllPresent = () => {
     const map = {};
-    dancers.forEach((d) => { map[d.id] = "present"; });
+    const now = new Date().toISOString();
+    dancers.forEach((d) => { map[d.id] = "present"; markedAt.current[d.id] = now; });
     setAttendance(map);
   };
 
   const saveAttendance = async () => {
     if (!session) return;
     setSaving(true);
+    const now = new Date().toISOString();
+    const deltas = dancers.map((d) => ({
+      id: newDeltaId(),
+      batch_id: batchId,
+      dancer_id: d.id,
+      status: attendance[d.id] || "absent",
+      client_timestamp: markedAt.current[d.id] || now,
+    }));
+    const queue = [...readQueue(session.id), ...deltas];
+    writeQueue(session.id, queue);
+    setQueued(queue.length);
     try {
-      const records = dancers.map((d) => ({
-        dancer_id: d.id,
-        status: attendance[d.id] || "absent",
-      }));
-      const res = await api.post("/attendance/bulk", {
-        session_id: session.id,
-        batch_id: batchId,
-        records,
-      });
-      setWarnings(res.data.warnings || []);
+      const res = await flushQueue();
+      setWarnings(res?.data.warnings || []);
       setSummaryOpen(true);
       toast.success("Attendance saved");
-    } catch {
-      toast.error("Failed to save");
+    } catch (e) {
+      toast.error(e.response ? "Failed to save" : "Offline - attendance is queued and will sync when you reconnect");
     } finally {
       setSaving(false);
     }
@@ -107,8 +179,8 @@ function TodayTab({ batchId, batch }) {
       });
       setDropinOpen(false);
       setDropinForm({ full_name: "", phone_number: "" });
-      await load();
-      setAttendance((prev) => ({ ...prev, [dRes.data.id]: "present" }));
+      pendingMarks.current = { [dRes.data.id]: "present" };
+      await reload();
       toast.success("Drop-in added");
     } catch (e) {
       toast.error(e.response?.data?.detail || "Failed to add drop-in");
@@ -136,7 +208,10 @@ function TodayTab({ batchId, batch }) {
           <p className="text-xs uppercase tracking-widest text-muted-foreground font-semibold">
             {session?.date || "Today"} Session
           </p>
-          <p className="text-sm text-muted-foreground mt-0.5">{presentCount}/{dancers.length} present</p>
+          <p className="text-sm text-muted-foreground mt-0.5">
+            {presentCount}/{dancers.length} present
+            {queued > 0 && <span className="font-medium text-foreground" data-testid="unsynced-indicator"> &middot; not synced yet</span>}
+          </p>
         </div>
         <div className="flex gap-2">
           <Button variant="outline" size="sm" className="rounded-full" onClick={() => setDropinOpen(true)} data-testid="add-dropin-button">
@@ -451,10 +526,17 @@ function DancersTab({ batchId }) {
 /* ============== HISTORY TAB ============== */
 function HistoryTab({ batchId }) {
   const [sessions, setSessions] = useState([]);
-
-  useEffect(() => {
-    api.get("/sessions", { params: { batch_id: batchId } }).then((r) => setSessions(r.data)).catch(() => {});
-  }, [batchId]);
+  const [nextCursor, setNextCursor] = useState(null);
+
+  const loadSessions = (cursor) => {
+    const params = { batch_id: batchId };
+    if (cursor) params.cursor = cursor;
+    api.get("/sessions", { params }).then((r) => {
+      setSessions((prev) => (cursor ? [...prev, ...r.data] : r.data));
+      setNextCursor(r.headers["x-next-cursor"] || null);
+    }).catch(() => {});
+  };
+  useEffect(() => { loadSessions(null); }, [batchId]);
 
   return (
     <div className="space-y-3">
@@ -482,6 +564,11 @@ function HistoryTab({ batchId }) {
           </Card>
         ))
       )}
+      {nextCursor && (
+        <Button variant="outline" className="w-full rounded-full" onClick={() => loadSessions(nextCursor)} data-testid="load-more-sessions">
+          Load more
+        </Button>
+      )}
     </div>
   );
 }
@@ -490,13 +577,20 @@ function HistoryTab({ batchId }) {
 export default function BatchView() {
   const { batchId } = useParams();
   const navigate = useNavigate();
-  const [batch, setBatch] = useState(null);
+  const [roster, setRoster] = useState(null);
+
+  // Batch, today's session, dancers and attendance in one request; unchanged rosters come back as 304
+  const loadRoster = useCallback(
+    () => api.get(`/batches/${batchId}/roster`).then((r) => setRoster(r.data)).catch((e) => {
+      if (e.response?.status === 404) navigate("/instructor/home");
+      else toast.error("Failed to load session");
+    }),
+    [batchId, navigate]
+  );
 
-  useEffect(() => {
-    api.get(`/batches/${batchId}`).then((r) => setBatch(r.data)).catch(() => navigate("/instructor/home"));
-  }, [batchId, navigate]);
+  useEffect(() => { loadRoster(); }, [loadRoster]);
 
-  if (!batch) return <div className="text-center py-12 text-muted-foreground">Loading...</div>;
+  if (!roster) return <div className="text-center py-12 text-muted-foreground">Loading...</div>;
 
   return (
     <div className="space-y-4" data-testid="batch-view">
@@ -505,18 +599,18 @@ export default function BatchView() {
       </button>
 
       <div>
-        <h1 className="font-heading text-2xl font-bold">{batch.batch_name}</h1>
-        <p className="text-sm text-muted-foreground">{batch.studio_name} &middot; {batch.schedule_days} {batch.time_slot}</p>
+        <h1 className="font-heading text-2xl font-bold">{roster.batch.batch_name}</h1>
+        <p className="text-sm text-muted-foreground">{roster.batch.studio_name} &middot; {roster.batch.schedule_days} {roster.batch.time_slot}</p>
       </div>
 
-      <Tabs defaultValue="today" className="w-full">
+      <Tabs defaultValue="today" className="w-full" onValueChange={(v) => { if (v === "today") loadRoster(); }}>
         <TabsList className="grid w-full grid-cols-3 rounded-xl bg-muted h-10">
           <TabsTrigger value="today" data-testid="tab-today" className="rounded-lg text-sm">Today</TabsTrigger>
           <TabsTrigger value="dancers" data-testid="tab-dancers" className="rounded-lg text-sm">Dancers</TabsTrigger>
           <TabsTrigger value="history" data-testid="tab-history" className="rounded-lg text-sm">History</TabsTrigger>
         </TabsList>
         <TabsContent value="today" className="mt-4">
-          <TodayTab batchId={batchId} batch={batch} />
+          <TodayTab batchId={batchId} roster={roster} reload={loadRoster} />
         </TabsContent>
         <TabsContent value="dancers" className="mt-4">
           <DancersTab batchId={batchId} />
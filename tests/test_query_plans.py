@@ -0,0 +1,107 @@
+"""Query plan checks: every hot query in backend/server.py must be served by a declared index.
+
+Needs a real MongoDB (explain() is not emulated by mocks), so the module is skipped unless MONGO_URL
+is set. The checks run against a scratch database (QUERY_PLAN_DB) that is dropped afterwards.
+"""
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+pytestmark = pytest.mark.skipif(not os.environ.get("MONGO_URL"), reason="MONGO_URL not set")
+
+# server needs connection settings to import, even when the module is skipped
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "aya_query_plans")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+import server  # noqa: E402
+
+TODAY = "2026-01-01"
+SETTINGS = {"monthly_expiry_warning_days": 5, "class_pack_expiry_warning_remaining": 2}
+
+# (collection, filter, sort) for the queries the endpoints issue on every request. Filters with structure
+# come from the same helpers server.py builds them with, so the checks follow changes to those helpers.
+HOT_QUERIES = [
+    ("users", {"email": "a@aya.dance"}, None),
+    ("users", {"role": "instructor"}, None),
+    ("batches", {"active": True}, None),
+    ("batches", {"assigned_instructor_ids": "u1", "active": True}, None),
+    ("batches", {"assigned_instructor_ids": "u1"}, None),
+    ("dancers", {"active": True}, None),
+    ("dancers", server.dancer_search_query("maya"), None),
+    ("dancers", {"$and": [{}, server.dancer_search_query("maya s", whole_words=True)]}, None),
+    ("dancers", {"$and": [{}, server.dancer_search_query("maya"), {"id": {"$nin": ["d1"]}}]}, None),
+    ("dancers", server.dancer_search_query("98765"), None),
+    ("dancers", {}, [("full_name", 1), ("id", 1)]),
+    ("dancers", server.keyset_query({}, "full_name", "M", "x", "$gt"), [("full_name", 1), ("id", 1)]),
+    ("enrollments", {"batch_id": "b1", "active": True}, None),
+    ("enrollments", {"batch_id": {"$in": ["b1", "b2"]}, "active": True}, None),
+    ("enrollments", {"dancer_id": "d1"}, None),
+    ("enrollments", {"dancer_id": "d1", "batch_id": "b1", "active": True}, None),
+    ("passes", {"dancer_id": "d1"}, None),
+    ("passes", {"batch_id": "b1"}, None),
+    ("passes", {"dancer_id": {"$in": ["d1"]}, "batch_id": "b1"}, [("created_at", -1)]),
+    ("passes", {"batch_id": "b1", "dancer_id": {"$in": ["d1"]}}, [("created_at", -1)]),
+    ("passes", server.pass_status_query("expired", SETTINGS), None),
+    ("passes", server.pass_status_query("expiring_soon", SETTINGS), None),
+    ("current_passes", {"batch_id": "b1", "dancer_id": {"$in": ["d1"]}}, None),
+    ("sessions", {"batch_id": "b1", "date": TODAY}, None),
+    ("sessions", server.session_query("b1", end_date=TODAY), [("date", -1), ("id", -1)]),
+    ("sessions", server.keyset_query(server.session_query("b1", end_date=TODAY), "date", TODAY, "s1", "$lt"),
+     [("date", -1), ("id", -1)]),
+    ("sessions", server.unmarked_scheduled_sessions_query("b1", TODAY, ["2026-01-08"]), None),
+    ("sessions", {"date": TODAY}, None),
+    ("sessions", server.session_query(start_date=TODAY, end_date="2026-01-31"), None),
+    ("attendance", {"session_id": "s1"}, None),
+    ("attendance", {"session_id": "s1", "dancer_id": {"$in": ["d1"]}}, None),
+    ("attendance", {"dancer_id": "d1", "status": "present"}, None),
+    ("attendance", {"session_id": "s1", "timestamp": {"$gte": TODAY}}, None),
+    ("attendance_sync_ops", {"user_id": "u1", "id": {"$in": ["x1", "x2"]}}, None),
+    ("daily_attendance_rollups", {"date": {"$gte": TODAY}}, None),
+    ("daily_attendance_rollups", {"batch_id": "b1", "date": {"$gte": TODAY}}, None),
+    ("audit_log", {}, [("timestamp", -1), ("id", -1)]),
+    ("audit_log", server.keyset_query({"action_type": "mark_attendance"}, "timestamp", TODAY, "a1", "$lt"),
+     [("timestamp", -1), ("id", -1)]),
+    ("audit_log", {"timestamp": {"$lt": TODAY}}, None),
+    ("audit_log", {"entity_type": "dancer", "entity_id": "d1"}, [("timestamp", -1)]),
+    ("notifications", {"scope": "admin", "dismissed": False}, [("rank", 1)]),
+    ("export_jobs", {}, [("created_at", -1)]),
+    ("export_jobs", {"status": "queued"}, [("created_at", 1)]),
+]
+
+
+def stages(plan):
+    yield plan.get("stage")
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            yield from stages(plan[key])
+    for child in plan.get("inputStages", []):
+        yield from stages(child)
+
+
+@pytest.fixture(scope="module")
+def database():
+    from pymongo import MongoClient
+
+    client = MongoClient(os.environ["MONGO_URL"])
+    name = os.environ.get("QUERY_PLAN_DB", "aya_query_plans")
+    client.drop_database(name)
+    db = client[name]
+    for collection, models in server.INDEXES.items():
+        db[collection].create_indexes(models)
+        # explain() on a collection that does not exist reports EOF rather than a plan
+        db[collection].insert_one({"id": "seed"})
+    yield db
+    client.drop_database(name)
+    client.close()
+
+
+@pytest.mark.parametrize("collection,filter,sort", HOT_QUERIES)
+def test_hot_query_uses_index(database, collection, filter, sort):
+    command = {"find": collection, "filter": filter}
+    if sort:
+        command["sort"] = dict(sort)
+    explain = database.command("explain", command, verbosity="queryPlanner")
+    plan = explain["queryPlanner"]["winningPlan"]
+    assert "COLLSCAN" not in set(stages(plan)), f"{collection} {filter} {sort}: {plan}"
@@ -0,0 +1,58 @@
+"""Schedule text parsing used to pre-generate sessions from batch schedules.
+
+Pure functions, so no database is needed; server only requires the connection settings to import.
+"""
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "aya_schedule_tests")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+from server import parse_schedule_days, parse_time_slot  # noqa: E402
+
+MON, TUE, WED, THU, FRI, SAT, SUN = range(7)
+
+
+@pytest.mark.parametrize("text,days", [
+    ("Mon-Fri", {MON, TUE, WED, THU, FRI}),
+    ("Mon-Fri 7pm", {MON, TUE, WED, THU, FRI}),
+    ("Monday - Thursday", {MON, TUE, WED, THU}),
+    ("Fri-Sun", {FRI, SAT, SUN}),
+    ("Fri–Sun", {FRI, SAT, SUN}),
+    ("Mon-Wed", {MON, TUE, WED}),
+    ("Mon–Wed", {MON, TUE, WED}),
+    ("Tue-Thu", {TUE, WED, THU}),
+    ("Tue to Thu", {TUE, WED, THU}),
+    ("Sat-Mon", {SAT, SUN, MON}),
+    ("Mon, Wed-Fri", {MON, WED, THU, FRI}),
+    ("Mon-Wed-Fri", {MON, WED, FRI}),
+    ("Tue/Thu", {TUE, THU}),
+    ("Tu/Th", {TUE, THU}),
+    ("M/W/F", {MON, WED, FRI}),
+    ("Sat & Sun", {SAT, SUN}),
+    ("Weekends", {SAT, SUN}),
+    ("Daily", set(range(7))),
+    ("", set()),
+    (None, set()),
+    ("TBD", set()),
+])
+def test_parse_schedule_days(text, days):
+    assert parse_schedule_days(text) == days
+
+
+@pytest.mark.parametrize("text,start", [
+    ("7:00-8:30 PM", "19:00"),
+    ("6pm", "18:00"),
+    ("11-12:30 pm", "11:00"),
+    ("12-1 pm", "12:00"),
+    ("12 am", "00:00"),
+    ("18.30", "18:30"),
+    ("evening", None),
+    ("25:00", None),
+])
+def test_parse_time_slot(text, start):
+    assert parse_time_slot(text) == start